@@ -0,0 +1,356 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    import fcntl
+except ImportError:  # not available on windows, the index is then only guarded within a process
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "klub-100-maker")
+DEFAULT_MAX_SIZE = 20 * 1024**3
+
+# query parameters that do not change which audio is downloaded
+IGNORED_QUERY = {"t", "feature", "si", "ab_channel", "list", "index", "pp", "fbclid"}
+
+
+def normalize_link(link):
+    """
+    Normalizes a link so different ways of writing the same source share one cache entry
+    ---------------------------------------
+    link = the link as written in the sheet
+    """
+    link = str(link).strip()
+    parts = urlsplit(link)
+    if not parts.scheme or not parts.netloc:
+        return link
+
+    scheme = parts.scheme.lower()
+    if scheme == "http":
+        scheme = "https"
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip("/")
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k not in IGNORED_QUERY and not k.startswith("utm_")]
+
+    # youtu.be/<id> and youtube.com/watch?v=<id> are the same video
+    if host == "youtu.be":
+        host, query, path = "youtube.com", [("v", path.lstrip("/"))], "/watch"
+    if host == "youtube.com" and path == "/watch":
+        query = [(k, v) for k, v in query if k == "v"]
+
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ""))
+
+
+def file_hash(path, chunk_size = 1 << 20):
+    """
+    Returns the sha256 hex digest of a file
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def locked_json(path):
+    """
+    Read-modify-write of a json file under an exclusive lock, so several builds (and processes of a build) can share it
+    """
+    with open(path + ".lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = {}
+            if os.path.exists(path):
+                with open(path, "rt") as f:
+                    data = json.load(f)
+            yield data
+            tmp = path + ".tmp"
+            with open(tmp, "wt") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-links src to dst, falling back to a copy when the two are on different file systems
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class DownloadCache:
+    """
+    Persistent on-disk cache of downloaded audio, shared between clubs and rebuilds
+    ---------------------------------------
+    path = the folder to keep the cache in \n
+    max_size = the maximum size of the cache in bytes, the least recently used files are evicted beyond this
+    """
+
+    # the links being downloaded by the builds running in this process, see claim
+    _claims = {}
+    _claims_lock = threading.Lock()
+
+    def __init__(self, path = DEFAULT_CACHE_DIR, max_size = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.index_path = os.path.join(path, "index.json")
+        os.makedirs(path, exist_ok = True)
+
+    def claim(self, link, fmt = "wav", variant = ""):
+        """
+        Returns the lock to hold while downloading the link, so builds running at the same time (see Functions/service.py)
+        download it once and the others take it from the cache
+        """
+        with DownloadCache._claims_lock:
+            return DownloadCache._claims.setdefault(self.key(link, fmt, variant), threading.Lock())
+
+    def key(self, link, fmt = "wav", variant = ""):
+        # variant separates different cuts of the same link, e.g. a downloaded time window
+        return hashlib.sha256((normalize_link(link) + "\n" + fmt + "\n" + variant).encode("utf-8")).hexdigest()
+
+    def _file(self, key, fmt):
+        return os.path.join(self.path, key[:2], key + "." + fmt)
+
+    def _index(self):
+        return locked_json(self.index_path)
+
+    def get(self, link, fmt = "wav", variant = ""):
+        """
+        Returns the path of the cached file for the link or None if it is not cached (or fails the integrity check). The file
+        is only hashed when its size or modification time differs from when it was stored, and then outside the index lock
+        """
+        key = self.key(link, fmt, variant)
+        path = self._file(key, fmt)
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            st = os.stat(path) if os.path.exists(path) else None
+            if st is None or st.st_size != entry["size"]:
+                self._drop(index, key, link)
+                return None
+            if st.st_mtime_ns == entry.get("mtime_ns"):
+                entry["last_used"] = time.time()
+                return path
+            sha256 = entry["sha256"]
+
+        digest = file_hash(path)
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None or entry["sha256"] != sha256:
+                # replaced by another build meanwhile
+                return None
+            if digest != sha256:
+                self._drop(index, key, link)
+                return None
+            entry["mtime_ns"] = st.st_mtime_ns
+            entry["last_used"] = time.time()
+        return path
+
+    def _drop(self, index, key, link):
+        print("Dropping corrupt cache entry for", link)
+        path = self._file(key, index.pop(key)["format"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def verify(self):
+        """
+        Hashes every cached file and drops the entries whose file is missing or changed, returns how many were dropped
+        """
+        with self._index() as index:
+            entries = dict(index)
+        corrupt = [key for key, entry in entries.items() if not os.path.exists(self._file(key, entry["format"]))
+                   or file_hash(self._file(key, entry["format"])) != entry["sha256"]]
+        with self._index() as index:
+            for key in corrupt:
+                if key in index and index[key]["sha256"] == entries[key]["sha256"]:
+                    self._drop(index, key, index[key]["link"])
+        return len(corrupt)
+
+    def put(self, link, src, fmt = "wav", variant = ""):
+        """
+        Stores a downloaded file in the cache and returns its path in the cache
+        """
+        key = self.key(link, fmt, variant)
+        path = self._file(key, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = path + ".tmp"
+        shutil.copyfile(src, tmp)
+        # hashed before it is moved into place and the index is locked
+        digest = file_hash(tmp)
+        os.replace(tmp, path)
+        st = os.stat(path)
+        with self._index() as index:
+            index[key] = {"link": normalize_link(link), "format": fmt, "variant": variant, "size": st.st_size,
+                          "mtime_ns": st.st_mtime_ns, "sha256": digest, "last_used": time.time()}
+            self._evict(index)
+        return path
+
+    def fetch(self, link, dst, fmt = "wav", variant = ""):
+        """
+        Places the cached file for the link at dst, returns whether the link was cached
+        """
+        path = self.get(link, fmt, variant)
+        if path is None:
+            return False
+        link_or_copy(path, dst)
+        return True
+
+    def _evict(self, index):
+        total = sum(e["size"] for e in index.values())
+        for key, entry in sorted(index.items(), key = lambda kv: kv[1]["last_used"]):
+            if total <= self.max_size:
+                break
+            path = self._file(key, entry["format"])
+            if os.path.exists(path):
+                os.remove(path)
+            total -= entry["size"]
+            del index[key]
+
+
+class LoudnessCache:
+    """
+    Persistent cache of loudness measurements, so a rebuild with another target volume only applies the gain and fades.
+    Measurements are keyed by the content of the source file, the trim and the measuring method. The hash of the content of
+    a file is kept by its path, size and modification time (see digest), so a file is only hashed once. Both are kept in
+    256 shards by the first two hex digits of their key, so a lookup reads (and an update locks) a small part of the cache
+    ---------------------------------------
+    path = the folder to keep the cache in (shared with the DownloadCache by default)
+    """
+
+    def __init__(self, path = DEFAULT_CACHE_DIR):
+        self.path = path
+        self.index_path = os.path.join(path, "loudness")
+        self.digests_path = os.path.join(path, "digests")
+        # the shards read or written by this process, by shard path
+        self._shards = {}
+        os.makedirs(self.index_path, exist_ok = True)
+        os.makedirs(self.digests_path, exist_ok = True)
+        self._migrate(os.path.join(path, "loudness.json"), self.index_path, lambda key: key)
+        self._migrate(os.path.join(path, "digests.json"), self.digests_path, self._path_key)
+
+    @staticmethod
+    def _path_key(path):
+        return hashlib.sha256(path.encode("utf-8")).hexdigest()
+
+    def _migrate(self, old, folder, key_of):
+        # caches made before the index was sharded are split into shards once
+        if not os.path.exists(old):
+            return
+        with locked_json(old) as index:
+            shards = {}
+            for key, value in index.items():
+                shards.setdefault(os.path.join(folder, key_of(key)[:2] + ".json"), {})[key] = value
+            for shard, entries in shards.items():
+                with locked_json(shard) as data:
+                    for key, value in entries.items():
+                        data.setdefault(key, value)
+            index.clear()
+        os.remove(old)
+
+    def _lookup(self, shard, key):
+        # a shard is read again only when it does not have the key yet, it is replaced atomically so it can be read without the lock
+        entries = self._shards.get(shard)
+        if (entries is None or key not in entries) and os.path.exists(shard):
+            with open(shard, "rt") as f:
+                entries = self._shards[shard] = json.load(f)
+        return None if entries is None else entries.get(key)
+
+    def digest(self, input):
+        """
+        Returns the sha256 hex digest of a file, hashing it only if it is new or its size or modification time changed since
+        it was last hashed
+        """
+        path = os.path.abspath(input)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        shard = os.path.join(self.digests_path, self._path_key(path)[:2] + ".json")
+        entry = self._lookup(shard, path)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["sha256"]
+
+        entry = {"stamp": stamp, "sha256": file_hash(path)}
+        with locked_json(shard) as digests:
+            # the files of removed clubs are forgotten
+            for gone in [p for p in digests if not os.path.exists(p)]:
+                del digests[gone]
+            digests[path] = entry
+            self._shards[shard] = dict(digests)
+        return entry["sha256"]
+
+    def key(self, input, ss, length, method):
+        """
+        Returns the key of the measurement of input trimmed to [ss, ss + length] (None for no trim) with a method, e.g. "loudnorm"
+        """
+        trim = [None if v is None else float(v) for v in (ss, length)]
+        return hashlib.sha256(json.dumps([self.digest(input), trim, method]).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the stored measurement or None
+        """
+        stats = self._lookup(os.path.join(self.index_path, key[:2] + ".json"), key)
+        # a copy, the caller may change it
+        return None if stats is None else dict(stats)
+
+    def put(self, key, stats):
+        shard = os.path.join(self.index_path, key[:2] + ".json")
+        with locked_json(shard) as index:
+            index[key] = stats
+            self._shards[shard] = dict(index)
+
+
+class PreparedCache:
+    """
+    Prepared songs and shoutouts shared between clubs. They are named by a key of everything they are made from (see
+    Functions/manifest.py), so a song prepared with the same settings for another club is linked instead of prepared again.
+    The files are hard links to the ones in the clubs where possible and are not evicted, remove the folder to clear it
+    ---------------------------------------
+    path = the folder to keep the cache in (shared with the DownloadCache by default)
+    """
+
+    def __init__(self, path = DEFAULT_CACHE_DIR):
+        self.path = os.path.join(path, "prepared")
+        os.makedirs(self.path, exist_ok = True)
+
+    def fetch(self, folder, keys):
+        """
+        Links the cached files of the keys that are missing in folder into it, returns how many were found
+        """
+        os.makedirs(folder, exist_ok = True)
+        found = 0
+        for key in set(keys):
+            src, dst = os.path.join(self.path, key + ".wav"), os.path.join(folder, key + ".wav")
+            if os.path.exists(src) and not os.path.exists(dst):
+                link_or_copy(src, dst)
+                found += 1
+        return found
+
+    def put(self, folder, keys):
+        """
+        Adds the files of the keys in folder to the cache
+        """
+        for key in set(keys):
+            src, dst = os.path.join(folder, key + ".wav"), os.path.join(self.path, key + ".wav")
+            if os.path.exists(src) and not os.path.exists(dst):
+                # replaced atomically, so a build fetching at the same time never links a partial file
+                tmp = dst + "." + str(threading.get_ident()) + ".tmp"
+                link_or_copy(src, tmp)
+                os.replace(tmp, dst)
@@ -0,0 +1,221 @@
+import os
+import struct
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from Functions.pcm import FFMPEG_INPUT_ARGS, iter_pcm_range, pcm_length
+from Functions.trace import note, span
+
+# the frames of a chunk before and after the part that is kept, so the encoder has settled at the joins
+PREROLL_FRAMES = 4
+
+MP3_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MP3_SAMPLE_RATES = [44100, 48000, 32000]
+
+
+def mp3_frames(data):
+    """
+    Splits mpeg-1 layer III data into its frames. Raises ValueError on anything that is not a frame, including the free format
+    and reserved bitrate and sample rate indexes, which would give a frame without a length
+    """
+    frames = []
+    i = 0
+    while i + 4 <= len(data):
+        if data[i] != 0xFF or data[i + 1] & 0xFE != 0xFA:
+            raise ValueError('No mp3 frame at byte ' + str(i))
+        bitrate_index, sr_index = data[i + 2] >> 4, (data[i + 2] >> 2) & 3
+        if bitrate_index in (0, 15) or sr_index == 3:
+            raise ValueError('Unsupported mp3 frame header at byte ' + str(i))
+        length = 144000 * MP3_BITRATES[bitrate_index] // MP3_SAMPLE_RATES[sr_index] + ((data[i + 2] >> 1) & 1)
+        if length < 4:
+            raise ValueError('Invalid mp3 frame length at byte ' + str(i))
+        frames.append(data[i:i + length])
+        i += length
+    return frames
+
+
+def adts_frames(data):
+    """
+    Splits aac data in adts framing into its frames. Raises ValueError on anything that is not a frame
+    """
+    frames = []
+    i = 0
+    while i + 7 <= len(data):
+        if data[i] != 0xFF or data[i + 1] & 0xF0 != 0xF0:
+            raise ValueError('No adts frame at byte ' + str(i))
+        length = ((data[i + 3] & 3) << 11) | (data[i + 4] << 3) | (data[i + 5] >> 5)
+        if length < 7:
+            raise ValueError('Invalid adts frame length at byte ' + str(i))
+        frames.append(data[i:i + length])
+        i += length
+    return frames
+
+
+# samples per frame, the ffmpeg arguments of a chunk, the frame splitter and whether the first chunk starts with an info header.
+# Without the bit reservoir every mp3 frame holds all of its own data, so frames of different chunks can be put next to each other
+CODECS = {
+    "mp3": (1152, ['-c:a', 'libmp3lame', '-reservoir', '0', '-f', 'mp3', '-id3v2_version', '0'], mp3_frames, True),
+    "aac": (1024, ['-c:a', 'aac', '-f', 'adts'], adts_frames, False),
+}
+
+
+def crc16(data):
+    # the crc-16 (0x8005, reflected) that protects the lame tag
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def info_offset(frame):
+    """
+    Returns the position of the xing/info header in an mp3 frame, or -1 if the frame is not an info frame with all four fields
+    (frame count, size, seek table and quality, as ffmpeg writes them) followed by a lame tag
+    """
+    i = max(frame.find(b'Info'), frame.find(b'Xing'))
+    if i < 0 or len(frame) < i + 120 + 36 or struct.unpack_from('>I', frame, i + 4)[0] & 0xF != 0xF:
+        return -1
+    return i
+
+
+def patch_info(header, sizes, samples):
+    """
+    Returns the mp3 info (xing/lame) header of the first chunk with the frame count, size, seek table and padding of the joined frames.
+    Raises ValueError if header is not an info frame (see info_offset)
+    ---------------------------------------------
+    header = the info frame written by ffmpeg for the first chunk \n
+    sizes = the size of every joined audio frame \n
+    samples = the number of samples that were encoded
+    """
+    i = info_offset(header)
+    if i < 0:
+        raise ValueError('No xing/info header with a lame tag in the first frame')
+    header = bytearray(header)
+    size = len(header) + sum(sizes)
+
+    offsets = [len(header)]
+    for length in sizes:
+        offsets.append(offsets[-1] + length)
+    struct.pack_into('>II', header, i + 8, len(sizes), size)
+    header[i + 16:i + 116] = bytes(min(offsets[k * len(sizes) // 100] * 256 // size, 255) for k in range(100))
+
+    # the lame tag: the encoder delay stays, the padding at the end and the music length change
+    lame = i + 120
+    delay = int.from_bytes(header[lame + 21:lame + 24], 'big') >> 12
+    padding = len(sizes) * 1152 - delay - samples
+    header[lame + 21:lame + 24] = (delay << 12 | padding).to_bytes(3, 'big')
+    struct.pack_into('>I', header, lame + 28, size)
+    struct.pack_into('>H', header, lame + 34, crc16(header[:lame + 34]))
+    return bytes(header)
+
+
+def chunk_bounds(lengths, n, frame):
+    """
+    Returns the sample positions [0, ..., total] that split segments of the given lengths into about n chunks of the same length.
+    The chunks are split at the segment boundaries, rounded down to whole frames
+    """
+    total = sum(lengths)
+    bounds = [0]
+    position = 0
+    for length in lengths[:-1]:
+        position += length
+        bound = position // frame * frame
+        if position >= total * len(bounds) / n and bound > bounds[-1]:
+            bounds.append(bound)
+    return bounds + [total]
+
+
+def encode_chunk(segments, start, end, output, args):
+    """
+    Encodes the samples [start, end) of the timeline of segments, a list of (path, offset, length), to output
+    """
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', *FFMPEG_INPUT_ARGS, '-i', '-', *args, '-y', output],
+                               stdin=subprocess.PIPE)
+    with span("encode chunk", "encode", output = output, start = start, end = end):
+        piped = 0
+        for path, offset, length in segments:
+            if offset + length <= start or offset >= end:
+                continue
+            for chunk in iter_pcm_range(path, max(start - offset, 0), min(end - offset, length)):
+                process.stdin.write(chunk)
+                piped += len(chunk)
+        process.stdin.close()
+        process.wait()
+        note(bytes_piped = piped, status = process.returncode)
+
+    if process.returncode != 0:
+        raise RuntimeError('Could not encode ' + output)
+
+
+def encode_chunked(inputs, output, chunks = None, args = ()):
+    """
+    Encodes segments one after another into a single mp3 or aac file, encoding chunks of the club on all cores at once.
+    Every chunk starts a few frames early and ends a few frames late on the frame grid of a serial encode, and only the frames
+    between its bounds are kept, so the joined frames decode gaplessly to the same number of samples.
+    When the segments can not be split into at least two chunks the club is encoded by a single encoder (see combine.encode)
+    -----------------------------------
+    inputs = the audio files to put together in order \n
+    output = the file to encode to, its extension must be .mp3 or .aac \n
+    chunks = the number of chunks to encode at the same time, by default the number of cpus \n
+    args = extra encoder arguments, e.g. the bitrate
+    """
+    frame, codec, split, info = CODECS[os.path.splitext(output)[1][1:]]
+    chunks = chunks or os.cpu_count()
+
+    segments = []
+    offset = 0
+    for path in inputs:
+        if not os.path.exists(path):
+            print('Skipping missing segment', path, file=sys.stderr)
+            continue
+        length = pcm_length(path)
+        segments.append((path, offset, length))
+        offset += length
+
+    bounds = chunk_bounds([s[2] for s in segments], chunks, frame)
+    if len(bounds) < 3:
+        from Functions.combine import encode
+        encode([s[0] for s in segments], [(output, list(args))])
+        return
+    parts = [output + '.part' + str(k) for k in range(len(bounds) - 1)]
+    preroll = PREROLL_FRAMES * frame
+    starts = [max(bounds[k] - preroll, 0) for k in range(len(parts))]
+
+    try:
+        with ThreadPoolExecutor(chunks) as pool, open(output, 'wb') as f:
+            # only the first chunk gets the info header, it is completed for the joined frames below
+            jobs = [pool.submit(encode_chunk, segments, starts[k], min(bounds[k + 1] + preroll, offset), parts[k],
+                                [*codec, *args] + (['-write_xing', '1' if k == 0 else '0'] if info else [])) for k in range(len(parts))]
+
+            # the chunks are written out in order as soon as they are encoded, so only one chunk is in memory at a time
+            header = None
+            sizes = []
+            for k, (part, job) in enumerate(zip(parts, jobs)):
+                job.result()
+                with open(part, 'rb') as p:
+                    part_frames = split(p.read())
+                os.remove(part)
+                # an encoder that wrote no info header leaves the first frame as audio, the club is then written without one
+                if k == 0 and info and part_frames and info_offset(part_frames[0]) >= 0:
+                    header = part_frames.pop(0)
+                    # the space of the header is kept, it is written once the frames after it are known
+                    f.write(bytes(len(header)))
+
+                first = (bounds[k] - starts[k]) // frame
+                last = first + (bounds[k + 1] - bounds[k]) // frame if k < len(parts) - 1 else len(part_frames)
+                for data in part_frames[first:last]:
+                    f.write(data)
+                    sizes.append(len(data))
+
+            if header is not None:
+                f.seek(0)
+                f.write(patch_info(header, sizes, offset))
+    except BaseException:
+        # e.g. a chunk failed, neither the chunks nor a part of the club are left behind
+        for path in [*parts, output]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
@@ -1,17 +1,8 @@
 #!/usr/bin/env python3
 import argparse
-import csv
 import subprocess
 import os
 
-err = subprocess.Popen(['pip', 'install', 'ffmpeg'], 
-                       stdout=subprocess.DEVNULL, 
-                       stderr=subprocess.PIPE).communicate()[1]
-
-if len(err) != 0:
-    print(err)
-    exit(1)
-
 # parser = argparse.ArgumentParser()
 # parser.add_argument('-shoutouts', type=str, default=os.path.join(os.path.curdir, 'prepared_shoutouts'),
 #                     help='Input shoutouts folder')
@@ -25,41 +16,142 @@ if len(err) != 0:
 # if not os.path.exists(args.shoutouts) or not os.path.exists(args.tracks):
 #     exit(1)
 
-def combine(songs_csv = "klub.csv", prep_shoutout_path = "prepared_shoutouts", prep_tracks_path = "prepared_tracks", output_name = "klub", file_format = "mp3", with_shoutouts = True):
+def combine(songs_csv = "klub.csv", prep_shoutout_path = "prepared_shoutouts", prep_tracks_path = "prepared_tracks", output_name = "klub", file_format = "mp3", with_shoutouts = True, song_keys = None, shoutout_keys = None, chunks = None, live = None):
     """
     Combines songs and shoutouts
     -----------------------------------
-    club_name = the name of the club csv file \n
+    club_name = the name of the club csv file, or the songs of a plan (see Functions/plan.py) \n
     prep_shoutout_path = path for the folder with the prepared shoutouts \n
     prep_tracks_path = path for the folder with the prepared tracks \n
     output_name = navnet på den lyd fil der skal laves med klub 100 \n
-    fileformat = the fileformat to use for the club \n
-    with_shoutout = whether or not to use shoutouts
+    fileformat = the fileformat to use for the club, optionally with a bitrate ("mp3:192k"). A list of formats makes a file of every format from the same render (see outputs) \n
+    with_shoutout = whether or not to use shoutouts \n
+    song_keys = the file name (without .wav) of each prepared track in the order of songs_csv, by default the row number \n
+    shoutout_keys = the file name (without .wav) of each prepared shoutout in the order of songs_csv, by default the row number \n
+    chunks = if given, mp3 and aac are encoded in this many chunks at the same time instead of by a single encoder (see Functions/chunked.py). Ignored on a single cpu, where the chunks would only be encoded one after another \n
+    live = a live output (see Functions/live.py) to also stream the club to while it is encoded
     """
 
+    from Functions.chunked import CODECS, encode_chunked
+    from Functions.manifest import csv_rows
+    from Functions.toolchain import require
+
+    require("ffmpeg")
+
     print("Putting the elements together...")
 
     shoutouts = prep_shoutout_path #os.path.join(os.path.curdir, 'prepared_shoutouts') if ((prep_shoutout_path is None) & (with_shoutouts)) else prep_shoutout_path
     tracks = prep_tracks_path #os.path.join(os.path.curdir, 'prepared_tracks') if prep_tracks_path is None else prep_tracks_path
-    output = output_name + "."+ file_format #os.path.join(os.path.curdir, output_name + "." + fileformat)
+    output = outputs(output_name, file_format) #os.path.join(os.path.curdir, output_name + "." + fileformat)
     inputs = []
 
-    
-        
-    with open(songs_csv, 'rt') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+    for i, row in enumerate(csv_rows(songs_csv), 1):
+        if with_shoutouts:
+            inputs.append(os.path.join(shoutouts, (str(i) if shoutout_keys is None else shoutout_keys[i-1]) + '.wav'))
         
-        for i, row in enumerate(reader, 1):
-            if with_shoutouts:
-                inputs.append('-i')
-                inputs.append(os.path.join(shoutouts, str(i) + '.wav'))
-            
-            inputs.append('-i')
-            inputs.append(os.path.join(tracks, str(i) + '.wav'))
+        inputs.append(os.path.join(tracks, (str(i) if song_keys is None else song_keys[i-1]) + '.wav'))
+
+    if chunks is not None and os.cpu_count() > 1:
+        # the formats that can be encoded in chunks are each encoded on all cores, the others together by one encoder
+        for path, args in [o for o in output if o[0].rsplit(".", 1)[1] in CODECS]:
+            encode_chunked(inputs, path, chunks, args)
+        output = [o for o in output if o[0].rsplit(".", 1)[1] not in CODECS]
+    if output or live is not None:
+        encode(inputs, output, live = live)
+
+def outputs(output_name, file_format):
+    """
+    Returns the file and the ffmpeg encoder arguments of every output format
+    -----------------------------------
+    output_name = the file name without extension \n
+    file_format = a file format, optionally followed by a bitrate ("mp3:192k"), or a list of them (["mp3:192k", "flac", "opus:96k"]). Every format can only be given once
+    """
+    files = []
+    for f in (file_format if isinstance(file_format, list) else [file_format]):
+        extension, _, bitrate = f.partition(":")
+        files.append((output_name + "." + extension, ['-b:a', bitrate] if bitrate else []))
+    
+    if len(set(path for path, _ in files)) != len(files):
+        raise AssertionError(f"Every file format can only be given once, got {file_format}")
+    return files
+
+def encode(inputs, output, input_args = None, live = None):
+    """
+    Encodes segments one after another into a single output file
+    -----------------------------------
+    inputs = the audio files to put together in order, either paths or futures of paths (see Functions/pipeline.py) or of raw pcm (see Functions/stream.py, None for a segment that failed). A future is waited for only when its turn comes, so the encoder can start on the first segments while the rest are still being made \n
+    output = the file to encode to, the format is given by its extension. Can also be a list of (file, encoder arguments), see outputs, which are all encoded at once from a single pass over the inputs \n
+    input_args = the ffmpeg arguments describing the raw pcm of the inputs, by default the canonical format (see Functions/pcm.py) \n
+    live = a live output (see Functions/live.py): the club is also encoded as an mp3 stream, which is written to it as it is
+    encoded, so every segment is played as soon as it and the segments before it are made
+    """
+    import sys
+    import threading
+    from Functions.pcm import FFMPEG_INPUT_ARGS, iter_pcm
+    from Functions.toolchain import require
+    from Functions.trace import note, span
 
-    n = 2*i if with_shoutouts else i
-    filter_ = ''.join(('[' + str(a) + ':0]' for a in range(0, n))) + 'concat=n=' + str(n) + ':v=0:a=1[out]'
+    require("ffmpeg")
 
-    process = subprocess.Popen(['ffmpeg', *inputs, '-filter_complex', filter_, '-map', '[out]', output],
-                            stdout=subprocess.PIPE)
-    process.communicate()
+    if isinstance(output, str):
+        output = [(output, [])]
+    if input_args is None:
+        input_args = FFMPEG_INPUT_ARGS
+    
+    if live is not None:
+        from Functions.live import LIVE_ARGS
+        output = [*output, ('pipe:1', LIVE_ARGS)]
+    
+    # the segments are appended one at a time to a single ffmpeg as raw pcm, so only one input is open at any time.
+    # ffmpeg feeds the decoded pcm to the encoders of all outputs, which run in their own threads
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-y', *input_args, '-i', '-',
+                                *[arg for path, args in output for arg in [*args, path]]],
+                            stdin=subprocess.PIPE,
+                            stdout=None if live is None else subprocess.PIPE)
+    # the live stream is read by its own thread while the segments are written. A player reading slowly from stdout holds up
+    # the encoder (and so a streaming build), the songs/shoutouts of a pipelined build are still made
+    pump = None
+    if live is not None:
+        pump = threading.Thread(target = live.pump, args = (process.stdout,), daemon = True)
+        pump.start()
+    
+    try:
+        with span("encode", "encode", output = [path for path, _ in output]):
+            piped = 0
+            try:
+                for path in inputs:
+                    if not isinstance(path, str):
+                        path = path.result()
+                    
+                    if isinstance(path, bytes):
+                        process.stdin.write(path)
+                        piped += len(path)
+                        continue
+                    
+                    if path is None:
+                        continue
+                    
+                    if not os.path.exists(path):
+                        print('Skipping missing segment', path, file=sys.stderr)
+                        continue
+                    
+                    for chunk in iter_pcm(path):
+                        process.stdin.write(chunk)
+                        piped += len(chunk)
+                process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg stopped reading, its return code tells why
+                pass
+            
+            if pump is not None:
+                pump.join()
+            process.wait()
+            note(bytes_piped = piped, status = process.returncode)
+    finally:
+        # e.g. when a segment could not be made, the encoder is stopped instead of being left waiting for more
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    
+    if process.returncode != 0:
+        raise RuntimeError('Could not encode ' + ', '.join(path for path, _ in output))
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Runs downloads and preparations on other machines. A build serves its work as self-contained units (a link to download,
+or the input file and arguments of a preparation) from a coordinator, and workers on any machine that can reach it lease
+units, run them and send the resulting file back. Units whose worker fails or stops answering are given to another worker.
+
+    KLUB_AUTHKEY=<secret> python -m Functions.distributed worker <coordinator host>:<port> --processes 4
+
+Many worker processes on one machine stand in for several machines just as well. The coordinator and the workers exchange
+pickles, so they must share a secret KLUB_AUTHKEY, and a coordinator only listens on other interfaces than loopback when
+asked to (see Coordinator).
+"""
+import argparse
+import ipaddress
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from multiprocessing import Process
+from multiprocessing.connection import Connection
+from multiprocessing.managers import BaseManager
+
+DEFAULT_PORT = 50100
+AUTHKEY_ENV = "KLUB_AUTHKEY"
+
+
+def authkey():
+    # the key workers and coordinator prove to each other, set KLUB_AUTHKEY to the same secret value on all machines
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        raise AssertionError(f"Set the {AUTHKEY_ENV} environment variable to the same secret value on the coordinator and all workers")
+    return key.encode("utf-8")
+
+
+def parse_address(address):
+    """
+    Returns (host, port) of "host:port" or "host"
+    """
+    host, _, port = address.rpartition(":") if ":" in address else (address, "", "")
+    return host, int(port or DEFAULT_PORT)
+
+
+def is_loopback(host):
+    """
+    Returns whether host only accepts connections from this machine
+    """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class WorkQueue:
+    """
+    The units of a build, leased to workers for lease_time seconds at a time, which the workers renew while they are working
+    on a unit. A unit that fails or whose lease runs out (its worker died or lost the connection) is given out again, after
+    the other pending units, up to retries times
+    """
+
+    def __init__(self, lease_time = 60, retries = 3):
+        self.lease_time = lease_time
+        self.retries = retries
+        self.lock = threading.Condition()
+        self.units = {}
+        self.pending = deque()
+        self.leases = {}
+        self.attempts = {}
+        self.done = queue.Queue()
+        # when a unit was last put, leased, renewed or finished, see stalled
+        self.active = time.time()
+
+    def put(self, unit_id, unit):
+        with self.lock:
+            self.units[unit_id] = unit
+            self.attempts[unit_id] = 0
+            self.pending.append(unit_id)
+            self.active = time.time()
+            self.lock.notify()
+
+    def _retry(self, unit_id, error):
+        # gives a unit out again after the other pending units, or fails it once it has used its retries
+        self.attempts[unit_id] += 1
+        if self.attempts[unit_id] <= self.retries:
+            print('Retrying', self.units[unit_id]["name"], 'after:', error, file=sys.stderr)
+            self.pending.append(unit_id)
+            self.lock.notify()
+        else:
+            self.done.put((unit_id, None, error))
+
+    def _expire(self):
+        now = time.time()
+        for unit_id, (worker, deadline) in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[unit_id]
+                self._retry(unit_id, 'the lease of ' + worker + ' ran out')
+
+    def stalled(self, timeout):
+        """
+        Takes the pending units off the queue and returns their ids if none is leased and no worker has leased, renewed or
+        finished a unit for timeout seconds, i.e. no worker is left to run them
+        """
+        with self.lock:
+            self._expire()
+            if self.leases or not self.pending or time.time() - self.active < timeout:
+                return []
+            stalled = list(self.pending)
+            self.pending.clear()
+            return stalled
+
+    def lease(self, worker, wait = 5):
+        """
+        Returns (unit id, unit, lease time) with the input file of preparations read in, or None if there was no work within wait seconds
+        """
+        with self.lock:
+            self._expire()
+            if not self.pending:
+                self.lock.wait(wait)
+                self._expire()
+            if not self.pending:
+                return None
+            unit_id = self.pending.popleft()
+            self.active = time.time()
+            self.leases[unit_id] = (worker, self.active + self.lease_time)
+            unit = self.units[unit_id]
+
+        # the input is read only when the unit is sent, so only the units being worked on are held in memory
+        if unit["kind"] == "prepare":
+            with open(unit["input"], "rb") as f:
+                unit = dict(unit, data = f.read())
+        return unit_id, unit, self.lease_time
+
+    def renew(self, unit_id, worker):
+        """
+        Extends the lease of a worker on a unit, returns False if the lease ran out and the unit was given to another worker
+        """
+        with self.lock:
+            if self.leases.get(unit_id, (None,))[0] != worker:
+                return False
+            self.active = time.time()
+            self.leases[unit_id] = (worker, self.active + self.lease_time)
+            return True
+
+    def complete(self, unit_id, result):
+        with self.lock:
+            if self.leases.pop(unit_id, None) is None:
+                # a late answer for a unit that was given to another worker meanwhile
+                return
+            self.active = time.time()
+        self.done.put((unit_id, result, None))
+
+    def fail(self, unit_id, error):
+        with self.lock:
+            if self.leases.pop(unit_id, None) is None:
+                return
+            self.active = time.time()
+            self._retry(unit_id, error)
+
+
+class Coordinator:
+    """
+    Serves the units of a build to workers (see work) until closed
+    ---------------------------------------
+    address = "host:port" to listen on, e.g. "0.0.0.0:50100" (with public = True) to accept workers from other machines \n
+    lease_time = the seconds a worker may go without answering before its unit is given to another worker \n
+    retries = the number of times a failed unit, or a unit whose lease ran out, is given out again \n
+    public = allow listening on an address other than loopback, anyone who can reach it and knows KLUB_AUTHKEY can run code here \n
+    idle_timeout = the seconds to wait for a worker while units are pending and none is leased, before the pending units fail
+    """
+
+    def __init__(self, address = "127.0.0.1", lease_time = 60, retries = 3, public = False, idle_timeout = 300):
+        host, port = parse_address(address)
+        if not public and not is_loopback(host):
+            raise AssertionError(f"The coordinator only listens on {host} with public = True, anyone who can reach it and knows {AUTHKEY_ENV} can run code on this machine")
+        key = authkey()
+        self.work = WorkQueue(lease_time, retries)
+        self.idle_timeout = idle_timeout
+        self.ids = 0
+
+        class Manager(BaseManager):
+            pass
+        Manager.register("work", callable = lambda: self.work)
+        # the manager server can not stop listening, so the connections are accepted here on a socket that can be shut down,
+        # and only handed to the server. The listener the server makes itself is closed right away
+        self.server = Manager(address = ("127.0.0.1", 0), authkey = key).get_server()
+        self.server.listener.close()
+        self.socket = socket.create_server((host, port))
+        self.server.address = self.socket.getsockname()[:2]
+        # set when the coordinator is closed, the server then stops serving the workers after their current request
+        self.server.stop_event = threading.Event()
+        threading.Thread(target = self._accept, daemon = True).start()
+        print('Serving work for workers on', ':'.join(map(str, self.server.address)), file=sys.stderr)
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                # the coordinator was closed
+                return
+            # the server checks the key of the worker and serves its requests
+            threading.Thread(target = self.server.handle_request, args = (Connection(client.detach()),), daemon = True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.server.stop_event.set()
+        # ends the accept and frees the port for the next build
+        self.socket.shutdown(socket.SHUT_RDWR)
+        self.socket.close()
+
+    def run(self, units):
+        """
+        Hands out units (see download_unit and prepare_unit) and writes the file every unit made to its output as soon as it
+        comes back. Yields (unit, error) as the units are finished, error being None if the unit succeeded. The pending units
+        fail if no worker is left to run them for idle_timeout seconds
+        """
+        ids = {}
+        for unit in units:
+            self.ids += 1
+            ids[self.ids] = unit
+            self.work.put(self.ids, unit)
+        for _ in range(len(ids)):
+            while True:
+                try:
+                    unit_id, result, error = self.work.done.get(timeout = 5)
+                    break
+                except queue.Empty:
+                    stalled = self.work.stalled(self.idle_timeout)
+                    if stalled:
+                        print('No worker has taken a unit for', self.idle_timeout, 'seconds, failing the', len(stalled), 'units left. Are the workers running with the same', AUTHKEY_ENV + '?', file=sys.stderr)
+                    for unit_id in stalled:
+                        self.work.done.put((unit_id, None, 'no worker took the unit within ' + str(self.idle_timeout) + ' seconds'))
+            unit = ids[unit_id]
+            if error is None:
+                # written next to the output first, so a file at the output is always complete
+                with open(unit["output"] + ".part", "wb") as f:
+                    f.write(result)
+                os.replace(unit["output"] + ".part", unit["output"])
+            yield unit, error
+
+
+def download_unit(job):
+    """
+    Returns the unit that downloads a job (see dl.download_job) to its outfile, with the downloader of the worker
+    """
+    return {"kind": "download", "name": job["name"], "output": job["outfile"], "job": job}
+
+
+def prepare_unit(what, engine, input, output, args):
+    """
+    Returns the unit that prepares input to output with the prepare_track ("track") or prepare_shoutout ("shoutout") function of an engine
+    ---------------------------------------
+    args = the arguments of the prepare function between the output file and the cache. Workers do not share the loudness cache
+    """
+    return {"kind": "prepare", "name": os.path.basename(output), "output": output, "what": what, "engine": engine, "input": input, "args": tuple(args)}
+
+
+def download_jobs(coordinator, jobs, cache = None):
+    """
+    Downloads jobs (see dl.download_job) on the workers of a coordinator, returns the failures like Downloader.run
+    ---------------------------------------
+    cache = a DownloadCache, the jobs found in it are not sent to the workers and the downloads of the workers are added to it
+    """
+    from Functions.downloader import host_of
+
+    units = []
+    for job in jobs:
+        if cache is not None and cache.fetch(job["link"], job["outfile"], variant = job["variant"]):
+            print('Found', job["name"], 'in the download cache')
+            continue
+        units.append(download_unit(job))
+
+    failures = []
+    for unit, error in coordinator.run(units):
+        job = unit["job"]
+        if error is None:
+            print('Downloaded', job["name"])
+            if cache is not None:
+                cache.put(job["link"], job["outfile"], variant = job["variant"])
+            continue
+        failures.append({"row": job["row"], "name": job["name"], "link": job["link"], "host": host_of(job["link"]), "outfile": job["outfile"],
+                         "attempts": coordinator.work.retries + 1, "returncode": 1, "error": error})
+    return failures
+
+
+def prepare_units(coordinator, units):
+    """
+    Prepares units (see prepare_unit) on the workers of a coordinator, returns the names of the units that failed
+    """
+    failed = []
+    for unit, error in coordinator.run(units):
+        if error is None:
+            print('Prepared', unit["name"])
+        else:
+            print('Could not prepare', unit["name"] + ':', error, file=sys.stderr)
+            failed.append(unit["name"])
+    return failed
+
+
+def execute(unit, downloader = "youtube-dl"):
+    """
+    Runs a unit in a temporary folder and returns the content of the file it made
+    ---------------------------------------
+    downloader = the youtube-dl executable of the worker, the coordinator can not choose what a worker runs
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        outfile = os.path.join(tmp, "output.wav")
+        if unit["kind"] == "download":
+            from Functions.downloader import Downloader
+
+            # retries are left to the coordinator, which may give the unit to another worker
+            failures = Downloader(retries = 0, downloader = downloader).run([dict(unit["job"], outfile = outfile)])
+            if failures:
+                raise RuntimeError(failures[0]["error"])
+        else:
+            if unit["what"] == "track":
+                from Functions.prepare_track import prepare_function
+            else:
+                from Functions.prepare_shoutout import prepare_function
+
+            infile = os.path.join(tmp, "input.wav")
+            with open(infile, "wb") as f:
+                f.write(unit["data"])
+            prepare_function(unit["engine"])(infile, outfile, *unit["args"], None)
+            if not os.path.exists(outfile) or os.path.getsize(outfile) == 0:
+                raise RuntimeError('Could not prepare ' + unit["name"])
+
+        with open(outfile, "rb") as f:
+            return f.read()
+
+
+def heartbeat(work_queue, unit_id, name, done, interval):
+    # renews the lease on a unit until it is done, so only workers that stopped answering lose their units
+    while not done.wait(interval):
+        try:
+            if not work_queue.renew(unit_id, name):
+                return
+        except (ConnectionError, EOFError):
+            return
+
+
+def work(address, name = None, downloader = "youtube-dl"):
+    """
+    Leases units from the coordinator at address ("host:port"), runs them and sends the results back, forever. Waits for the
+    coordinator if it is not running (yet), so workers can be left running between builds
+    ---------------------------------------
+    downloader = the youtube-dl executable to download with, e.g. a stand-in for offline tests
+    """
+    from Functions.toolchain import require
+
+    name = name or socket.gethostname() + ":" + str(os.getpid())
+    key = authkey()
+    require("ffmpeg")
+
+    class Manager(BaseManager):
+        pass
+    Manager.register("work")
+
+    while True:
+        try:
+            manager = Manager(address = parse_address(address), authkey = key)
+            manager.connect()
+            work_queue = manager.work()
+            while True:
+                leased = work_queue.lease(name)
+                if leased is None:
+                    continue
+                unit_id, unit, lease_time = leased
+                working = threading.Event()
+                threading.Thread(target = heartbeat, args = (work_queue, unit_id, name, working, lease_time / 3), daemon = True).start()
+                try:
+                    result = execute(unit, downloader)
+                except Exception as e:
+                    work_queue.fail(unit_id, repr(e))
+                else:
+                    work_queue.complete(unit_id, result)
+                finally:
+                    working.set()
+        except (ConnectionError, EOFError):
+            time.sleep(5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs downloads and preparations for the builds of a coordinator")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    worker = commands.add_parser("worker", help = "lease and run units from a coordinator")
+    worker.add_argument("address", help = "host:port of the coordinator (see make_club's coordinator argument)")
+    worker.add_argument("--processes", type = int, default = os.cpu_count(), help = "the number of units to run at the same time")
+    worker.add_argument("--downloader", default = "youtube-dl", help = "the youtube-dl executable to download with")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        work(args.address, downloader = args.downloader)
+    processes = [Process(target = work, args = (args.address, None, args.downloader)) for _ in range(args.processes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
@@ -1,30 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import multiprocessing
 import shutil
 import os
 
 import subprocess
 
-# if __name__ == "__main":
-err = subprocess.Popen(['pip', 'install', 'youtube-dl'],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE).communicate()[1]
-
-if len(err) != 0:
-    print(err)
-    exit(1)
+def download_command(link, outfile, downloader = "youtube-dl"):
+    """
+    Returns the command that downloads a link to a wav file
+    """
+    return [downloader, '--extract-audio', '--audio-format', 'wav', '-o', outfile, link]
 
 def download(name, link, outfile):
     import subprocess
     
     print('Downloading', name, 'from', link + '...')
-    process = subprocess.Popen(['youtube-dl',
-                                '--extract-audio',
-                                '--audio-format', 'wav',
-                                '-o', outfile, link],
+    process = subprocess.Popen(download_command(link, outfile),
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
     
@@ -35,38 +27,154 @@ def download(name, link, outfile):
         print('Error downloading', name, 'from', link, file=sys.stderr)
         print(err.decode('utf-8'), file=sys.stderr)
 
-def download_all(dl_path = "tracks", csv_name = "Songs.csv"):#, sound_type = "tracks"):
+MEDIA_EXTENSIONS = ('.wav', '.mp3', '.flac', '.m4a', '.aac', '.ogg', '.opus', '.webm', '.mp4')
+
+def is_direct(link):
+    """
+    Returns whether a link points directly to a media file that ffmpeg can read
+    """
+    from urllib.parse import urlsplit
+    
+    return urlsplit(link).path.lower().endswith(MEDIA_EXTENSIONS)
+
+def resolve_command(link, downloader = "youtube-dl"):
+    """
+    Returns the command that prints the direct media url of a link
+    """
+    return [downloader, '--get-url', '-f', 'bestaudio/best', link]
+
+def resolve_url(link, downloader = "youtube-dl"):
+    """
+    Returns a direct media url for a link, so it can be read by ffmpeg without downloading the whole file.
+    Links that already point directly to a media file are returned as they are
+    """
+    import subprocess
+    
+    if is_direct(link):
+        return link
+    
+    process = subprocess.Popen(resolve_command(link, downloader),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    
+    if process.returncode != 0 or not out.strip():
+        raise RuntimeError('Could not resolve ' + link + ': ' + err.decode('utf-8'))
+    
+    return out.decode('utf-8').splitlines()[0]
+
+def window_bounds(ss, length, margin):
+    """
+    Returns the start and duration of the window to fetch for a clip starting at ss with the given length
+    """
+    start = max(float(ss) - margin, 0)
+    return start, float(ss) - start + float(length) + margin
+
+def window_command(url, outfile, start, duration):
+    """
+    Returns the ffmpeg command that fetches [start, start + duration] of a direct media url to a wav file
+    """
+    # -ss before -i seeks in the source (using range requests over http) instead of decoding up to ss
+    return ['ffmpeg', '-loglevel', 'error',
+            '-ss', str(start), '-i', url,
+            '-t', str(duration), '-vn',
+            '-f', 'wav', '-y', outfile]
+
+def windows_command(url, windows):
+    """
+    Returns the ffmpeg command that fetches several windows of a direct media url in one pass: the source is read and decoded
+    once, from the first start to the last end, and split into a wav file per window
+    ------------------------------------
+    windows = list of (outfile, start, duration)
+    """
+    first = min(start for _, start, _ in windows)
+    last = max(start + duration for _, start, duration in windows)
+    # one decode is split to every window and trimmed to it (sample accurate), each window is written to its own file
+    graph = '[0:a]asplit=%d%s;' % (len(windows), ''.join('[s%d]' % i for i in range(len(windows))))
+    graph += ';'.join('[s%d]atrim=start=%s:duration=%s,asetpts=PTS-STARTPTS[w%d]' % (i, start - first, duration, i)
+                      for i, (_, start, duration) in enumerate(windows))
+
+    cmd = ['ffmpeg', '-loglevel', 'error',
+           '-ss', str(first), '-t', str(last - first), '-i', url,
+           '-filter_complex', graph]
+    for i, (outfile, _, _) in enumerate(windows):
+        cmd += ['-map', '[w%d]' % i, '-f', 'wav', '-y', outfile]
+    return cmd
+
+def download_job(i, row, outfile, window_margin = None, length = None):
+    """
+    Returns the download of the i'th csv row as a job for the Downloader (see Functions/downloader.py)
+    ------------------------------------
+    i = the (1-indexed) row number \n
+    row = the csv row, with the name in the first column, the link in the second and (for windows) the start time and length in the third and fourth \n
+    outfile = the file to download to \n
+    window_margin = see download_all \n
+    length = see download_all
+    """
+    job = {"row": i, "name": row[0], "link": row[1], "outfile": outfile, "window": None, "variant": ""}
+    if window_margin is not None:
+        clip_length = float(row[3]) if length is None else length
+        job["window"] = window_bounds(row[2], clip_length, window_margin)
+        job["variant"] = 'window=%g+%g' % job["window"]
+    return job
+
+def download_all(dl_path = "tracks", csv_name = "Songs.csv", cache = None, window_margin = None, length = None, rows = None, keys = None, parallel = 8, retries = 3, downloader = "youtube-dl", coordinator = None, limits = None):#, sound_type = "tracks"):
     """
-    Downloades all links from the csv
+    Downloades all links from the csv, returns the downloads that failed (see Functions/downloader.py)
     ------------------------------------
-    csv_name = the csv to download from, the first column must be the name of the track and the second must be a link \n
+    csv_name = the csv to download from, the first column must be the name of the track and the second must be a link, or a plan Table (see Functions/plan.py) \n
     dl_path = the path in which to place the downloaded tracks \n
-    sound_type = whick type of sound, a folder with this name will be created with the downloads if no dl_path is specified
+    sound_type = whick type of sound, a folder with this name will be created with the downloads if no dl_path is specified \n
+    cache = a DownloadCache (see Functions/cache.py), links found in it are linked/copied instead of downloaded and new downloads are added to it \n
+    window_margin = if given, only [start - window_margin, start + length + window_margin] is downloaded, using the start time in the third column. The downloaded file then starts at max(start - window_margin, 0) \n
+    length = the length of each clip when downloading windows, if None it is read from the fourth column \n
+    rows = if given, only these (1-indexed) rows are downloaded and the other files in dl_path are kept. "failed" downloads only the rows that failed last time \n
+    keys = the file name (without .wav) to download each row to, e.g. a content key (see Functions/manifest.py). By default the row number is used \n
+    parallel = the number of downloads to run at the same time \n
+    retries = the number of times a failed download is retried \n
+    downloader = the youtube-dl executable, e.g. a stand-in for offline tests \n
+    coordinator = a Coordinator (see Functions/distributed.py) to download on its workers instead of here, its retries are used instead of retries and the workers use their own downloader \n
+    limits = HostLimits (see Functions/downloader.py) shared with other builds, used instead of parallel
     """
+    from Functions.downloader import Downloader, FAILURES_FILE, failed_rows, print_failures, save_failures
+    from Functions.manifest import csv_rows
+    from Functions.toolchain import require
+    
     # tracks_path = os.path.join(os.path.curdir, sound_type) if dl_path is None else dl_path
     tracks_path = dl_path
-    name_index = 0
-    link_index = 1
     
-    if os.path.exists(tracks_path):
+    if rows == "failed":
+        rows = failed_rows(tracks_path)
+    
+    if rows is None and os.path.exists(tracks_path):
         shutil.rmtree(tracks_path)
     
-    os.mkdir(tracks_path)
+    os.makedirs(tracks_path, exist_ok = True)
     
-    with multiprocessing.Pool() as p:
-        with open(csv_name, 'rt') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            
-            for i, row in enumerate(reader, 1):
-                name = row[name_index]
-                link = row[link_index]
-                
-                outfile = os.path.join(tracks_path, str(i) + '.wav')
-                p.apply_async(download, (name, link, outfile))
+    jobs = []
+    for i, row in enumerate(csv_rows(csv_name), 1):
+        if rows is not None and i not in rows:
+            continue
         
-        p.close()
-        p.join()
-
+        outfile = os.path.join(tracks_path, (str(i) if keys is None else keys[i-1]) + '.wav')
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        jobs.append(download_job(i, row, outfile, window_margin, length))
+    
+    if coordinator is None:
+        require(downloader)
+        failures = Downloader(parallel = parallel, retries = retries, downloader = downloader, cache = cache, limits = limits).run(jobs)
+    else:
+        from Functions.distributed import download_jobs
+        from Functions.downloader import shared_failures
+        # the workers download every file once, however many rows use it
+        unique = {}
+        for job in jobs:
+            unique.setdefault(job["outfile"], job)
+        failures = shared_failures(download_jobs(coordinator, list(unique.values()), cache = cache), jobs)
+    print_failures(failures, len(jobs))
+    save_failures(os.path.join(tracks_path, FAILURES_FILE), failures)
+    return failures
 
 if __name__ == "__main__":
     download("test", "https://www.youtube.com/watch?v=E0Hk3LHbA7Y", "test.wav")
\ No newline at end of file
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from Functions.trace import note, span
+
+FAILURES_FILE = "failed.json"
+# windows of the same source that are less than this many seconds apart are fetched in one pass (see group_jobs)
+MERGE_GAP = 30
+
+
+def host_of(link):
+    """
+    Returns the host a link is downloaded from, the rate limits are per host
+    """
+    return urlsplit(str(link)).netloc.lower() or "local"
+
+
+def group_jobs(jobs, gap = MERGE_GAP):
+    """
+    Groups the jobs (see dl.download_job) by their source, so every source is fetched once: the full downloads of a link
+    become one group, and the windows of a link that overlap or are less than gap seconds apart become one group that is
+    fetched in a single pass. Jobs writing to the same file must be left out first (see Downloader.run)
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job["link"], job["window"] is None), []).append(job)
+
+    passes = []
+    for (_, full), group in groups.items():
+        if full:
+            passes.append(group)
+            continue
+        group = sorted(group, key = lambda job: job["window"][0])
+        end = None
+        for job in group:
+            start, duration = job["window"]
+            if end is None or start > end + gap:
+                passes.append([])
+                end = start + duration
+            passes[-1].append(job)
+            end = max(end, start + duration)
+    return passes
+
+
+def shared_failures(failures, jobs):
+    """
+    Returns the failures of every job whose file failed to download, for jobs that share a file with the job that failed
+    """
+    failed = {f["outfile"]: f for f in failures}
+    return [dict(failed[job["outfile"]], row = job["row"], name = job["name"]) for job in jobs if job["outfile"] in failed]
+
+
+async def run(cmd):
+    """
+    Runs a command without blocking the event loop, returns its return code, stdout and stderr
+    """
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    out, err = await process.communicate()
+    return process.returncode, out, err.decode('utf-8', 'replace')
+
+
+class HostLimits:
+    """
+    Download slots and per host limits that several Downloaders can share, each running in its own event loop and thread,
+    e.g. the builds running at the same time in the build service (see Functions/service.py)
+    ---------------------------------------
+    parallel, per_host, host_interval = see Downloader
+    """
+
+    def __init__(self, parallel = 8, per_host = 2, host_interval = 0.5):
+        self.parallel = parallel
+        self.per_host = per_host
+        self.host_interval = host_interval
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(parallel)
+        self.hosts = {}
+        self.next_start = {}
+
+    @asynccontextmanager
+    async def slot(self, host):
+        with self.lock:
+            host_slots = self.hosts.setdefault(host, threading.Semaphore(self.per_host))
+        # polled, as waiting on the semaphores would block the event loop of the downloader
+        while not self.slots.acquire(blocking = False):
+            await asyncio.sleep(0.05)
+        try:
+            while not host_slots.acquire(blocking = False):
+                await asyncio.sleep(0.05)
+            try:
+                with self.lock:
+                    now = time.monotonic()
+                    start = max(now, self.next_start.get(host, 0))
+                    self.next_start[host] = start + self.host_interval
+                await asyncio.sleep(start - now)
+                yield
+            finally:
+                host_slots.release()
+        finally:
+            self.slots.release()
+
+
+class Downloader:
+    """
+    Downloads with bounded concurrency, per host rate limits and retries, collecting the downloads that failed
+    ---------------------------------------
+    parallel = the number of downloads to run at the same time \n
+    per_host = the number of downloads from the same host to run at the same time \n
+    host_interval = the minimum number of seconds between starting two downloads from the same host \n
+    retries = the number of times a failed download is retried \n
+    backoff = the seconds to wait before the first retry, doubled for every following retry \n
+    downloader = the youtube-dl executable, can be replaced by a stand-in (e.g. for offline tests) taking the same arguments \n
+    cache = a DownloadCache (see Functions/cache.py) to fetch downloads from and add new downloads to, or None \n
+    limits = HostLimits shared with other Downloaders, used instead of parallel, per_host and host_interval
+    """
+
+    def __init__(self, parallel = 8, per_host = 2, host_interval = 0.5, retries = 3, backoff = 1, downloader = "youtube-dl", cache = None, limits = None):
+        self.parallel = parallel
+        self.per_host = per_host
+        self.host_interval = host_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.downloader = downloader
+        self.cache = cache
+        self.limits = limits
+        self._slots = None
+        self._hosts = {}
+        self._next_start = {}
+        # the media urls of the links resolved so far, so the windows of a link resolve it once
+        self._urls = {}
+
+    @asynccontextmanager
+    async def _slot(self, host):
+        if self.limits is not None:
+            async with self.limits.slot(host):
+                yield
+            return
+        # created on first use so they belong to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.parallel)
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.per_host)
+
+        async with self._slots, self._hosts[host]:
+            loop = asyncio.get_running_loop()
+            start = max(loop.time(), self._next_start.get(host, 0))
+            self._next_start[host] = start + self.host_interval
+            await asyncio.sleep(start - loop.time())
+            yield
+
+    async def _resolve(self, link):
+        # returns the direct media url of a link (or None) and the error of resolving it
+        from Functions.dl import is_direct, resolve_command
+
+        if is_direct(link):
+            return link, ""
+        if link not in self._urls:
+            code, out, err = await run(resolve_command(link, self.downloader))
+            if code != 0 or not out.strip():
+                return None, err
+            self._urls[link] = out.decode('utf-8').splitlines()[0]
+        return self._urls[link], ""
+
+    async def _attempt(self, job):
+        from Functions.dl import download_command, window_command
+
+        outfile = job["outfile"]
+        if job["window"] is None:
+            code, _, err = await run(download_command(job["link"], outfile, self.downloader))
+        else:
+            url, err = await self._resolve(job["link"])
+            if url is None:
+                return 1, err
+            code, _, err = await run(window_command(url, outfile, *job["window"]))
+
+        if code == 0 and not os.path.exists(outfile):
+            return 1, err + "\nNo file was written to " + outfile
+        return code, err
+
+    async def _attempt_windows(self, jobs):
+        from Functions.dl import windows_command
+
+        url, err = await self._resolve(jobs[0]["link"])
+        if url is None:
+            return 1, err
+        code, _, err = await run(windows_command(url, [(job["outfile"], *job["window"]) for job in jobs]))
+
+        missing = [job["outfile"] for job in jobs if not os.path.exists(job["outfile"])]
+        if code == 0 and missing:
+            return 1, err + "\nNo file was written to " + missing[0]
+        return code, err
+
+    async def fetch(self, job):
+        """
+        Downloads a job (see dl.download_job), returns None if it succeeded and a dict describing the failure otherwise
+        """
+        with span("download", "download", item = job["name"], link = job["link"]):
+            failure = await self._fetch(job)
+            note(status = "failed" if failure else "ok", bytes_written = os.path.getsize(job["outfile"]) if failure is None else 0)
+        return failure
+
+    async def _fetch(self, job):
+        if self.cache is None:
+            return await self._download(job)
+
+        # another build running in this process may be downloading the same link, wait for it and take it from the cache
+        claim = self.cache.claim(job["link"], variant = job["variant"])
+        while not claim.acquire(blocking = False):
+            await asyncio.sleep(0.1)
+        try:
+            return await self._download(job)
+        finally:
+            claim.release()
+
+    async def _download(self, job):
+        # the cache may hash a whole file (see DownloadCache.get), which is done in a thread to keep the other downloads going
+        if self.cache is not None and await asyncio.to_thread(self.cache.fetch, job["link"], job["outfile"], variant = job["variant"]):
+            print('Found', job["name"], 'in the download cache')
+            return None
+
+        host = host_of(job["link"])
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # exponential backoff with jitter, so retries of the same host do not line up
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+            async with self._slot(host):
+                print('Downloading', job["name"], 'from', job["link"] + '...')
+                code, err = await self._attempt(job)
+            note(attempts = attempt + 1, returncode = code)
+            if code == 0:
+                if self.cache is not None:
+                    await asyncio.to_thread(self.cache.put, job["link"], job["outfile"], variant = job["variant"])
+                return None
+            if os.path.exists(job["outfile"]):
+                os.remove(job["outfile"])
+
+        error = err.strip().splitlines()
+        return {"row": job["row"], "name": job["name"], "link": job["link"], "host": host, "outfile": job["outfile"],
+                "attempts": self.retries + 1, "returncode": code, "error": error[-1] if error else ""}
+
+    async def fetch_group(self, jobs):
+        """
+        Downloads a group of jobs of the same source (see group_jobs) at once, returns the failures of its jobs (see fetch)
+        """
+        from Functions.cache import link_or_copy
+
+        if jobs[0]["window"] is None:
+            # the link is downloaded once and the file is shared by the other jobs
+            failure = await self.fetch(jobs[0])
+            if failure is not None:
+                return [dict(failure, row = job["row"], name = job["name"], outfile = job["outfile"]) for job in jobs]
+            for job in jobs[1:]:
+                link_or_copy(jobs[0]["outfile"], job["outfile"])
+            return []
+
+        if self.cache is not None:
+            cached = await asyncio.gather(*[asyncio.to_thread(self.cache.fetch, job["link"], job["outfile"], variant = job["variant"]) for job in jobs])
+            for job in [job for job, found in zip(jobs, cached) if found]:
+                print('Found', job["name"], 'in the download cache')
+            jobs = [job for job, found in zip(jobs, cached) if not found]
+        if len(jobs) <= 1:
+            return [f for f in [await self.fetch(job) for job in jobs] if f is not None]
+
+        names = ', '.join(job["name"] for job in jobs)
+        with span("download", "download", item = names, link = jobs[0]["link"]):
+            failures = await self._download_windows(jobs)
+            note(status = "failed" if failures else "ok", windows = len(jobs),
+                 bytes_written = sum(os.path.getsize(job["outfile"]) for job in jobs if os.path.exists(job["outfile"])))
+        return failures
+
+    async def _download_windows(self, jobs):
+        host = host_of(jobs[0]["link"])
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+            async with self._slot(host):
+                print('Downloading', len(jobs), 'windows of', jobs[0]["link"], '(' + ', '.join(job["name"] for job in jobs) + ')...')
+                code, err = await self._attempt_windows(jobs)
+            note(attempts = attempt + 1, returncode = code)
+            if code == 0:
+                if self.cache is not None:
+                    for job in jobs:
+                        await asyncio.to_thread(self.cache.put, job["link"], job["outfile"], variant = job["variant"])
+                return []
+            for job in jobs:
+                if os.path.exists(job["outfile"]):
+                    os.remove(job["outfile"])
+
+        error = err.strip().splitlines()
+        return [{"row": job["row"], "name": job["name"], "link": job["link"], "host": host, "outfile": job["outfile"],
+                 "attempts": self.retries + 1, "returncode": code, "error": error[-1] if error else ""} for job in jobs]
+
+    async def _fetch_all(self, jobs):
+        # a file is downloaded once, however many rows use it
+        unique = {}
+        for job in jobs:
+            unique.setdefault(job["outfile"], job)
+        failures = await asyncio.gather(*[self.fetch_group(group) for group in group_jobs(list(unique.values()))])
+        return shared_failures([f for group in failures for f in group], jobs)
+
+    def run(self, jobs):
+        """
+        Downloads all jobs and returns the failures (see fetch). Every source is fetched once: rows downloading the same file
+        share it, and the windows of the same link are fetched together (see group_jobs)
+        """
+        return asyncio.run(self._fetch_all(jobs))
+
+
+def print_failures(failures, n, hint = "run again with incremental = True to retry only these"):
+    """
+    Prints a summary of the failed downloads out of n, followed by hint
+    """
+    if not failures:
+        return
+    print(len(failures), 'of', n, 'downloads failed,', hint + ':', file=sys.stderr)
+    for f in sorted(failures, key = lambda f: f["row"]):
+        print('  row', f["row"], '-', f["name"], '(' + f["host"] + ', ' + str(f["attempts"]) + ' attempts):', f["error"], file=sys.stderr)
+
+
+def save_failures(path, failures):
+    """
+    Saves the failures as json, so only those rows can be retried (see failed_rows)
+    """
+    with open(path, "wt") as f:
+        json.dump(sorted(failures, key = lambda f: f["row"]), f, indent = 1)
+
+
+def failed_rows(folder):
+    """
+    Returns the (1-indexed) rows that failed in the last download to folder
+    """
+    path = os.path.join(folder, FAILURES_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, "rt") as f:
+        return [failure["row"] for failure in json.load(f)]
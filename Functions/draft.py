@@ -0,0 +1,62 @@
+from Functions.dsp import decode, fade, integrated_loudness, write_wav
+from Functions.trace import traced
+
+# drafts are only listened to for the order, the shoutouts and the start times, so they are made and encoded at a low quality
+SAMPLE_RATE = 16000
+CHANNELS = 1
+BITRATE = "32k"
+
+FFMPEG_INPUT_ARGS = ['-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS)]
+
+
+def outputs(output_name):
+    """
+    Returns the file and the ffmpeg encoder arguments of the draft of a club (see combine.outputs)
+    """
+    return [(output_name + "_draft.mp3", ['-b:a', BITRATE])]
+
+
+def approximate_gain(x, t):
+    """
+    Returns x with the gain that brings it to about t LUFS, measured on x itself in the same pass. The draft is mono and
+    at a low sample rate and there is no true peak limiting, so the levels are only roughly those of the real club
+    """
+    import numpy as np
+
+    loudness = integrated_loudness(x, SAMPLE_RATE)
+    if not np.isfinite(loudness):
+        return x
+    return x * np.float32(10 ** ((t - loudness) / 20))
+
+
+@traced("prepare")
+def prepare_track(input, output, ss=0, t=-14, f=3, length = 60, cache = None, excerpt = None):
+    """
+    Makes the draft of a track (same arguments as prepare_track.prepare_track, the loudness cache is not used)
+    ---------------------------------------------
+    excerpt = if given, only this many seconds (at least the fade) at the start and at the end of the track are used, where it is cut and faded
+    """
+    import numpy as np
+
+    print('Drafting', input + '...')
+    if excerpt is not None:
+        excerpt = max(excerpt, f)
+    if excerpt is None or 2 * excerpt >= float(length):
+        x = decode(input, ss = ss, length = length, sr = SAMPLE_RATE, channels = CHANNELS)
+    else:
+        # only the two windows are read, ffmpeg seeks to each of them
+        x = np.concatenate((decode(input, ss = ss, length = excerpt, sr = SAMPLE_RATE, channels = CHANNELS),
+                            decode(input, ss = float(ss) + float(length) - excerpt, length = excerpt, sr = SAMPLE_RATE, channels = CHANNELS)))
+    return write_wav(output, fade(approximate_gain(x, t), SAMPLE_RATE, fade_in = f, fade_out = f), SAMPLE_RATE)
+
+
+@traced("prepare")
+def prepare_shoutout(input, output, t=-14, trim = False, ss = 0, length = 5, cache = None):
+    """
+    Makes the draft of a shoutout (same arguments as prepare_shoutout.prepare_shoutout, the loudness cache is not used)
+    """
+    print('Drafting', input + '...')
+    if not trim:
+        ss, length = None, None
+    x = decode(input, ss = ss, length = length, sr = SAMPLE_RATE, channels = CHANNELS)
+    return write_wav(output, approximate_gain(x, t), SAMPLE_RATE)
@@ -0,0 +1,320 @@
+import subprocess
+import wave
+
+from Functions.pcm import SAMPLE_RATE, CHANNELS
+from Functions.trace import note, traced
+
+
+def decode(input, ss = None, length = None, sr = SAMPLE_RATE, channels = CHANNELS):
+    """
+    Decodes (and trims) an audio file with ffmpeg into a float32 array of shape (samples, channels)
+    ---------------------------------------------
+    input = the file to decode \n
+    ss = the position to start the trim at, None to not trim \n
+    length = the length to trim to, None to not trim \n
+    sr = the sample rate to decode at \n
+    channels = the number of channels to decode to
+    """
+    import numpy as np
+
+    trim = []
+    if ss is not None:
+        trim += ['-ss', str(ss)]
+    if length is not None:
+        trim += ['-t', str(length)]
+
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error',
+                                *trim, '-i', input,
+                                '-map', '0:a:0', '-ac', str(channels), '-ar', str(sr),
+                                '-f', 'f32le', '-'],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    note(bytes_piped = len(out), status = process.returncode)
+
+    if process.returncode != 0:
+        raise RuntimeError('Could not decode ' + input + ': ' + err.decode('utf-8', 'replace'))
+
+    return np.frombuffer(out, dtype = np.float32).reshape(-1, channels)
+
+
+def write_wav(output, x, sr = SAMPLE_RATE):
+    """
+    Writes a float array of shape (samples, channels) as 16 bit wav. If output is '-' the raw pcm is returned as bytes instead
+    """
+    import numpy as np
+
+    pcm = (np.clip(x, -1, 1) * 32767).round().astype('<i2')
+    if output == '-':
+        return pcm.tobytes()
+
+    with wave.open(output, 'wb') as w:
+        w.setnchannels(x.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes(pcm.tobytes())
+
+    return b''
+
+
+def _fast_length(n):
+    # the smallest 2^a * 3^b * 5^c >= n, fft sizes that pocketfft handles quickly
+    import numpy as np
+
+    best = 1 << int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35 << max(int(np.ceil(np.log2(n / p35))), 0)
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _fftfilter(x, pad, response):
+    # filters each channel by multiplying its spectrum, zero padded by pad samples so the filter does not wrap around
+    import numpy as np
+
+    n = _fast_length(len(x) + pad)
+    X = np.fft.rfft(x, n = n, axis = 0)
+    X *= response(np.exp(-2j * np.pi * np.arange(n // 2 + 1) / n))[:, None]
+    return np.fft.irfft(X, n = n, axis = 0)[:len(x)]
+
+
+def _biquad_response(b, a, z):
+    return (b[0] + b[1] * z + b[2] * z**2) / (a[0] + a[1] * z + a[2] * z**2)
+
+
+def k_weighting_coefficients(sr):
+    """
+    Returns the (b, a) coefficients of the two ITU-R BS.1770 K-weighting biquads for the sample rate
+    """
+    import numpy as np
+
+    # high shelf (head effects)
+    f0, G, Q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    K = np.tan(np.pi * f0 / sr)
+    Vh = 10 ** (G / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf = ([(Vh + Vb * K / Q + K * K) / a0, 2 * (K * K - Vh) / a0, (Vh - Vb * K / Q + K * K) / a0],
+             [1, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0])
+
+    # high pass (RLB)
+    f0, Q = 38.13547087602444, 0.5003270373238773
+    K = np.tan(np.pi * f0 / sr)
+    a0 = 1 + K / Q + K * K
+    highpass = ([1, -2, 1], [1, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0])
+
+    return shelf, highpass
+
+
+def k_weight(x, sr = SAMPLE_RATE):
+    """
+    Applies the K-weighting filter to a (samples, channels) array
+    """
+    shelf, highpass = k_weighting_coefficients(sr)
+    return _fftfilter(x, sr, lambda z: _biquad_response(*shelf, z) * _biquad_response(*highpass, z))
+
+
+def _gated_loudness(y, sr):
+    # EBU R128 gating of a K-weighted signal
+    import numpy as np
+
+    block = int(0.4 * sr)
+    step = int(0.1 * sr)
+    if len(y) < block:
+        return -np.inf
+
+    # mean square of every 400 ms block with 75 % overlap, from a cumulative sum of the squared signal
+    energy = np.concatenate((np.zeros((1, y.shape[1])), np.cumsum(y * y, axis = 0)))
+    starts = np.arange(0, len(y) - block + 1, step)
+    z = ((energy[starts + block] - energy[starts]) / block).sum(axis = 1)
+
+    with np.errstate(divide = 'ignore'):
+        loudness = -0.691 + 10 * np.log10(z)
+
+    # absolute gate at -70 LUFS and relative gate 10 LU below the absolute-gated loudness
+    gated = z[loudness > -70]
+    if len(gated) == 0:
+        return -np.inf
+    relative = -0.691 + 10 * np.log10(gated.mean()) - 10
+    gated = z[(loudness > -70) & (loudness > relative)]
+
+    return -0.691 + 10 * np.log10(gated.mean())
+
+
+def integrated_loudness(x, sr = SAMPLE_RATE):
+    """
+    Returns the EBU R128 integrated loudness of a (samples, channels) array in LUFS (-inf for silence)
+    """
+    return _gated_loudness(k_weight(x, sr), sr)
+
+
+def true_peak_envelope(x, oversample = 4, taps = 48):
+    """
+    Returns the per sample true peak (maximum over channels of the oversampled signal) of a (samples, channels) array
+    """
+    import numpy as np
+
+    # windowed sinc fractional delay filters for the intermediate phases of the oversampled signal
+    k = np.arange(-taps // 2 + 1, taps // 2 + 1)
+    window = np.hanning(taps + 2)[1:-1]
+
+    env = np.abs(x).max(axis = 1)
+    for p in range(1, oversample):
+        h = (np.sinc(k - p / oversample) * window).astype(x.dtype)
+        for c in range(x.shape[1]):
+            env = np.maximum(env, np.abs(np.convolve(x[:, c], h, 'same')))
+    return env
+
+
+def true_peak(x):
+    """
+    Returns the true peak of a (samples, channels) array in dBTP
+    """
+    import numpy as np
+
+    with np.errstate(divide = 'ignore'):
+        return 20 * np.log10(true_peak_envelope(x).max()) if len(x) else -np.inf
+
+
+def analyse(x, sr = SAMPLE_RATE):
+    """
+    Returns the integrated loudness in LUFS and the true peak envelope (see true_peak_envelope) of a (samples, channels) array
+    """
+    import numpy as np
+
+    if len(x) == 0:
+        return -np.inf, np.zeros(0, dtype = x.dtype)
+    return integrated_loudness(x, sr), true_peak_envelope(x)
+
+
+def limit(x, env, sr = SAMPLE_RATE, tp = -1, lookahead = 0.005, release = 0.05):
+    """
+    True peak limiter, returns x with a smooth gain applied so that its true peak stays below tp dBTP
+    ---------------------------------------------
+    x = (samples, channels) array \n
+    env = the true peak envelope of x (see analyse) \n
+    sr = the sample rate \n
+    tp = the ceiling in dBTP \n
+    lookahead = the block length (and lookahead) of the limiter in seconds \n
+    release = the time in seconds it takes the gain to recover by 6 dB
+    """
+    import numpy as np
+
+    ceiling = 10 ** (tp / 20)
+    if len(x) == 0 or env.max() <= ceiling:
+        return x
+
+    # the gain needed in every block, taking the neighbouring blocks into account as lookahead
+    block = max(int(lookahead * sr), 1)
+    n_blocks = -(-len(x) // block)
+    padded = np.pad(env, (0, n_blocks * block - len(env)))
+    needed = np.minimum(1, ceiling / np.maximum(padded.reshape(n_blocks, block).max(axis = 1), 1e-12))
+    needed = np.minimum(needed, np.minimum(np.r_[needed[1:], 1], np.r_[1, needed[:-1]]))
+
+    # the gain drops instantly but recovers gradually, this recursion runs once per block
+    step = 2 ** (block / (release * sr))
+    gain = np.empty(n_blocks)
+    g = 1.0
+    for i, target in enumerate(needed):
+        g = min(target, g * step)
+        gain[i] = g
+
+    centers = np.arange(n_blocks) * block + block / 2
+    return (x * np.interp(np.arange(len(x)), centers, gain)[:, None]).astype(np.float32)
+
+
+def fade(x, sr = SAMPLE_RATE, fade_in = 0, fade_out = 0):
+    """
+    Applies linear fade in and fade out (in seconds) to a (samples, channels) array
+    """
+    import numpy as np
+
+    x = x.copy()
+    n_in = min(int(fade_in * sr), len(x))
+    n_out = min(int(fade_out * sr), len(x))
+    if n_in:
+        x[:n_in] *= np.linspace(0, 1, n_in, dtype = np.float32)[:, None]
+    if n_out:
+        x[len(x) - n_out:] *= np.linspace(1, 0, n_out, dtype = np.float32)[:, None]
+    return x
+
+
+def measure(x, sr = SAMPLE_RATE, key = None, cache = None):
+    """
+    Returns the integrated loudness, the true peak (linear) and the true peak envelope of x. If the measurement is in the
+    loudness cache (see Functions/cache.py) under key it is not measured again, and the envelope is None
+    """
+    measured = None if cache is None else cache.get(key)
+    if measured is not None:
+        return measured['loudness'], measured['peak'], None
+
+    loudness, env = analyse(x, sr)
+    peak = float(env.max()) if len(env) else 0.0
+    if cache is not None:
+        cache.put(key, {'loudness': float(loudness), 'peak': peak})
+    return loudness, peak, env
+
+
+def normalize(x, t, sr = SAMPLE_RATE, tp = -1, measured = None):
+    """
+    Applies the gain that brings x to t LUFS, followed by true peak limiting at tp dBTP
+    ---------------------------------------------
+    measured = the (loudness, peak, envelope) of x from measure, measured here if None. The envelope is only needed when the gain makes x peak above tp
+    """
+    import numpy as np
+
+    loudness, peak, env = measure(x, sr) if measured is None else measured
+    if not np.isfinite(loudness):
+        return x
+    gain = 10 ** ((t - loudness) / 20)
+    if peak * gain <= 10 ** (tp / 20):
+        return x * np.float32(gain)
+    if env is None:
+        env = true_peak_envelope(x)
+    return limit(x * np.float32(gain), env * gain, sr, tp)
+
+
+@traced("prepare")
+def prepare_track(input, output, ss=0, t=-14, f=3, length = 60, cache = None):
+    """
+    Prepares a track by normalising and fading it in process (same arguments as prepare_track.prepare_track)
+    ---------------------------------------------
+    input = The input file to prepare \n
+    output = The output file name \n
+    ss = the position to start the trim at \n
+    t = the target volume in LUFS (-70 to -5) \n
+    f = the number of seconds to fade \n
+    length = the length of the track to use \n
+    cache = a LoudnessCache (see Functions/cache.py), if the track was measured before only the gain and fades are applied
+    """
+    print('Preparing', input + '...')
+    x = decode(input, ss = ss, length = length)
+    key = None if cache is None else cache.key(input, ss, length, "bs1770")
+    x = fade(normalize(x, t, measured = measure(x, key = key, cache = cache)), fade_in = f, fade_out = f)
+    return write_wav(output, x)
+
+
+@traced("prepare")
+def prepare_shoutout(input, output, t=-14, trim = False, ss = 0, length = 5, cache = None):
+    """
+    Prepares a shoutout by normalising it in process (same arguments as prepare_shoutout.prepare_shoutout)
+    ---------------------------------------------
+    input = The input file to prepare \n
+    output = The output file name \n
+    t = the target volume in LUFS (-70 to -5) \n
+    trim = whether or not to trim the shoutout \n
+    ss = the position to start the trim at \n
+    length = the length of the shoutout \n
+    cache = a LoudnessCache (see Functions/cache.py), if the shoutout was measured before only the gain is applied
+    """
+    print('Preparing', input + '...')
+    if not trim:
+        ss, length = None, None
+    x = decode(input, ss = ss, length = length)
+    key = None if cache is None else cache.key(input, ss, length, "bs1770")
+    return write_wav(output, normalize(x, t, measured = measure(x, key = key, cache = cache)))
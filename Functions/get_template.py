@@ -13,8 +13,11 @@ def get_template(name = "template", format = "xlsx", extra_song_cols = ["komment
     song_cols = ["Sang - Kunstner", "link", "starttidspunkt (i sek)", "Shoutout"]
     shoutout_cols = ["Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"] 
 
-    songs = pd.read_excel("sheet_template.xlsx", sheet_name= "Sange", usecols = song_cols)
-    shoutouts = pd.read_excel("sheet_template.xlsx", sheet_name= "Shoutouts", usecols= shoutout_cols)
+    from Functions.workbook import read_sheet
+
+    # both sheets come from a single read of the template
+    songs = read_sheet("sheet_template.xlsx", "Sange", song_cols)
+    shoutouts = read_sheet("sheet_template.xlsx", "Shoutouts", shoutout_cols)
 
     for extra in extra_song_cols:
         songs[extra] = []
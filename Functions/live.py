@@ -0,0 +1,171 @@
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the live club is streamed as mp3, which every player can start playing from any point of the stream. Every packet is
+# written as soon as it is encoded, so the stream is only as far behind the build as the encoder is
+LIVE_ARGS = ['-flush_packets', '1', '-f', 'mp3', '-b:a', '192k']
+CONTENT_TYPE = "audio/mpeg"
+CHUNK_SIZE = 1 << 16
+
+
+class FileOutput:
+    """
+    Writes the live club to a file that grows while the club is made, so it can be played (e.g. with `ffplay` or `mpv`) before
+    the club is done
+    ---------------------------------------
+    path = the mp3 file to write to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.file.flush()
+
+    def pump(self, stream):
+        """
+        Writes everything read from stream (the live output of the encoder, see combine.encode) until it ends
+        """
+        for chunk in iter(lambda: stream.read1(CHUNK_SIZE), b''):
+            self.write(chunk)
+
+    def close(self, wait = True):
+        """
+        Closes the output, wait = whether to wait for the listeners to play the rest of the club (see HttpOutput)
+        """
+        self.file.close()
+
+
+class StdoutOutput(FileOutput):
+    """
+    Writes the live club to stdout, e.g. to pipe it to a player (`python make_club.py | mpv -`). Everything else printed to
+    stdout, by this process or the programs it starts, goes to stderr until the output is closed
+    """
+
+    def __init__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        self.file = os.fdopen(os.dup(1), "wb")
+        os.dup2(2, 1)
+        self.path = "-"
+        self.closed = False
+
+    def write(self, chunk):
+        if self.closed:
+            return
+        try:
+            super().write(chunk)
+        except BrokenPipeError:
+            # the player was closed, the club is still made
+            print('The live output was closed, the club is still being made', file=sys.stderr)
+            self.closed = True
+
+    def close(self, wait = True):
+        try:
+            self.file.close()
+        except BrokenPipeError:
+            pass
+        sys.stdout.flush()
+        os.dup2(self.saved, 1)
+        os.close(self.saved)
+
+
+class HttpOutput(FileOutput):
+    """
+    Serves the live club over http while it is made, e.g. to play it in VLC or a browser on the same network. Every listener
+    gets the club from the start, followed as it grows. The club is also written to path, which the listeners are served from
+    ---------------------------------------
+    address = "host:port" to serve on \n
+    path = the mp3 file to write to
+    """
+
+    def __init__(self, address, path):
+        super().__init__(path)
+        self.done = False
+        self.listeners = 0
+        self.changed = threading.Condition()
+
+        output = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                output.serve(self.wfile)
+
+            def log_message(self, format, *args):
+                pass
+
+        host, port = address.rsplit(":", 1)
+        self.server = ThreadingHTTPServer((host, int(port)), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        print(f"Playing the club live at http://{host or 'localhost'}:{self.server.server_address[1]}/")
+
+    def write(self, chunk):
+        super().write(chunk)
+        with self.changed:
+            self.changed.notify_all()
+
+    def serve(self, wfile):
+        """
+        Sends the club to a listener, following it until it is done or the listener leaves
+        """
+        with self.changed:
+            self.listeners += 1
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    # done is read before the file, so nothing written before the club was done is missed
+                    with self.changed:
+                        done = self.done
+                    chunk = f.read(CHUNK_SIZE)
+                    if chunk:
+                        wfile.write(chunk)
+                    elif done:
+                        break
+                    else:
+                        with self.changed:
+                            self.changed.wait(1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.changed:
+                self.listeners -= 1
+                self.changed.notify_all()
+
+    def close(self, wait = True):
+        """
+        Closes the file and, if wait, waits for the listeners to get the rest of the club before the server is stopped
+        """
+        super().close()
+        with self.changed:
+            self.done = True
+            self.changed.notify_all()
+            if wait and self.listeners:
+                print('Waiting for', self.listeners, 'listeners to play the rest of the club (Ctrl+C to stop)...')
+            while wait and self.listeners:
+                self.changed.wait()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def open_live(live, path):
+    """
+    Returns the live output of a club (see make_club): "-" for stdout, "host:port" to serve it over http and otherwise the
+    file to write it to
+    ---------------------------------------
+    path = the file the club is served from over http
+    """
+    if live == "-":
+        return StdoutOutput()
+    if re.fullmatch(r"[\w.\-]*:\d+", live):
+        return HttpOutput(live, path)
+    return FileOutput(live)
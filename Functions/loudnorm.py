@@ -0,0 +1,111 @@
+import json
+import math
+import os
+import subprocess
+
+from Functions.trace import note
+
+
+def trim_args(ss = None, length = None):
+    """
+    Returns the ffmpeg input arguments that trim to [ss, ss + length], None to not trim
+    """
+    trim = []
+    if ss is not None:
+        trim += ['-ss', str(ss)]
+    if length is not None:
+        trim += ['-t', str(length)]
+    return trim
+
+
+def measure_and_decode(input, t, ss = None, length = None, tp = -1):
+    """
+    Decodes (and trims) the input once, returning the decoded wav bytes together with the loudnorm measurements of it
+    ---------------------------------------------
+    input = the input file \n
+    t = the target volume in LUFS (-70 to -5) \n
+    ss = the position to start the trim at, None to not trim \n
+    length = the length to trim to, None to not trim \n
+    tp = the maximum true peak in dBTP
+    """
+    # one decode feeds two outputs: the trimmed pcm on stdout and the loudnorm measurement pass (printed on stderr)
+    process = subprocess.Popen(['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'info',
+                                *trim_args(ss, length), '-i', input,
+                                '-map', '0:a:0', '-f', 'wav', '-',
+                                '-map', '0:a:0', '-af', 'loudnorm=I=' + str(t) + ':TP=' + str(tp) + ':print_format=json',
+                                '-f', 'null', os.devnull],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    decoded, err = process.communicate()
+    note(bytes_piped = len(decoded))
+
+    if process.returncode != 0:
+        raise RuntimeError('Could not measure ' + input + ': ' + err.decode('utf-8', 'replace'))
+
+    return decoded, parse_measurement(err)
+
+
+def measure_or_lookup(input, t, ss = None, length = None, cache = None):
+    """
+    Returns the ffmpeg input arguments, the bytes to feed them on stdin and the loudnorm measurements of the trimmed input.
+    If the measurement is in the cache, the second pass reads and trims the input itself and no measuring is done,
+    otherwise the input is decoded and measured once (see measure_and_decode)
+    ---------------------------------------------
+    input = the input file \n
+    t = the target volume in LUFS (-70 to -5) \n
+    ss = the position to start the trim at, None to not trim \n
+    length = the length to trim to, None to not trim \n
+    cache = a LoudnessCache (see Functions/cache.py) or None
+    """
+    key = None if cache is None else cache.key(input, ss, length, "loudnorm")
+    stats = None if key is None else cache.get(key)
+    if stats is not None:
+        # the gain is worked out from the measured loudness (see linear_filter), so a measurement holds for any target
+        stats.pop('t', None)
+        return [*trim_args(ss, length), '-i', input], None, stats
+
+    decoded, stats = measure_and_decode(input, t, ss = ss, length = length)
+    if key is not None:
+        cache.put(key, stats)
+    return ['-i', '-'], decoded, stats
+
+
+def parse_measurement(stderr):
+    """
+    Parses the json printed by loudnorm with print_format=json, returns a dict with the measured values as floats
+    """
+    text = stderr.decode('utf-8', 'replace') if isinstance(stderr, bytes) else stderr
+    start = text.rfind('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError('No loudnorm measurement found in ffmpeg output')
+
+    stats = json.loads(text[start:end + 1])
+    return {k: float(v) for k, v in stats.items() if k in ('input_i', 'input_tp', 'input_lra', 'input_thresh', 'target_offset')}
+
+
+def linear_filter(t, stats, tp = -1, attack = 5, release = 50):
+    """
+    Returns the filters that apply the measured stats as a single linear gain followed by a peak limiter at tp (second pass),
+    the same as the numpy engine does (see dsp.normalize)
+    ---------------------------------------------
+    t = the target volume in LUFS (-70 to -5) \n
+    stats = the measurements from measure_and_decode/parse_measurement \n
+    tp = the maximum true peak in dBTP \n
+    attack = the lookahead of the limiter in ms \n
+    release = the release of the limiter in ms
+    """
+    if not all(math.isfinite(stats[k]) for k in ('input_i', 'input_tp', 'input_lra', 'input_thresh')):
+        # silence, there is nothing to normalise
+        return 'anull'
+
+    # loudnorm itself is not used for the second pass: in linear mode it falls back to dynamic normalisation exactly when the
+    # gain would push the true peak above tp, so the gain is applied as it is and only the peaks are limited
+    gain = t - stats['input_i']
+    if stats['input_tp'] + gain <= tp:
+        return 'volume=' + str(round(gain, 2)) + 'dB'
+
+    # alimiter limits the sample peaks, the true peak may overshoot tp by a fraction of a dB
+    return ('volume=' + str(round(gain, 2)) + 'dB' +
+            ',alimiter=limit=' + str(round(max(10 ** (tp / 20), 0.0625), 4)) +
+            ':attack=' + str(attack) + ':release=' + str(release) + ':level=false')
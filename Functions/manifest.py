@@ -0,0 +1,122 @@
+import csv
+import hashlib
+import json
+import os
+
+KEY_LENGTH = 20
+
+
+def row_hash(*inputs):
+    """
+    Returns a key identifying an artifact by the inputs it is made from, e.g. the link, start time and length
+    """
+    return hashlib.sha256(json.dumps([str(i) for i in inputs]).encode("utf-8")).hexdigest()[:KEY_LENGTH]
+
+
+def csv_rows(csv_name):
+    """
+    Returns the rows of a song/shoutout csv as lists of strings. Can also be given the songs or shoutouts of a Plan (see Functions/plan.py)
+    """
+    if not isinstance(csv_name, str):
+        return csv_name.rows()
+    with open(csv_name, "rt") as csvfile:
+        return list(csv.reader(csvfile, delimiter=",", quotechar='"'))
+
+
+def download_keys(csv_name, length = None, window_margin = None):
+    """
+    Returns the content key of the download of every row in a song/shoutout csv (see dl.download_all for the arguments)
+    """
+    keys = []
+    for row in csv_rows(csv_name):
+        if window_margin is None:
+            keys.append(row_hash(row[1]))
+        else:
+            keys.append(row_hash(row[1], row[2], row[3] if length is None else length, window_margin))
+    return keys
+
+
+def file_keys(folder, n):
+    """
+    Returns a key from the size and modification time of <folder>/1.wav ... <folder>/n.wav, used for own shoutouts
+    """
+    keys = []
+    for i in range(1, n + 1):
+        path = os.path.join(folder, str(i) + ".wav")
+        stat = os.stat(path) if os.path.exists(path) else None
+        keys.append(row_hash(stat.st_size, stat.st_mtime_ns) if stat else row_hash(None))
+    return keys
+
+
+def prepare_keys(input_keys, csv_name = None, length = None, settings = ()):
+    """
+    Returns the content key of every prepared row: made from the key of its input file, its start time and length (read
+    from the third and fourth column of csv_name if given) and the settings (target volume, fade, ...)
+    """
+    rows = csv_rows(csv_name) if csv_name is not None else [None] * len(input_keys)
+    keys = []
+    for k, row in zip(input_keys, rows):
+        trim = () if row is None else (row[2], row[3] if length is None else length)
+        keys.append(row_hash(k, *trim, *settings))
+    return keys
+
+
+def missing_rows(keys, folder):
+    """
+    Returns the (1-indexed) rows whose artifact <key>.wav does not exist in folder
+    """
+    return [i for i, k in enumerate(keys, 1) if not os.path.exists(os.path.join(folder, k + ".wav"))]
+
+
+def prune(folder, keys):
+    """
+    Removes the artifacts from folder that are not used by any of the keys
+    """
+    keep = {k + ".wav" for k in keys}
+    if os.path.isdir(folder):
+        for f in os.listdir(folder):
+            if f.endswith(".wav") and f not in keep:
+                os.remove(os.path.join(folder, f))
+
+
+class Manifest:
+    """
+    Records the order of the songs and shoutouts of the last build, so an incremental rebuild keeps the club's order
+    ---------------------------------------
+    path = the json file to keep the manifest in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {"orders": {}}
+        if os.path.exists(path):
+            with open(path, "rt") as f:
+                self.data = json.load(f)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump(self.data, f, indent = 1)
+        os.replace(tmp, self.path)
+
+    def order(self, kind, n):
+        """
+        Returns the order (see prepare_csv.mix_song_pos) used in the last build if it had n rows, otherwise None
+        """
+        order = self.data["orders"].get(kind)
+        return order if order is not None and len(order) == n else None
+
+    def set_order(self, kind, order):
+        self.data["orders"][kind] = [int(i) for i in order]
+        self.save()
+
+    def reorder(self, kind, order):
+        """
+        Records a new order applied on top of the last one (e.g. when reshuffling the existing csv's)
+        """
+        last = self.data["orders"].get(kind)
+        if last is not None and len(last) == len(order):
+            self.set_order(kind, [last[i] for i in order])
+        else:
+            self.data["orders"].pop(kind, None)
+            self.save()
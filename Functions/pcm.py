@@ -0,0 +1,93 @@
+import subprocess
+import wave
+
+# the canonical format every prepare stage writes, so segments can be appended without resampling
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+
+FFMPEG_ARGS = ['-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), '-c:a', 'pcm_s16le']
+FFMPEG_INPUT_ARGS = ['-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS)]
+
+CHUNK_FRAMES = 1 << 16
+
+
+def output_args(output):
+    """
+    Returns the ffmpeg arguments that write the canonical format to output, a wav file or '-' for raw pcm on stdout
+    """
+    if output == '-':
+        return [*FFMPEG_ARGS, '-f', 's16le', '-']
+    return [*FFMPEG_ARGS, '-f', 'wav', '-y', output]
+
+
+def is_canonical(path):
+    """
+    Returns whether a file is a wav in the canonical format (44.1 kHz stereo 16 bit)
+    """
+    try:
+        with wave.open(path, 'rb') as w:
+            return (w.getframerate(), w.getnchannels(), w.getsampwidth()) == (SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH)
+    except (wave.Error, EOFError):
+        return False
+
+
+def iter_pcm(path, chunk_frames = CHUNK_FRAMES):
+    """
+    Yields the raw canonical pcm of an audio file in chunks. Canonical wavs are read directly, anything else is converted with ffmpeg
+    ---------------------------------------------
+    path = the file to read \n
+    chunk_frames = the number of frames in each chunk
+    """
+    if is_canonical(path):
+        with wave.open(path, 'rb') as w:
+            for chunk in iter(lambda: w.readframes(chunk_frames), b''):
+                yield chunk
+        return
+
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-i', path,
+                                '-map', '0:a:0', *FFMPEG_ARGS, '-f', 's16le', '-'],
+                               stdout=subprocess.PIPE)
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_frames * CHANNELS * SAMPLE_WIDTH), b''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def pcm_length(path):
+    """
+    Returns the number of frames (samples per channel) of an audio file in the canonical format
+    """
+    if is_canonical(path):
+        with wave.open(path, 'rb') as w:
+            return w.getnframes()
+    return sum(len(chunk) for chunk in iter_pcm(path)) // (CHANNELS * SAMPLE_WIDTH)
+
+
+def iter_pcm_range(path, start, end, chunk_frames = CHUNK_FRAMES):
+    """
+    Yields the raw canonical pcm of the frames [start, end) of an audio file in chunks (see iter_pcm)
+    """
+    if is_canonical(path):
+        with wave.open(path, 'rb') as w:
+            w.setpos(start)
+            left = end - start
+            while left > 0:
+                chunk = w.readframes(min(chunk_frames, left))
+                if not chunk:
+                    break
+                left -= len(chunk) // (CHANNELS * SAMPLE_WIDTH)
+                yield chunk
+        return
+
+    frame_bytes = CHANNELS * SAMPLE_WIDTH
+    position = 0
+    for chunk in iter_pcm(path, chunk_frames):
+        n = len(chunk) // frame_bytes
+        if position + n > start:
+            yield chunk[max(start - position, 0) * frame_bytes:max(min(end - position, n), 0) * frame_bytes]
+        position += n
+        if position >= end:
+            break
@@ -0,0 +1,228 @@
+import asyncio
+import itertools
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import Future, wait
+
+from Functions.manifest import csv_rows
+
+
+class PriorityPool:
+    """
+    Threads running the functions submitted to them lowest priority first rather than in the order they were submitted
+    ---------------------------------------
+    workers = the number of functions to run at the same time \n
+    slots = a semaphore shared with other pools, a function only runs while it holds a slot
+    """
+
+    def __init__(self, workers, slots = None):
+        self.slots = slots
+        self.queue = queue.PriorityQueue()
+        # breaks ties between equal priorities in the order they were submitted, the futures are not comparable
+        self.count = itertools.count()
+        self.threads = [threading.Thread(target = self._work, daemon = True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            _, _, future, function, args = self.queue.get()
+            if future is None:
+                return
+            if self.slots is not None:
+                self.slots.acquire()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(function(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            finally:
+                if self.slots is not None:
+                    self.slots.release()
+
+    def submit(self, priority, function, *args):
+        """
+        Returns a future of function(*args), run after everything submitted with a lower priority
+        """
+        future = Future()
+        self.queue.put((priority, next(self.count), future, function, args))
+        return future
+
+    def shutdown(self, cancel = False):
+        """
+        Stops the threads after the work already submitted, or with cancel after the work already running, cancelling the rest
+        """
+        if cancel:
+            while True:
+                try:
+                    _, _, future, _, _ = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if future is not None:
+                    future.cancel()
+        for _ in self.threads:
+            self.queue.put((float("inf"), next(self.count), None, None, None))
+        for thread in self.threads:
+            thread.join()
+
+
+class Pipeline:
+    """
+    Moves every song/shoutout through download and preparation on its own, so a track is prepared as soon as it is downloaded
+    instead of waiting for the slowest download, and the encoder can start on the first segments while the rest are still running.
+    The items are downloaded and prepared in the order they were submitted: a downloaded item is prepared before the items
+    submitted after it, even if those were downloaded first, so the segment the encoder waits for next is made first
+    ---------------------------------------
+    cache = a DownloadCache (see Functions/cache.py) to fetch downloads from and add new downloads to, or None \n
+    net_workers = the number of downloads to run at the same time \n
+    cpu_workers = the number of preparations to run at the same time, by default the number of cpus \n
+    retries = the number of times a failed download is retried \n
+    downloader = the youtube-dl executable, e.g. a stand-in for offline tests \n
+    limits = HostLimits (see Functions/downloader.py) shared with other builds, used instead of net_workers \n
+    cpu_slots = a semaphore shared with other builds (see Functions/service.py), a preparation only runs while it holds a slot
+    """
+
+    def __init__(self, cache = None, net_workers = 4, cpu_workers = None, retries = 3, downloader = "youtube-dl", limits = None, cpu_slots = None):
+        from Functions.downloader import Downloader
+
+        # downloads run on an event loop in a background thread (see Functions/downloader.py), the preparation is done by
+        # ffmpeg subprocesses (or numpy, which releases the gil) so threads are enough for it
+        self.downloader = Downloader(parallel = net_workers, retries = retries, downloader = downloader, cache = cache, limits = limits)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+        self.cpu = PriorityPool(cpu_workers or os.cpu_count(), cpu_slots)
+        self.downloads = []
+        self.fetches = {}
+        self.prepares = {}
+        self.submitted = 0
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # on an error (e.g. the encoder failed) nothing more is downloaded or prepared
+        self.close(cancel = exc[0] is not None)
+
+    def close(self, cancel = False):
+        """
+        Waits for every submitted item, or with cancel only for the preparations already running, cancelling the downloads
+        and the preparations not started yet
+        """
+        if cancel:
+            asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result()
+        else:
+            # downloads are waited for first as their callbacks submit to the cpu pool
+            wait(self.downloads)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.cpu.shutdown(cancel = cancel)
+
+    def submit(self, download, prepare, outfile):
+        """
+        Schedules one song/shoutout and returns a future of the path of its prepared file, which raises the error if it could not be prepared. Items are started in the order they
+        are submitted, so submitting in the order of the club gives the first segments of the encode priority
+        ---------------------------------------
+        download = the job to download the input with (see dl.download_job), or None if the input is already in place \n
+        prepare = (function, args) to prepare the input with, args starting with the input and output file \n
+        outfile = the prepared file, if it exists already nothing is done
+        """
+        result = Future()
+        position = self.submitted
+        self.submitted += 1
+        if os.path.exists(outfile):
+            result.set_result(outfile)
+            return result
+        if outfile in self.prepares:
+            # another row with the same inputs and settings (see manifest.prepare_keys) is already being prepared to this file
+            return self.prepares[outfile]
+        self.prepares[outfile] = result
+
+        def prepared(f):
+            if f.cancelled():
+                result.cancel()
+                return
+            if f.exception() is not None:
+                # unlike a failed download, a failed preparation fails the build instead of leaving the segment out
+                result.set_exception(f.exception())
+                return
+            result.set_result(outfile)
+
+        def start_prepare(f = None):
+            if f is not None and f.cancelled():
+                result.cancel()
+                return
+            if f is not None and f.exception() is not None:
+                print('Error downloading', download["name"], file=sys.stderr)
+                print(f.exception(), file=sys.stderr)
+            elif f is not None and f.result() is not None:
+                self.failures.append(dict(f.result(), row = download["row"], name = download["name"]))
+            infile = prepare[1][0]
+            if not os.path.exists(infile):
+                # the download failed (and was reported), the encoder skips the missing segment
+                result.set_result(outfile)
+                return
+            self.cpu.submit(position, prepare[0], *prepare[1]).add_done_callback(prepared)
+
+        if download is not None and download["outfile"] in self.fetches:
+            # the file is already being downloaded for another row using the same source
+            self.fetches[download["outfile"]].add_done_callback(start_prepare)
+        elif download is None or os.path.exists(download["outfile"]):
+            start_prepare()
+        else:
+            f = asyncio.run_coroutine_threadsafe(self.downloader.fetch(download), self.loop)
+            self.fetches[download["outfile"]] = f
+            self.downloads.append(f)
+            f.add_done_callback(start_prepare)
+        return result
+
+
+async def cancel_tasks():
+    # cancels the other tasks of the running loop and waits until they have stopped
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+
+
+def track_jobs(songs_csv, input, output, t = -14, f = 3, length = 60, window_margin = None, engine = "ffmpeg", input_keys = None, keys = None, cache = None):
+    """
+    Returns the (download, prepare, outfile) of every song for Pipeline.submit (see prepare_track.prepare_all_tracks for the arguments)
+    """
+    from Functions.dl import download_job
+    from Functions.prepare_track import prepare_function, track_trim
+
+    prepare = prepare_function(engine)
+    jobs = []
+    for i, row in enumerate(csv_rows(songs_csv), 1):
+        infile = os.path.join(input, (str(i) if input_keys is None else input_keys[i-1]) + '.wav')
+        outfile = os.path.join(output, (str(i) if keys is None else keys[i-1]) + '.wav')
+        download = download_job(i, row, infile, window_margin, length if isinstance(length, (int, float)) else None)
+        ss, track_length = track_trim(row, i, length, window_margin)
+        jobs.append((download, (prepare, (infile, outfile, ss, t, f, track_length, cache)), outfile))
+    return jobs
+
+
+def shoutout_jobs(shoutout_csv, input, output, n, t = -14, trim_vals = None, window_margin = None, engine = "ffmpeg", input_keys = None, keys = None, cache = None):
+    """
+    Returns the (download, prepare, outfile) of every shoutout for Pipeline.submit. If shoutout_csv is None the shoutouts are
+    not downloaded but read from <input>/1.wav ... <input>/n.wav (see prepare_shoutout.prepare_all_shoutouts for the other arguments)
+    """
+    from Functions.dl import download_job
+    from Functions.prepare_shoutout import prepare_function, shoutout_args
+
+    prepare = prepare_function(engine)
+    rows = csv_rows(shoutout_csv) if shoutout_csv is not None else [None] * n
+    jobs = []
+    for i, row in enumerate(rows[:n], 1):
+        infile = os.path.join(input, (str(i) if input_keys is None else input_keys[i-1]) + '.wav')
+        outfile = os.path.join(output, (str(i) if keys is None else keys[i-1]) + '.wav')
+        download = None if row is None else download_job(i, row, infile, window_margin)
+        jobs.append((download, (prepare, (infile, outfile, *shoutout_args(i, t, trim_vals, window_margin), cache)), outfile))
+    return jobs
@@ -0,0 +1,236 @@
+import csv
+import os
+
+# the columns of a row of the song and shoutout csv's (see prepare_csv.create_song_csv and create_shoutout_csv)
+SONG_LAYOUT = ["name", "link", "start", "shoutout", "pinned"]
+VARYING_SONG_LAYOUT = ["name", "link", "start", "length", "shoutout", "pinned"]
+SHOUTOUT_LAYOUT = ["name", "link", "start", "length"]
+TEXT_COLUMNS = {"name", "link", "shoutout"}
+
+
+def text(value):
+    """
+    Returns a value as pandas writes it to a csv, so the rows of a plan are the same as the rows read back from its csv export
+    (and so are the content keys made from them, see Functions/manifest.py)
+    """
+    if isinstance(value, str):
+        return value
+    import numpy as np
+
+    if isinstance(value, (bool, np.bool_)):
+        return "x" if value else ""
+    if np.isnan(value):
+        return ""
+    if isinstance(value, np.integer):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Table:
+    """
+    The songs or the shoutouts of a club in the order they are played, one entry per slot, kept as a typed column per field
+    ---------------------------------------
+    columns = dict of equally long numpy arrays: "name", "link" and "shoutout" of strings ("" if empty), "start" and "length" of numbers (NaN if empty) and "pinned" of bools \n
+    layout = the columns of a row of the csv export, in order
+    """
+
+    def __init__(self, columns, layout):
+        self.columns = columns
+        self.layout = layout
+
+    def __len__(self):
+        return len(self.columns["name"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @classmethod
+    def from_frame(cls, frame, layout):
+        """
+        Returns the table of a data frame with the columns of layout, in order. If the frame has no "pinned" column (e.g. a
+        csv exported before it had one) no row is pinned
+        """
+        import numpy as np
+        import pandas as pd
+
+        columns = {}
+        for name, (_, values) in zip(layout, frame.items()):
+            if name == "pinned":
+                columns[name] = values.notnull().to_numpy()
+            elif name in TEXT_COLUMNS or values.dtype == object:
+                # a start time written as text (e.g. "1:30") is kept as text, ffmpeg reads it just as well
+                columns[name] = np.array(["" if pd.isnull(v) else str(v) for v in values], dtype = str)
+            else:
+                columns[name] = values.to_numpy()
+        if "pinned" not in columns:
+            columns["pinned"] = np.zeros(len(frame), dtype = bool)
+        return cls(columns, layout)
+
+    @classmethod
+    def from_csv(cls, csv_name, layout):
+        """
+        Returns the table of a song/shoutout csv
+        """
+        import pandas as pd
+
+        return cls.from_frame(pd.read_csv(csv_name, header = None), layout)
+
+    def take(self, order):
+        """
+        Returns the table with its rows in the given order
+        """
+        import numpy as np
+
+        order = np.asarray(order, dtype = int)
+        return Table({name: values[order] for name, values in self.columns.items()}, self.layout)
+
+    def rows(self):
+        """
+        Returns the rows as lists of strings, as they are written to the csv export
+        """
+        return [[text(v) for v in row] for row in zip(*[self.columns[name] for name in self.layout])]
+
+    def trim_vals(self):
+        """
+        Returns a data frame with the start times in the first column and the lengths in the second (see prepare_csv.get_trim_vals)
+        """
+        import pandas as pd
+
+        return pd.DataFrame({0: self.columns["start"], 1: self.columns["length"]})
+
+    def to_csv(self, csv_name):
+        """
+        Writes the table as a song/shoutout csv
+        """
+        with open(csv_name, "wt", newline = "") as f:
+            csv.writer(f, lineterminator = os.linesep).writerows(self.rows())
+
+
+class Plan:
+    """
+    The club as it is played: its songs and the shoutouts played before them. The plan is read once from the xlsx/csv's and
+    handed to every stage, the song and shoutout csv's are only written as an export
+    ---------------------------------------
+    songs = the Table of the songs \n
+    shoutouts = the Table of the shoutouts, None if the shoutouts are not from links
+    """
+
+    def __init__(self, songs, shoutouts = None):
+        self.songs = songs
+        self.shoutouts = shoutouts
+
+    @classmethod
+    def read(cls, song_file, shoutout_file = None, n_songs = 100, diff_song_length = False, song_sheet = "Sange", shoutout_sheet = "Shoutouts", cache_dir = None):
+        """
+        Reads a plan from xlsx or csv files with the headers described in prepare_csv.read_songs and read_shoutouts
+        ---------------------------------------
+        song_file = the file with the songs \n
+        shoutout_file = the file with the shoutouts, or None for no shoutouts from links \n
+        n_songs = the number of songs (and shoutouts) to use, taken from the start of the files \n
+        diff_song_length = whether the songs have varying lengths \n
+        song_sheet, shoutout_sheet = the sheets with the songs and the shoutouts in an xlsx file \n
+        cache_dir = the cache of parsed workbooks (see Functions/workbook.py). The songs and the shoutouts of one xlsx are read from it in a single pass
+        """
+        from Functions.prepare_csv import read_songs
+
+        print("Reading the songs...")
+        songs = read_songs(song_file, n_songs, song_sheet, diff_song_length, cache_dir)
+        songs = Table.from_frame(songs, VARYING_SONG_LAYOUT if diff_song_length else SONG_LAYOUT)
+
+        plan = cls(songs)
+        if shoutout_file is not None:
+            plan.read_shoutouts(shoutout_file, n_songs, shoutout_sheet, cache_dir)
+        return plan
+
+    def read_shoutouts(self, shoutout_file, n_shoutouts = 100, shoutout_sheet = "Shoutouts", cache_dir = None):
+        """
+        Reads the shoutouts of the plan from an xlsx or csv file, in the order of the file (see arrange)
+        """
+        from Functions.prepare_csv import read_shoutouts
+
+        print("Reading the shoutouts...")
+        self.shoutouts = Table.from_frame(read_shoutouts(shoutout_file, n_shoutouts, shoutout_sheet, cache_dir = cache_dir), SHOUTOUT_LAYOUT)
+
+    @classmethod
+    def from_csv(cls, song_csv, shoutout_csv = None, diff_song_length = False):
+        """
+        Returns the plan of the song and shoutout csv's of a club, e.g. one made before plans were saved
+        """
+        songs = Table.from_csv(song_csv, VARYING_SONG_LAYOUT if diff_song_length else SONG_LAYOUT)
+        shoutouts = None if shoutout_csv is None else Table.from_csv(shoutout_csv, SHOUTOUT_LAYOUT)
+        return cls(songs, shoutouts)
+
+    def mix(self, order = None, seed = None, spread = False):
+        """
+        Mixes up the order of the songs, keeping the pinned songs in place, and returns the order used (see prepare_csv.mix_order)
+        ---------------------------------------
+        order = an order to apply instead of mixing, e.g. the order returned by an earlier call \n
+        seed = a seed for the same order every time \n
+        spread = whether to avoid playing the same artist (the part of the name after " - ") twice in a row
+        """
+        from Functions.prepare_csv import artists_of, mix_order
+
+        if order is None:
+            order = mix_order(self.songs["pinned"], artists_of(self.songs["name"]) if spread else None, seed)
+        self.songs = self.songs.take(order)
+        return order
+
+    def arrange(self, order = None, seed = None):
+        """
+        Puts the shoutouts in the order of the songs they belong to and returns the order used (see prepare_csv.arrange_order)
+        ---------------------------------------
+        order = an order to apply instead of arranging, e.g. the order returned by an earlier call \n
+        seed = a seed for the same order every time
+        """
+        from Functions.prepare_csv import arrange_order
+
+        if order is None:
+            order = arrange_order(self.songs["shoutout"], self.shoutouts["name"], seed)
+        self.shoutouts = self.shoutouts.take(order)
+        return order
+
+    def to_csv(self, song_csv, shoutout_csv = None):
+        """
+        Exports the songs (and the shoutouts) as csv's in the format of prepare_csv.create_song_csv and create_shoutout_csv
+        """
+        self.songs.to_csv(song_csv)
+        if shoutout_csv is not None and self.shoutouts is not None:
+            self.shoutouts.to_csv(shoutout_csv)
+
+    def save(self, path):
+        """
+        Saves the plan to a binary file (numpy's npz, without pickles) to resume from with load
+        """
+        import numpy as np
+
+        arrays = {}
+        for kind, table in [("songs", self.songs), ("shoutouts", self.shoutouts)]:
+            if table is None:
+                continue
+            arrays[kind + ".layout"] = np.array(table.layout)
+            for name, values in table.columns.items():
+                arrays[kind + "." + name] = values
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the plan saved to path
+        """
+        import numpy as np
+
+        with np.load(path, allow_pickle = False) as data:
+            tables = {}
+            for kind in ["songs", "shoutouts"]:
+                if kind + ".layout" in data.files:
+                    columns = {name.split(".", 1)[1]: data[name] for name in data.files if name.startswith(kind + ".") and name != kind + ".layout"}
+                    layout = list(data[kind + ".layout"])
+                    if kind == "songs" and "pinned" not in layout:
+                        # saved before the songs of varying length exported their pins, which a hand edited csv would lose
+                        layout.append("pinned")
+                    tables[kind] = Table(columns, layout)
+        return cls(tables["songs"], tables.get("shoutouts"))
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import re
+import sys
+import time
+
+from Functions.downloader import Downloader, host_of, run
+from Functions.trace import note, span
+
+REPORT_FILE = "preflight.json"
+
+
+def seconds(value):
+    """
+    Returns a start time or length (a number or text like "90", "1:30" or "0:01:30") in seconds, or None if it is not a time
+    """
+    try:
+        parts = [float(part) for part in str(value).strip().split(":")]
+    except ValueError:
+        return None
+    if len(parts) > 3 or parts[0] != parts[0]:
+        return None
+    total = 0
+    for part in parts:
+        total = total * 60 + part
+    return total
+
+
+def probe_command(link, downloader = "youtube-dl"):
+    """
+    Returns the command that prints the metadata of a link as json without downloading it
+    """
+    return [downloader, '--dump-json', '--no-playlist', link]
+
+
+def media_command(url):
+    """
+    Returns the ffmpeg command that prints the duration and the streams of a direct media url (ffmpeg exits without an output file)
+    """
+    return ['ffmpeg', '-hide_banner', '-i', url]
+
+
+def parse_info(out):
+    """
+    Returns the duration and the audio formats from the json youtube-dl prints for a link (see probe_command). The formats are
+    None if the extractor does not list them. Raises ValueError if there is no json object in the output
+    """
+    # lines that are not json, e.g. warnings printed on stdout, are skipped
+    lines = [line for line in out.decode('utf-8', 'replace').splitlines() if line.lstrip().startswith('{')]
+    if not lines:
+        raise ValueError('youtube-dl printed no info')
+    info = json.loads(lines[0])
+    if not isinstance(info, dict):
+        raise ValueError('youtube-dl printed no info')
+    formats = info.get("formats")
+    if formats is None and info.get("acodec") is not None:
+        formats = [info]
+    if formats is not None:
+        formats = [f.get("format_id", "") + " " + f["acodec"] for f in formats if f.get("acodec") not in (None, "none")]
+    return {"duration": info.get("duration"), "live": bool(info.get("is_live")), "formats": formats}
+
+
+def parse_media(err):
+    """
+    Returns the duration and the audio streams from what ffmpeg prints about an input (see media_command)
+    """
+    duration = None
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", err)
+    if match is not None:
+        h, m, s = match.groups()
+        duration = round(int(h) * 3600 + int(m) * 60 + float(s), 2)
+    return {"duration": duration, "live": False, "formats": re.findall(r"Stream #\S+: Audio: (\w+)", err)}
+
+
+class Prober(Downloader):
+    """
+    Resolves the metadata of links (duration, availability and audio formats) without downloading them, with the
+    concurrency, per host limits and retries of the Downloader (see Functions/downloader.py). Every link is probed once
+    """
+
+    async def probe(self, link):
+        """
+        Returns the metadata of a link as {"available", "duration", "live", "formats", "error"}
+        """
+        from Functions.dl import is_direct
+
+        host = host_of(link)
+        with span("probe", "preflight", item = link):
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                async with self._slot(host):
+                    # links to media files are read by ffmpeg directly, as they are when downloading windows
+                    if is_direct(link):
+                        _, _, err = await run(media_command(link))
+                        info = parse_media(err)
+                        ok = info["duration"] is not None or len(info["formats"]) > 0
+                    else:
+                        code, out, err = await run(probe_command(link, self.downloader))
+                        ok = code == 0 and out.strip() != b""
+                        try:
+                            info = parse_info(out) if ok else None
+                        except ValueError as e:
+                            # reported as a problem of the rows using the link, the other links are still checked
+                            ok, err = False, 'could not read the info of the link: ' + str(e)
+                if ok:
+                    note(status = "ok", attempts = attempt + 1)
+                    return dict(info, available = True, error = "")
+            note(status = "failed", attempts = self.retries + 1)
+
+        error = err.strip().splitlines()
+        return {"available": False, "duration": None, "live": False, "formats": None, "error": error[-1] if error else ""}
+
+    async def _probe_all(self, links):
+        return dict(zip(links, await asyncio.gather(*[self.probe(link) for link in links])))
+
+    def run(self, links):
+        """
+        Probes all (distinct) links at the same time and returns their metadata by link (see probe)
+        """
+        return asyncio.run(self._probe_all(list(dict.fromkeys(links))))
+
+
+def check_windows(table, infos, kind, length = None):
+    """
+    Returns the problems of the rows of a song/shoutout table: links that are unavailable, live or without audio, and
+    clips (the start time plus the length) that do not fit in their source
+    ---------------------------------------
+    table = a Table of a plan (see Functions/plan.py) \n
+    infos = the metadata of the links (see Prober.run) \n
+    kind = "songs" or "shoutouts", only used in the report \n
+    length = the length of every clip, None to use the lengths of the table
+    """
+    problems = []
+    lengths = table["length"] if length is None else [length] * len(table)
+    for i, (name, link, ss, ln) in enumerate(zip(table["name"], table["link"], table["start"], lengths), start = 1):
+        info = infos[link]
+
+        def problem(text, severity = "error"):
+            problems.append({"kind": kind, "row": i, "name": name, "link": link, "severity": severity, "problem": text})
+
+        start, clip = seconds(ss), seconds(ln)
+        if not info["available"]:
+            problem("unavailable: " + info["error"])
+            continue
+        if info["live"]:
+            problem("is a live stream")
+        if info["formats"] is not None and len(info["formats"]) == 0:
+            problem("has no audio")
+        if start is None or start < 0:
+            problem(f"the start time {ss} is not a time in seconds")
+        elif clip is None or clip <= 0:
+            problem(f"the length {ln} is not positive, the end time must be after the start time")
+        elif info["duration"] is None:
+            problem("the length of the source is unknown, the clip can not be checked", "warning")
+        elif start + clip > info["duration"]:
+            problem(f"the clip ends at {start + clip:g} s but the source is only {info['duration']:g} s long")
+    return problems
+
+
+def check_bindings(songs, shoutouts):
+    """
+    Returns the problems with the shoutouts named by the songs (see prepare_csv.arrange_order): names not found among the
+    shoutouts, names of more than one shoutout and songs not played after the shoutout they name (e.g. when the shoutouts
+    were kept from an earlier build)
+    """
+    problems = []
+    names = list(shoutouts["name"])
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    if len(names) < len(songs):
+        problems.append({"kind": "shoutouts", "row": len(names) + 1, "name": "", "link": "", "severity": "error",
+                         "problem": f"there are only {len(names)} shoutouts for {len(songs)} songs"})
+
+    for i, (name, link, wanted) in enumerate(zip(songs["name"], songs["link"], songs["shoutout"]), start = 1):
+        def problem(text, severity = "warning"):
+            problems.append({"kind": "songs", "row": i, "name": name, "link": link, "severity": severity, "problem": text})
+
+        if wanted == "":
+            continue
+        if wanted not in counts:
+            problem(f'names the shoutout "{wanted}", which does not exist, a random shoutout is played instead')
+        elif i <= len(names) and names[i - 1] != wanted:
+            problem(f'names the shoutout "{wanted}" but is played after "{names[i - 1]}"')
+        if counts.get(wanted, 0) > 1:
+            problem(f'names the shoutout "{wanted}", which is the name of {counts[wanted]} shoutouts, only the first is used')
+    return problems
+
+
+def print_report(problems, n_rows, n_links, elapsed):
+    """
+    Prints a summary of the preflight and its problems, the errors first, all to stderr so the report stays together
+    """
+    errors = sum(p["severity"] == "error" for p in problems)
+    print(f"Checked {n_rows} songs/shoutouts ({n_links} links) in {elapsed:.1f} seconds: {errors} errors and {len(problems) - errors} warnings", file=sys.stderr)
+    for p in sorted(problems, key = lambda p: (p["severity"] != "error", p["kind"], p["row"])):
+        where = p["name"] + (' (' + p["link"] + ')' if p["link"] else '')
+        print('  ' + p["severity"], 'in', p["kind"], 'row', p["row"], '-', where + ':', p["problem"], file=sys.stderr)
+
+
+def check_club(plan, length = 60, shoutouts = True, report = None, parallel = 8, per_host = 4, retries = 1, downloader = "youtube-dl"):
+    """
+    Checks a club before anything is downloaded: the metadata of every link is resolved at the same time (without downloading
+    any media), the clips are checked to fit in their sources and the songs to be bound to the shoutouts they name.
+    Returns the problems found, as dicts with the kind ("songs"/"shoutouts"), the (1-indexed) row, the name, the link, the
+    severity ("error"/"warning") and the problem
+    ---------------------------------------
+    plan = the Plan of the club (see Functions/plan.py) \n
+    length = the length of every song, None if the songs have varying lengths \n
+    shoutouts = whether the shoutouts of the plan are downloaded from links \n
+    report = if given, the metadata of the links and the problems are written to this json file \n
+    parallel = the number of links to probe at the same time \n
+    per_host = the number of links of the same host to probe at the same time \n
+    retries = the number of times a link that could not be probed is tried again \n
+    downloader = the youtube-dl executable, can be replaced by a stand-in taking the same arguments (e.g. for offline tests)
+    """
+    t0 = time.time()
+    tables = [("songs", plan.songs, length)]
+    if shoutouts and plan.shoutouts is not None:
+        tables.append(("shoutouts", plan.shoutouts, None))
+    links = [link for _, table, _ in tables for link in table["link"]]
+
+    print("Checking", len(links), "links before downloading...")
+    # a probe only fetches metadata, so the probes of a host are only limited by per_host and not spaced out like downloads
+    infos = Prober(parallel = parallel, per_host = per_host, host_interval = 0, retries = retries, downloader = downloader).run(links)
+
+    problems = []
+    for kind, table, clip in tables:
+        problems += check_windows(table, infos, kind, clip)
+    if len(tables) == 2:
+        problems += check_bindings(plan.songs, plan.shoutouts)
+
+    print_report(problems, len(links), len(infos), time.time() - t0)
+    if report is not None:
+        with open(report, "wt") as f:
+            json.dump({"links": infos, "problems": problems}, f, indent = 1)
+    return problems
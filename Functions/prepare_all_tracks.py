@@ -3,15 +3,6 @@ import argparse
 import multiprocessing
 import os
 import csv
-import subprocess
-
-err = subprocess.Popen(['pip', 'install', 'ffmpeg'], 
-                       stdout=subprocess.DEVNULL, 
-                       stderr=subprocess.PIPE).communicate()[1]
-
-if len(err) != 0:
-    print(err)
-    exit(1)
 
 def prepare_all_tracks(club_name = "klub.csv", input = None, output = None, t = -14, f = 3, length = 60):
     """
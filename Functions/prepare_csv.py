@@ -4,17 +4,18 @@ import numpy as np
 
 
 
-def create_song_csv(file_name, n_songs = 100, song_sheet = "Sange", csv_name = "Songs.csv", diff_song_length = False):
+def read_songs(file_name, n_songs = 100, song_sheet = "Sange", diff_song_length = False, cache_dir = None):
     """
-    Creates a csv in the right format to use for the make_klub function. File must either be xlsx or csv and have the headers "Sang - Kunstner", "link", "starttidspunkt (i sek)", "Shoutout"
+    Reads the songs from an xlsx or csv with the headers "Sang - Kunstner", "link", "starttidspunkt (i sek)", "Shoutout", "behold placering",
+    returns a data frame with the columns of the song csv (see create_song_csv), the last of which is "behold placering"
     -------------------------------------------
-    file_name = file to make the songs csv from \n
+    file_name = file to read the songs from \n
     n_songs = how many songs to use (fill be taken from start of the file) \n
     song_sheet = if the file is an .xslx file, the name of the sheet containing the songs must be given here \n
-    csv_name = name of the output csv, must have the .csv extension \n
-    diff_song_length = whether the songs have varying/different lengths \n
+    diff_song_length = whether the songs have varying/different lengths, read from the column "sluttidspunkt (i sek)" \n
+    cache_dir = the cache of parsed workbooks (see Functions/workbook.py), None to parse an xlsx every time
     """
-    print("Creating the song csv...")
+    from Functions.workbook import check_columns, read_sheet
 
     # determine file extension
     filename, file_extension = os.path.splitext(file_name)
@@ -24,35 +25,53 @@ def create_song_csv(file_name, n_songs = 100, song_sheet = "Sange", csv_name = "
     if not (file_extension in supported_extensions):
         raise AssertionError("Please use a valid file extension (xlsx or csv)")
 
-    # create the csv 
+    # read the songs
     cols = ["Sang - Kunstner", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)", "Shoutout", "behold placering"] if diff_song_length else ["Sang - Kunstner", "link", "starttidspunkt (i sek)", "Shoutout", "behold placering"]
 
     if file_extension == ".xlsx":
-        songs = pd.read_excel(file_name, sheet_name=song_sheet, usecols = cols).dropna(how = "all")
+        songs = read_sheet(file_name, song_sheet, cols, cache_dir)
     elif file_extension == ".csv":
-        songs = pd.read_csv(file_name, usecols = cols)
+        songs = pd.read_csv(file_name)
+        check_columns(songs, cols, file_name)
+        songs = songs.loc[:, cols]
 
     if diff_song_length:
         songs["Song length"] = songs["sluttidspunkt (i sek)"]-songs["starttidspunkt (i sek)"]
         songs["Song length"] = songs["Song length"].fillna(60)
-        songs = songs.loc[:, ["Sang - Kunstner", "link", "starttidspunkt (i sek)", "Song length", "Shoutout"]]
+        songs = songs.loc[:, ["Sang - Kunstner", "link", "starttidspunkt (i sek)", "Song length", "Shoutout", "behold placering"]]
 
-    songs.iloc[:n_songs, :].to_csv(csv_name, index = False, header = False)
+    return songs.iloc[:n_songs, :]
 
 
-def create_shoutout_csv(file_name, n_shoutouts = 100, shoutout_sheet = "Shoutouts", csv_name = "Shoutouts.csv", max_length = 45):
+def create_song_csv(file_name, n_songs = 100, song_sheet = "Sange", csv_name = "Songs.csv", diff_song_length = False):
     """
-    Creates a csv in the right format to use for the make_klub function. File must either be xlsx or csv and have the headers "Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"
+    Creates a csv in the right format to use for the make_klub function. File must either be xlsx or csv and have the headers "Sang - Kunstner", "link", "starttidspunkt (i sek)", "Shoutout"
     -------------------------------------------
-    file_name = file to make the shoutout csv from \n
+    file_name = file to make the songs csv from \n
+    n_songs = how many songs to use (fill be taken from start of the file) \n
+    song_sheet = if the file is an .xslx file, the name of the sheet containing the songs must be given here \n
+    csv_name = name of the output csv, must have the .csv extension \n
+    diff_song_length = whether the songs have varying/different lengths \n
+    """
+    print("Creating the song csv...")
+
+    songs = read_songs(file_name, n_songs, song_sheet, diff_song_length)
+    songs.to_csv(csv_name, index = False, header = False)
+
+
+def read_shoutouts(file_name, n_shoutouts = 100, shoutout_sheet = "Shoutouts", max_length = 45, cache_dir = None):
+    """
+    Reads the shoutouts from an xlsx or csv with the headers "Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)",
+    returns a data frame with the columns of the shoutout csv (see create_shoutout_csv)
+    -------------------------------------------
+    file_name = file to read the shoutouts from \n
     n_shoutouts = how many shoutouts to use (will be taken from start of the file). This should match the number of songs used \n
     shoutout_sheet = if the file is an .xslx file, the name of the sheet containing the shoutputs must be given here \n
-    csv_name = name of the output csv, must have the .csv extension \n
-    max_length = the maximum length of a shoutout, if the no end time of the shoutout is given, this shoutout will be trimmed to this length
+    max_length = the maximum length of a shoutout, if the no end time of the shoutout is given, this shoutout will be trimmed to this length \n
+    cache_dir = the cache of parsed workbooks (see Functions/workbook.py), None to parse an xlsx every time
     """
+    from Functions.workbook import check_columns, read_sheet
 
-    print("Creating the shoutout csv...")
-    
     # determine file extension
     filename, file_extension = os.path.splitext(file_name)
 
@@ -60,14 +79,32 @@ def create_shoutout_csv(file_name, n_shoutouts = 100, shoutout_sheet = "Shoutout
     supported_extensions = [".xlsx", ".csv"]
     assert (file_extension in supported_extensions)
 
-    # create the csv
+    # read the shoutouts
+    cols = ["Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"]
     if file_extension == ".xlsx":
-        shoutouts = pd.read_excel(file_name, sheet_name = shoutout_sheet, usecols = ["Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"]).dropna(how = "all")
+        shoutouts = read_sheet(file_name, shoutout_sheet, cols, cache_dir)
     elif file_extension == ".csv":
-        shoutouts = pd.read_csv(file_name, usecols = ["Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"])
+        shoutouts = pd.read_csv(file_name)
+        check_columns(shoutouts, cols, file_name)
+        shoutouts = shoutouts.loc[:, cols]
     shoutouts["SO length"] = shoutouts["sluttidspunkt (i sek)"]-shoutouts["starttidspunkt (i sek)"]
     shoutouts["SO length"] = shoutouts["SO length"].fillna(max_length)
-    shoutouts.iloc[:n_shoutouts, [0, 1, 2, 4]].to_csv(csv_name, index = False, header = False)
+    return shoutouts.iloc[:n_shoutouts, [0, 1, 2, 4]]
+
+
+def create_shoutout_csv(file_name, n_shoutouts = 100, shoutout_sheet = "Shoutouts", csv_name = "Shoutouts.csv", max_length = 45):
+    """
+    Creates a csv in the right format to use for the make_klub function. File must either be xlsx or csv and have the headers "Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"
+    -------------------------------------------
+    file_name = file to make the shoutout csv from \n
+    n_shoutouts = how many shoutouts to use (will be taken from start of the file). This should match the number of songs used \n
+    shoutout_sheet = if the file is an .xslx file, the name of the sheet containing the shoutputs must be given here \n
+    csv_name = name of the output csv, must have the .csv extension \n
+    max_length = the maximum length of a shoutout, if the no end time of the shoutout is given, this shoutout will be trimmed to this length
+    """
+
+    print("Creating the shoutout csv...")
+    read_shoutouts(file_name, n_shoutouts, shoutout_sheet, max_length).to_csv(csv_name, index = False, header = False)
 
 def get_trim_vals(csv = "Shoutouts.csv"):
     """
@@ -81,51 +118,153 @@ def get_trim_vals(csv = "Shoutouts.csv"):
     lens.columns = list(range(2))
     return lens
 
-def mix_song_pos(song_csv = "Songs.csv", diff_song_length = False):
+def artists_of(names):
+    """
+    Returns the artist of every song from its "Sang - Kunstner" name (the part after the last " - ", ignoring case), or the
+    whole name if it has no artist
+    """
+    names = pd.Series(names, dtype = object).fillna("")
+    return np.array([str(name).rpartition(" - ")[2].strip().lower() for name in names], dtype = object)
+
+
+def spread_artists(order, pinned, artists, rng, tries = 20, rounds = 5):
     """
-    Mixes up the order of the songs or shoutouts
+    Swaps songs of order (in place) until no artist plays twice in a row, where possible. Only the songs on both sides of a
+    repeat are looked at and each is swapped with a random unpinned song that fits between its new neighbours, so the time
+    grows with the number of repeats rather than with the square of the songs
+    ---------------------------------------
+    order = an order from mix_order \n
+    pinned = whether every position is pinned \n
+    artists = the artist of every song (see artists_of) \n
+    rng = the numpy Generator to draw from \n
+    tries = the number of random songs tried for every repeat in a round \n
+    rounds = the number of rounds over the repeats that are left
+    """
+    n = len(order)
+    free = np.flatnonzero(~pinned)
+    if n < 2 or len(free) < 2:
+        return order
+    a = pd.factorize(artists)[0][order]
+
+    def fits(i):
+        return (i == 0 or a[i] != a[i-1]) and (i == n - 1 or a[i] != a[i+1])
+
+    for _ in range(rounds):
+        repeats = np.flatnonzero(a[1:] == a[:-1]) + 1
+        # the second song of a repeat is moved, or the first if the second is pinned
+        movable = np.where(pinned[repeats], repeats - 1, repeats)
+        movable = movable[~pinned[movable]]
+        if len(movable) == 0:
+            break
+        candidates = rng.choice(free, size = (len(movable), tries))
+        for p, row in zip(movable.tolist(), candidates.tolist()):
+            if fits(p):
+                # an earlier swap fixed it
+                continue
+            for q in row:
+                if q == p:
+                    continue
+                a[p], a[q] = a[q], a[p]
+                if fits(p) and fits(q):
+                    order[p], order[q] = order[q], order[p]
+                    break
+                a[p], a[q] = a[q], a[p]
+
+    left = np.count_nonzero(a[1:] == a[:-1])
+    if left:
+        print(f"{left} songs are played right after a song by the same artist, there are too many songs by the same artists (or pinned next to each other) to spread them all")
+    return order
+
+
+def mix_order(pinned, artists = None, seed = None):
+    """
+    Returns a random order of the songs, where the songs that are pinned (an array of bools) keep their position
+    ---------------------------------------
+    pinned = whether every song keeps its position ("behold placering") \n
+    artists = if given, the artist of every song (see artists_of), and no artist is played twice in a row where possible \n
+    seed = a seed or numpy Generator for the same order every time, by default a new random order
+    """
+    rng = np.random.default_rng(seed)
+    pinned = np.asarray(pinned, dtype = bool)
+    order = np.arange(len(pinned))
+    free = np.flatnonzero(~pinned)
+    order[free] = rng.permutation(free)
+    if artists is not None:
+        spread_artists(order, pinned, np.asarray(artists), rng)
+    return order
+
+
+def mix_song_pos(song_csv = "Songs.csv", diff_song_length = False, order = None, seed = None, spread = False):
+    """
+    Mixes up the order of the songs or shoutouts, returns the order used
     ---------------------------------------
     csv: a csv in the format of create_song_csv/shoutout_csv, where a character in the column "behold placering", keeps the song in its original position \n
-    diff_song_length: whether the song_csv contains the column "sluttidspunkt (i sek)" or not
-    """
-    df = pd.read_csv(song_csv, usecols = [5]) if diff_song_length else pd.read_csv(song_csv, usecols = [4], header = None, squeeze = True)
-    l = len(df)
-    mix_loc = list(*np.where(pd.isnull(df)))
-    keep_loc = [i for i in range(l) if i not in mix_loc]
-    order = []
-    perm_mix = np.random.permutation(mix_loc)
-    for i in range(l):
-        if i in keep_loc:
-            order.append(i)
-        else:
-            order.append(perm_mix[0])
-            perm_mix = np.delete(perm_mix, 0)
+    diff_song_length: whether the song_csv contains the column "sluttidspunkt (i sek)" or not \n
+    order: an order to apply instead of mixing, e.g. the order returned by an earlier call \n
+    seed: a seed for the same order every time (see mix_order) \n
+    spread: whether to avoid playing the same artist twice in a row
+    """
+    if order is None:
+        df = pd.read_csv(song_csv, usecols = [5]) if diff_song_length else pd.read_csv(song_csv, usecols = [4], header = None, squeeze = True)
+        artists = artists_of(pd.read_csv(song_csv, usecols = [0], header = None, squeeze = True)) if spread else None
+        order = mix_order(pd.notnull(df), artists, seed)
     
     pd.read_csv(song_csv, header = None).reindex(order).to_csv(song_csv, index = False, header = False)
+    return order
 
 
-def arrange_shoutout_csv(song_csv = "Songs.csv", shoutout_csv = "Shoutouts.csv", diff_song_length = False):
+def arrange_shoutout_csv(song_csv = "Songs.csv", shoutout_csv = "Shoutouts.csv", diff_song_length = False, order = None, seed = None):
     """
-    Arranges the shoutout csv due to the placement in the song csv
+    Arranges the shoutout csv due to the placement in the song csv, returns the order used
+    ---------------------------------------
+    order: an order to apply instead of arranging, e.g. the order returned by an earlier call \n
+    seed: a seed for the same order every time (see arrange_order)
     """
+    if order is not None:
+        pd.read_csv(shoutout_csv, header = None).reindex(order).to_csv(shoutout_csv, index = False, header = False)
+        return order
+
     song_so = pd.read_csv(song_csv, usecols = [4]) if diff_song_length else pd.read_csv(song_csv, usecols = [3], header = None, squeeze = True).values
     shoutout_so = pd.read_csv(shoutout_csv, usecols = [0], header = None, squeeze = True).values
+    order = arrange_order(song_so, shoutout_so, seed)
 
-    missing_so = [t for t in song_so if (t is not np.nan) & (t not in shoutout_so)]
-    if len(missing_so) is not 0:
-        print(f"These shoutouts does not exist in the shoutout csv/sheet: {missing_so}! Please insert the same name in the song sheet as given in the shoutout sheet if the shoutout should follow a specific song.")
+    pd.read_csv(shoutout_csv, header = None).reindex(order).to_csv(shoutout_csv, index = False, header = False)
+    return order
 
-    order = []
-    perm_mix = np.random.permutation([i for i in range(len(song_so)) if shoutout_so[i] not in song_so])
 
-    for i in range(len(song_so)):
-        if song_so[i] in shoutout_so:
-            order.append(*list(*np.where(shoutout_so == song_so[i])))
-        else:
-            order.append(perm_mix[0])
-            perm_mix = np.delete(perm_mix, 0)
+def arrange_order(song_so, shoutout_so, seed = None):
+    """
+    Returns the order of the shoutouts that puts every shoutout named in the "Shoutout" column of the songs before that song,
+    and the other shoutouts in a random order before the other songs
+    ---------------------------------------
+    song_so = the shoutout named by every song, NaN or "" for none \n
+    shoutout_so = the names of the shoutouts \n
+    seed = a seed or numpy Generator for the same order every time, by default a new random order
+    """
+    rng = np.random.default_rng(seed)
+    song_so = np.asarray(pd.Series(song_so, dtype = object).fillna("").astype(str), dtype = str)
+    shoutout_so = np.asarray(pd.Series(shoutout_so, dtype = object).fillna("").astype(str), dtype = str)
 
-    pd.read_csv(shoutout_csv, header = None).reindex(order).to_csv(shoutout_csv, index = False, header = False)
+    # the first shoutout of every name, found by a binary search of the sorted names
+    names, first = np.unique(shoutout_so, return_index = True)
+    found = np.minimum(np.searchsorted(names, song_so), max(len(names) - 1, 0))
+    bound = (song_so != "") & (names[found] == song_so) if len(names) else np.zeros(len(song_so), dtype = bool)
+
+    missing_so = list(dict.fromkeys(song_so[(song_so != "") & ~bound]))
+    if len(missing_so) != 0:
+        print(f"These shoutouts does not exist in the shoutout csv/sheet: {missing_so}! Please insert the same name in the song sheet as given in the shoutout sheet if the shoutout should follow a specific song.")
+
+    # the shoutouts whose name no song asks for are the ones mixed in
+    asked = np.zeros(len(names), dtype = bool)
+    asked[found[bound]] = True
+    unbound = np.flatnonzero(~asked[np.searchsorted(names, shoutout_so)])
+    if len(unbound) < np.count_nonzero(~bound):
+        raise AssertionError(f"There are {len(song_so)} songs but only {len(unbound)} shoutouts for the {np.count_nonzero(~bound)} songs without their own shoutout")
+
+    order = np.empty(len(song_so), dtype = int)
+    order[bound] = first[found[bound]]
+    order[~bound] = rng.permutation(unbound)[:np.count_nonzero(~bound)]
+    return order
 
 
 if __name__ == "__main__":
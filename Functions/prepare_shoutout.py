@@ -1,105 +1,165 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
 import subprocess
-import csv
 import multiprocessing
 
-err = subprocess.Popen(['pip', 'install', 'ffmpeg'], 
-                       stdout=subprocess.DEVNULL, 
-                       stderr=subprocess.PIPE).communicate()[1]
+from Functions.manifest import csv_rows
+from Functions.trace import note, traced
 
-if len(err) != 0:
-    print(err)
-    exit(1)
-
-def prepare_shoutout(input, output, t=-14, trim = False, ss = 0, length = 5):
+@traced("prepare")
+def prepare_shoutout(input, output, t=-14, trim = False, ss = 0, length = 5, cache = None):
     """
     Prepares a shoutout by normalising and more
     ---------------------------------------------
     input = The input file to prepare \n
-    output = The output file name \n
+    output = The output file name, '-' to return the prepared shoutout as raw pcm (see Functions/pcm.py) instead \n
     t = the target volume in LUFS (-70 to -5) \n
     trim = whether or not to trim the shoutout \n
     ss = the position to start the trim at \n
-    length = the length of the shoutout
+    length = the length of the shoutout \n
+    cache = a LoudnessCache (see Functions/cache.py), if the shoutout was measured before only the gain is applied
     """
     print('Preparing', input + '...')
-    # trim
+    
+    from Functions.loudnorm import measure_or_lookup, linear_filter
+    from Functions.pcm import output_args
+    
+    # trim and measure
+    # decode once, measuring with loudnorm (pass 1) while keeping the pcm, unless it was measured before
     if trim:
-        p1 = subprocess.Popen(['ffmpeg',
-                            '-loglevel', 'error',
-                            '-ss', str(ss),
-                            '-i', input, '-t', str(length), '-f', 'wav', '-'],
-                            stdout=subprocess.PIPE)
-        input = '-'
-        
-    # two-pass ebu r128 loudnorm filter
-    # loudnorm pass 1
+        source, decoded, stats = measure_or_lookup(input, t, ss = ss, length = length, cache = cache)
+    else:
+        source, decoded, stats = measure_or_lookup(input, t, cache = cache)
+    
+    # pass 2 applies the measured gain and limits the peaks (see loudnorm.linear_filter)
     p2 = subprocess.Popen(['ffmpeg', '-loglevel', 'error',
-                        '-i', input,
-                        '-pass', '1', '-af', 'loudnorm=I=' + str(t) + ':TP=-1',
-                        '-f', 'wav', '-y', os.devnull],  # generate log in null
+                        *source,
+                        '-af', linear_filter(t, stats),
+                        *output_args(output)],
                         stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE)
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
     
-    # loudnorm pass 2
-    p3 = subprocess.Popen(['ffmpeg', '-loglevel', 'error',
-                        '-i', input,
-                        '-pass', '2', '-af', 'loudnorm=I=' + str(t) + ':TP=-1',
-                        '-f', 'wav', '-y', output],
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE)
+    out, err = p2.communicate(decoded)
+    note(bytes_piped = len(decoded or b'') + len(out), status = p2.returncode)
+    if p2.returncode != 0:
+        # a partly written shoutout would be taken as prepared by the next build
+        if output != '-' and os.path.exists(output):
+            os.remove(output)
+        raise RuntimeError('Could not prepare ' + input + ': ' + err.decode('utf-8', 'replace'))
+    return out # return the raw pcm in case output is '-'
 
-    if trim:
-        trimmed = p1.communicate()[0]
-        p2.communicate(trimmed)
-        p3.communicate(trimmed)[0]
+def prepare_function(engine = "ffmpeg"):
+    """
+    Returns the prepare_shoutout function of an engine, "ffmpeg", "numpy" or "draft" (see Functions/draft.py)
+    """
+    if engine == "ffmpeg":
+        return prepare_shoutout
+    elif engine == "numpy":
+        from Functions.dsp import prepare_shoutout as prepare
+        return prepare
+    elif engine == "draft":
+        from Functions.draft import prepare_shoutout as prepare
+        return prepare
+    raise AssertionError(f"Unknown engine {engine}, choose either 'ffmpeg' or 'numpy'")
 
-    else:
-        p2.communicate()
-        p3.communicate()
+def shoutout_args(i, t = -14, trim_vals = None, window_margin = None):
+    """
+    Returns the arguments after input and output for prepare_shoutout for the i'th shoutout (see prepare_all_shoutouts for the arguments)
+    """
+    if trim_vals is None:
+        return (t, False, None, None)
+    
+    ss = trim_vals.iloc[i-1,0]
+    if window_margin is not None:
+        # the downloaded window starts at max(ss - window_margin, 0)
+        ss = min(float(ss), window_margin)
+    return (t, True, ss, trim_vals.iloc[i-1,1])
 
-def prepare_all_shoutouts(songs_csv, input = "shoutouts", output = "prepared_shoutouts", t = -14, trim_vals = None): 
+def prepare_all_shoutouts(songs_csv, input = "shoutouts", output = "prepared_shoutouts", t = -14, trim_vals = None, window_margin = None, engine = "ffmpeg", rows = None, input_keys = None, keys = None, cache = None, processes = None, coordinator = None, cpu_slots = None): 
     """
     Prepares all shoutouts
     -------------------------
-    songs_csv = csv with the songs (used to find number of songs) \n
+    songs_csv = csv with the songs or a plan Table (used to find number of songs) \n
     input = input folder with shoutouts \n
     output = name of output folder \n
     t = Target volume in LUFS (-70 to -5) \n
-    trim_vals = data frame with start time of SO as first column and length as second
+    trim_vals = data frame with start time of SO as first column and length as second \n
+    window_margin = the margin used when the shoutouts were downloaded as windows (see dl.download_all), None if the full shoutouts were downloaded \n
+    engine = "ffmpeg" to normalise with ffmpeg filters or "numpy" to do it in process (see Functions/dsp.py) \n
+    rows = if given, only these (1-indexed) rows are prepared, their old outputs are removed first \n
+    input_keys = the file name (without .wav) of each row in the input folder, by default the row number \n
+    keys = the file name (without .wav) to write each prepared row to, by default the row number \n
+    cache = a LoudnessCache (see Functions/cache.py) to reuse the loudness measurements of earlier builds from \n
+    processes = the number of shoutouts to prepare at the same time, by default the number of cpus \n
+    coordinator = a Coordinator (see Functions/distributed.py) to prepare the shoutouts on its workers instead of here \n
+    cpu_slots = a semaphore shared with other builds (see Functions/service.py), a shoutout is only prepared while it holds a slot
     """
 
     # input = os.path.join(os.path.curdir, 'shoutouts') if input is None else input
     # output = os.path.join(os.path.curdir, 'prepared_shoutouts') if output is None else output
     
+    from Functions.distributed import prepare_unit, prepare_units
+    from Functions.toolchain import require
+    
+    prepare = prepare_function(engine)
+    if coordinator is None:
+        require("ffmpeg")
+    
     if not os.path.exists(input):
         exit(1)
     
     if not os.path.exists(output):
         os.mkdir(output)
 
-    trim = False if trim_vals is None else True
-    with multiprocessing.Pool() as p:
-        with open(songs_csv, 'rt') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+    release = None if cpu_slots is None else lambda _: cpu_slots.release()
+    units = []
+    results = []
+    outfiles = set()
+    with multiprocessing.Pool(processes if coordinator is None else 1) as p:
+        for i, row in enumerate(csv_rows(songs_csv), 1):
+            
+            if rows is not None and i not in rows:
+                continue
             
-            for i, row in enumerate(reader, 1):
-                
-                infile = os.path.join(input, str(i) + '.wav')
-                outfile = os.path.join(output, str(i) + '.wav')
-                
-                if not os.path.exists(infile):
-                    continue
-                
-                if trim:
-                    p.apply_async(prepare_shoutout, (infile, outfile, t, trim, trim_vals.iloc[i-1,0], trim_vals.iloc[i-1,1]))
-                else:
-                    p.apply_async(prepare_shoutout, (infile, outfile, t, trim))
+            infile = os.path.join(input, (str(i) if input_keys is None else input_keys[i-1]) + '.wav')
+            outfile = os.path.join(output, (str(i) if keys is None else keys[i-1]) + '.wav')
+            
+            if outfile in outfiles:
+                # another row with the same inputs and settings (see manifest.prepare_keys) is already prepared to this file
+                continue
+            outfiles.add(outfile)
+            
+            if rows is not None and os.path.exists(outfile):
+                os.remove(outfile)
+            
+            if not os.path.exists(infile):
+                continue
+            
+            if coordinator is not None:
+                units.append(prepare_unit("shoutout", engine, infile, outfile, shoutout_args(i, t, trim_vals, window_margin)))
+                continue
+            if cpu_slots is not None:
+                cpu_slots.acquire()
+            results.append((infile, p.apply_async(prepare, (infile, outfile, *shoutout_args(i, t, trim_vals, window_margin), cache), callback = release, error_callback = release)))
         
         p.close()
         p.join()
+    
+    failed = []
+    for infile, result in results:
+        try:
+            result.get()
+        except Exception as e:
+            print('Error preparing', infile, file=sys.stderr)
+            print(e, file=sys.stderr)
+            failed.append(infile)
+    if units:
+        failed += prepare_units(coordinator, units)
+    if failed:
+        raise RuntimeError(f"Could not prepare {len(failed)} of the shoutouts, the club would be missing them (see the errors above)")
 
 if __name__ == "__main__":
     from prepare_csv import create_shoutout_csv, create_song_csv
@@ -1,78 +1,87 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
 import subprocess
 import multiprocessing
-import csv
-import pandas as pd
 
-err = subprocess.Popen(['pip', 'install', 'ffmpeg'], 
-                       stdout=subprocess.DEVNULL, 
-                       stderr=subprocess.PIPE).communicate()[1]
+from Functions.manifest import csv_rows
+from Functions.trace import note, traced
 
-if len(err) != 0:
-    print(err)
-    exit(1)
-
-def prepare_track(input, output, ss=0, t=-14, f=3, length = 60):
+@traced("prepare")
+def prepare_track(input, output, ss=0, t=-14, f=3, length = 60, cache = None):
     """
     Prepares a track by normalising, fading and more
     ---------------------------------------------
     input = The input file to prepare
-    output = The output file name
+    output = The output file name, '-' to return the prepared track as raw pcm (see Functions/pcm.py) instead
     ss = the position to start the trim at
     t = the target volume in LUFS (-70 to -5)
     f = the number of seconds to fade
     length = the length of the track to use
+    cache = a LoudnessCache (see Functions/cache.py), if the track was measured before only the gain and fades are applied
     """
     print('Preparing', input + '...')
     
-    # trim
-    p1 = subprocess.Popen(['ffmpeg',
-                           '-loglevel', 'error',
-                           '-ss', str(ss),
-                           '-i', input, '-t', str(length), '-f', 'wav', '-'],
-                          stdout=subprocess.PIPE)
+    from Functions.loudnorm import measure_or_lookup, linear_filter
+    from Functions.pcm import output_args
     
-    # normalize
-    # two-pass ebu r128 loudnorm filter
-    # loudnorm pass 1
-    p2 = subprocess.Popen(['ffmpeg',
-                           '-loglevel', 'error',
-                           '-i', '-',
-                           '-pass', '1', '-af', 'loudnorm=I=' + str(t) + ':TP=-1',
-                           '-f', 'wav', '-y', os.devnull],  # generate log but no other output
-                          stdin=subprocess.PIPE,
-                          stdout=subprocess.PIPE)
+    # trim and measure
+    # decode the window once, measuring it with loudnorm (pass 1) while keeping the pcm, unless it was measured before
+    source, trimmed, stats = measure_or_lookup(input, t, ss = ss, length = length, cache = cache)
     
-    # loudnorm pass 2
-    p3 = subprocess.Popen(['ffmpeg',
-                           '-loglevel', 'error',
-                           '-i', '-',
-                           '-pass', '2', '-af', 'loudnorm=I=' + str(t) + ':TP=-1',
-                           '-f', 'wav', '-'
-                           ],
-                          stdin=subprocess.PIPE,
-                          stdout=subprocess.PIPE)
-    
-    # fade
-    p4 = subprocess.Popen(['ffmpeg',
+    # normalize and fade
+    # pass 2 applies the measured gain and limits the peaks (see loudnorm.linear_filter), followed by the fades in the same filter graph
+    p2 = subprocess.Popen(['ffmpeg',
                            '-loglevel', 'error',
-                           '-i', '-', '-af',
-                           'afade=t=in:ss=0:d=' + str(f) +
+                           *source, '-af',
+                           linear_filter(t, stats) +
+                           ',afade=t=in:ss=0:d=' + str(f) +
                            ',afade=t=out:st=' + str(length - f) + ':d=' + str(f),
-                           '-f', 'wav', '-y', output],
+                           *output_args(output)],
                           stdin=subprocess.PIPE,
-                          stdout=subprocess.PIPE)
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
     
-    trimmed = p1.communicate()[0]
+    out, err = p2.communicate(trimmed)
+    note(bytes_piped = len(trimmed or b'') + len(out), status = p2.returncode)
+    if p2.returncode != 0:
+        # a partly written track would be taken as prepared by the next build
+        if output != '-' and os.path.exists(output):
+            os.remove(output)
+        raise RuntimeError('Could not prepare ' + input + ': ' + err.decode('utf-8', 'replace'))
+    return out # return the raw pcm in case output is '-'
+
+def prepare_function(engine = "ffmpeg"):
+    """
+    Returns the prepare_track function of an engine, "ffmpeg", "numpy" or "draft" (see Functions/draft.py)
+    """
+    if engine == "ffmpeg":
+        return prepare_track
+    elif engine == "numpy":
+        from Functions.dsp import prepare_track as prepare
+        return prepare
+    elif engine == "draft":
+        from Functions.draft import prepare_track as prepare
+        return prepare
+    raise AssertionError(f"Unknown engine {engine}, choose either 'ffmpeg' or 'numpy'")
+
+def track_trim(row, i, length = 60, window_margin = None):
+    """
+    Returns the start and length to trim the track of a csv row to (see prepare_all_tracks for the arguments)
+    """
+    import pandas as pd
+
+    ss_index = 2
     
-    p2.communicate(trimmed)
-    normalized = p3.communicate(trimmed)[0]
+    ss, track_length = (length.iloc[i-1,0], length.iloc[i-1,1]) if isinstance(length, pd.DataFrame) else (row[ss_index], length)
+    if window_margin is not None:
+        # the downloaded window starts at max(ss - window_margin, 0)
+        ss = min(float(ss), window_margin)
     
-    return p4.communicate(normalized)[0] # return stdout in case output is '-'
+    return ss, track_length
 
-def prepare_all_tracks(songs_csv = "klub.csv", input = "tracks", output = "prepared_tracks", t = -14, f = 3, length = 60):
+def prepare_all_tracks(songs_csv = "klub.csv", input = "tracks", output = "prepared_tracks", t = -14, f = 3, length = 60, window_margin = None, engine = "ffmpeg", rows = None, input_keys = None, keys = None, cache = None, processes = None, coordinator = None, cpu_slots = None):
     """
     Prepares all tracks in a folder
     ---------------------------------------
@@ -82,9 +91,23 @@ def prepare_all_tracks(songs_csv = "klub.csv", input = "tracks", output = "prepa
     t = Target volume in LUFS (-70 to -5)
     f = fade duration in seconds
     length = length of song, if specified as a pd data frame with start time as first column and length as second, this will be used 
+    window_margin = the margin used when the tracks were downloaded as windows (see dl.download_all), None if the full tracks were downloaded
+    engine = "ffmpeg" to normalise and fade with ffmpeg filters or "numpy" to do it in process (see Functions/dsp.py)
+    rows = if given, only these (1-indexed) rows are prepared, their old outputs are removed first
+    input_keys = the file name (without .wav) of each row in the input folder, by default the row number
+    keys = the file name (without .wav) to write each prepared row to, by default the row number
+    cache = a LoudnessCache (see Functions/cache.py) to reuse the loudness measurements of earlier builds from
+    processes = the number of tracks to prepare at the same time, by default the number of cpus
+    coordinator = a Coordinator (see Functions/distributed.py) to prepare the tracks on its workers instead of here
+    cpu_slots = a semaphore shared with other builds (see Functions/service.py), a track is only prepared while it holds a slot
     """
     
-    ss_index = 2
+    from Functions.distributed import prepare_unit, prepare_units
+    from Functions.toolchain import require
+    
+    prepare = prepare_function(engine)
+    if coordinator is None:
+        require("ffmpeg")
 
     # input = os.path.join(os.path.curdir, 'tracks') if input is None else input
     # output = os.path.join(os.path.curdir, 'prepared_tracks') if output is None else output
@@ -96,22 +119,50 @@ def prepare_all_tracks(songs_csv = "klub.csv", input = "tracks", output = "prepa
     if not os.path.exists(output):
         os.mkdir(output)
     
-    with multiprocessing.Pool() as p:
-        with open(songs_csv, 'rt') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+    release = None if cpu_slots is None else lambda _: cpu_slots.release()
+    units = []
+    results = []
+    outfiles = set()
+    with multiprocessing.Pool(processes if coordinator is None else 1) as p:
+        for i, row in enumerate(csv_rows(songs_csv), 1):
             
-            for i, row in enumerate(reader, 1):
-                
-                infile = os.path.join(input, str(i) + '.wav')
-                outfile = os.path.join(output, str(i) + '.wav')
-                
-                if not os.path.exists(infile):
-                    continue
-                
-                if isinstance(length, pd.DataFrame):
-                    p.apply_async(prepare_track, (infile, outfile, length.iloc[i-1,0], t, f, length.iloc[i-1,1]))
-                else:
-                    p.apply_async(prepare_track, (infile, outfile, row[2], t, f, length))
+            if rows is not None and i not in rows:
+                continue
+            
+            infile = os.path.join(input, (str(i) if input_keys is None else input_keys[i-1]) + '.wav')
+            outfile = os.path.join(output, (str(i) if keys is None else keys[i-1]) + '.wav')
+            
+            if outfile in outfiles:
+                # another row with the same inputs and settings (see manifest.prepare_keys) is already prepared to this file
+                continue
+            outfiles.add(outfile)
+            
+            if rows is not None and os.path.exists(outfile):
+                os.remove(outfile)
+            
+            if not os.path.exists(infile):
+                continue
+            
+            ss, track_length = track_trim(row, i, length, window_margin)
+            if coordinator is not None:
+                units.append(prepare_unit("track", engine, infile, outfile, (ss, t, f, track_length)))
+                continue
+            if cpu_slots is not None:
+                cpu_slots.acquire()
+            results.append((infile, p.apply_async(prepare, (infile, outfile, ss, t, f, track_length, cache), callback = release, error_callback = release)))
         
         p.close()
         p.join()
+    
+    failed = []
+    for infile, result in results:
+        try:
+            result.get()
+        except Exception as e:
+            print('Error preparing', infile, file=sys.stderr)
+            print(e, file=sys.stderr)
+            failed.append(infile)
+    if units:
+        failed += prepare_units(coordinator, units)
+    if failed:
+        raise RuntimeError(f"Could not prepare {len(failed)} of the tracks, the club would be missing them (see the errors above)")
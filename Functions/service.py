@@ -0,0 +1,221 @@
+import hmac
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8765
+# the secret every request to the api must carry in the TOKEN_HEADER, so a web page (or anyone else) can not queue builds
+TOKEN_ENV = "KLUB_SERVICE_TOKEN"
+TOKEN_HEADER = "X-Klub-Token"
+
+# make_club arguments the service decides, so the builds share the caches and stay within the budgets. The downloader is run
+# as a program, so it is chosen when the service is started rather than by whoever submits a build
+SERVICE_ARGS = {"cache_dir", "incremental", "share_prepared", "cpu_workers", "net_workers", "budget", "trace", "profile", "downloader"}
+# make_club arguments that take over stdout or a port of the process, which the builds running at the same time would fight over
+EXCLUSIVE_ARGS = {"live", "coordinator"}
+
+
+def service_token():
+    # set KLUB_SERVICE_TOKEN to the same secret value for the service and the clients submitting to it
+    token = os.environ.get(TOKEN_ENV)
+    if not token:
+        raise AssertionError(f"Set the {TOKEN_ENV} environment variable to the same secret value for the service and its clients")
+    return token
+
+
+class Budget:
+    """
+    The cpus and downloads shared by the builds running at the same time (see make_klub.make_club's budget): a build running
+    alone uses all of them, and the running builds together never use more. The per host limits are shared as well, so
+    builds downloading from the same host do not add up
+    ---------------------------------------
+    cpus = the number of songs/shoutouts prepared at the same time by all builds together \n
+    net = the number of downloads running at the same time in all builds together
+    """
+
+    def __init__(self, cpus, net):
+        from Functions.downloader import HostLimits
+
+        self.cpus = cpus
+        self.net = net
+        self.cpu_slots = threading.BoundedSemaphore(cpus)
+        self.limits = HostLimits(parallel = net)
+
+
+class BuildService:
+    """
+    Builds clubs from a priority queue, several at a time, without ever asking anything. All builds share the download,
+    loudness and prepared song caches in cache_dir, and the cpu and network budgets (see Budget), so a build running alone
+    uses all of them and the running builds together never use more
+    ---------------------------------------
+    builds = the number of clubs to build at the same time \n
+    cpus = the number of songs/shoutouts prepared at the same time by all builds together, by default the number of cpus \n
+    net = the number of downloads running at the same time in all builds together \n
+    cache_dir = the cache folder shared by the builds (see make_klub.make_club) \n
+    downloader = the youtube-dl executable used by all builds
+    """
+
+    def __init__(self, builds = 2, cpus = None, net = 8, cache_dir = "default", downloader = "youtube-dl"):
+        self.builds = builds
+        self.budget = Budget(cpus or os.cpu_count(), net)
+        self.cache_dir = cache_dir
+        self.downloader = downloader
+        self.queue = queue.PriorityQueue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.threads = []
+
+    def submit(self, club_folder, club_file, priority = 0, **kwargs):
+        """
+        Queues a build of a club and returns its job id. Builds with a higher priority start first, builds with the same
+        priority in the order they were submitted
+        ---------------------------------------
+        club_folder, club_file = see make_klub.make_club \n
+        priority = the priority of the build \n
+        kwargs = the other arguments of make_klub.make_club, except the ones the service decides (see SERVICE_ARGS) and live and coordinator (see EXCLUSIVE_ARGS)
+        """
+        fixed = SERVICE_ARGS.intersection(kwargs)
+        if fixed:
+            raise AssertionError(f"The service decides {', '.join(sorted(fixed))} for all builds")
+        exclusive = EXCLUSIVE_ARGS.intersection(kwargs)
+        if exclusive:
+            raise AssertionError(f"The builds of the service can not use {', '.join(sorted(exclusive))}, run such a build with make_club on its own")
+        if not os.path.isdir(club_folder):
+            raise AssertionError(f"There is no club folder at {club_folder}")
+
+        with self.lock:
+            job_id = next(self.ids)
+            self.jobs[job_id] = {"id": job_id, "club_folder": club_folder, "club_file": club_file, "priority": priority,
+                                 "args": kwargs, "status": "queued", "submitted": time.time(), "started": None, "finished": None, "error": None}
+        self.queue.put((-priority, job_id))
+        return job_id
+
+    def status(self, job_id = None):
+        """
+        Returns a job, or all jobs if job_id is None
+        """
+        with self.lock:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            if job_id not in self.jobs:
+                raise KeyError(job_id)
+            return dict(self.jobs[job_id])
+
+    def _update(self, job_id, **changes):
+        with self.lock:
+            self.jobs[job_id].update(changes)
+
+    def _build(self, job_id):
+        from make_klub import make_club
+
+        job = self.status(job_id)
+        self._update(job_id, status = "running", started = time.time())
+        print("Building", job["club_folder"], "(job " + str(job_id) + ")")
+        try:
+            make_club(job["club_folder"], job["club_file"], cache_dir = self.cache_dir, incremental = True, share_prepared = self.cache_dir is not None,
+                      budget = self.budget, downloader = self.downloader, **job["args"])
+            self._update(job_id, status = "done", finished = time.time())
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            self._update(job_id, status = "failed", finished = time.time(), error = repr(e))
+
+    def _worker(self):
+        while True:
+            _, job_id = self.queue.get()
+            if job_id == 0:
+                return
+            self._build(job_id)
+
+    def start(self):
+        """
+        Starts building the queued clubs in the background
+        """
+        for _ in range(self.builds):
+            thread = threading.Thread(target = self._worker, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stops when the running builds are done, the queued builds are not started
+        """
+        for _ in self.threads:
+            # job 0 sorts before every job and stops a worker
+            self.queue.put((-float("inf"), 0))
+        for thread in self.threads:
+            thread.join()
+
+    def serve(self, host = "127.0.0.1", port = DEFAULT_PORT):
+        """
+        Starts building and serves the json api until interrupted:
+        POST /jobs with {"club_folder": ..., "club_file": ..., "priority": ..., <make_club arguments>} queues a build,
+        GET /jobs lists all jobs and GET /jobs/<id> returns one. Every request must carry the secret KLUB_SERVICE_TOKEN
+        in the X-Klub-Token header, and a POST must be sent as application/json
+        """
+        service = self
+        token = service_token().encode("utf-8")
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, code, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def authorized(self):
+                if hmac.compare_digest(self.headers.get(TOKEN_HEADER, "").encode("utf-8"), token):
+                    return True
+                self.reply(401, {"error": f"Missing or wrong {TOKEN_HEADER} header"})
+                return False
+
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                parts = self.path.strip("/").split("/")
+                if parts == ["jobs"]:
+                    return self.reply(200, service.status())
+                if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                    try:
+                        return self.reply(200, service.status(int(parts[1])))
+                    except KeyError:
+                        return self.reply(404, {"error": "No job " + parts[1]})
+                self.reply(404, {"error": "Unknown path " + self.path})
+
+            def do_POST(self):
+                if not self.authorized():
+                    return
+                if self.path.strip("/") != "jobs":
+                    return self.reply(404, {"error": "Unknown path " + self.path})
+                if self.headers.get_content_type() != "application/json":
+                    # a form or text/plain post from a web page is sent without asking, json is not
+                    return self.reply(415, {"error": "Jobs must be sent as application/json"})
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    job_id = service.submit(body.pop("club_folder"), body.pop("club_file"), **body)
+                except (KeyError, TypeError, ValueError, AssertionError) as e:
+                    return self.reply(400, {"error": str(e)})
+                self.reply(201, service.status(job_id))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.start()
+        server = ThreadingHTTPServer((host, port), Handler)
+        print(f"Build service listening on http://{host}:{port}, {self.builds} builds at a time", file = sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print("Waiting for the running builds...", file = sys.stderr)
+            self.stop()
@@ -0,0 +1,121 @@
+import os
+import random
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from Functions.manifest import csv_rows
+
+
+class Stream:
+    """
+    Makes every song/shoutout in memory, reading only its window from the source and returning the prepared pcm, so the club
+    is encoded without writing a single wav. Only a few segments are held at a time, as the next is started when the encoder
+    takes one
+    ---------------------------------------
+    workers = the number of songs/shoutouts to make at the same time, by default the number of cpus \\n
+    ahead = the number of segments to make ahead of the encoder, by default twice the number of workers \\n
+    retries = the number of times a song/shoutout whose source could not be read is retried \\n
+    backoff = the seconds to wait before the first retry, doubled for every following retry \\n
+    downloader = the youtube-dl executable used to find the media url of links, e.g. a stand-in for offline tests \\n
+    cpu_slots = a semaphore shared with other builds (see Functions/service.py), a segment is only made while it holds a slot
+    """
+
+    def __init__(self, workers = None, ahead = None, retries = 3, backoff = 1, downloader = "youtube-dl", cpu_slots = None):
+        self.workers = workers or os.cpu_count()
+        self.ahead = ahead or 2 * self.workers
+        self.retries = retries
+        self.backoff = backoff
+        self.downloader = downloader
+        self.cpu_slots = cpu_slots
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.failures = []
+        # the media urls of the links resolved so far, by link
+        self.urls = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown()
+
+    def resolve(self, link):
+        """
+        Returns the media url of a link, resolved once for all the segments cut from it (e.g. several shoutouts from one video)
+        """
+        from Functions.dl import resolve_url
+
+        if link not in self.urls:
+            self.urls[link] = resolve_url(link, self.downloader)
+        return self.urls[link]
+
+    def make(self, segment):
+        """
+        Makes a segment (see track_segments), read from its local source file or else its link, and returns its raw pcm (see Functions/pcm.py), or None if it failed
+        """
+        from Functions.downloader import host_of
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+            try:
+                # ffmpeg reads (and seeks in) the media url itself, so only the window is fetched and decoded
+                source = segment["source"] if segment["link"] is None else self.resolve(segment["link"])
+                if self.cpu_slots is None:
+                    return segment["prepare"](source, '-', *segment["args"])
+                with self.cpu_slots:
+                    return segment["prepare"](source, '-', *segment["args"])
+            except (RuntimeError, OSError, subprocess.SubprocessError) as e:
+                # a failed ffmpeg, a dropped connection or a timeout. The url may have expired, it is resolved again for the retry
+                self.urls.pop(segment["link"], None)
+                error = str(e).strip().splitlines()
+
+        self.failures.append({"row": segment["row"], "name": segment["name"], "link": segment["link"], "host": host_of(segment["link"] or ""), "attempts": self.retries + 1,
+                              "error": error[-1] if error else ""})
+        return None
+
+    def run(self, segments):
+        """
+        Yields a future of the pcm of every segment in order, see combine.encode
+        """
+        pending = deque()
+        for segment in segments:
+            pending.append(self.pool.submit(self.make, segment))
+            if len(pending) > self.ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def track_segments(songs_csv, t = -14, f = 3, length = 60, engine = "ffmpeg", excerpt = None):
+    """
+    Returns the segment of every song for Stream.run (see prepare_track.prepare_all_tracks for the arguments). With the
+    "draft" engine, excerpt is passed on to draft.prepare_track
+    """
+    from Functions.prepare_track import prepare_function, track_trim
+
+    prepare = prepare_function(engine)
+    segments = []
+    for i, row in enumerate(csv_rows(songs_csv), 1):
+        ss, track_length = track_trim(row, i, length)
+        args = (ss, t, f, track_length) if excerpt is None else (ss, t, f, track_length, None, excerpt)
+        segments.append({"row": i, "name": row[0], "link": row[1], "source": None, "prepare": prepare, "args": args})
+    return segments
+
+
+def shoutout_segments(shoutout_csv, input, n, t = -14, trim_vals = None, engine = "ffmpeg", cache = None):
+    """
+    Returns the segment of every shoutout for Stream.run. If shoutout_csv is None the shoutouts are read from
+    <input>/1.wav ... <input>/n.wav (see prepare_shoutout.prepare_all_shoutouts for the other arguments)
+    """
+    from Functions.prepare_shoutout import prepare_function, shoutout_args
+
+    prepare = prepare_function(engine)
+    if shoutout_csv is None:
+        # own shoutouts are local files, so their loudness can be cached
+        return [{"row": i, "name": str(i), "link": None, "source": os.path.join(input, str(i) + '.wav'), "prepare": prepare,
+                 "args": (*shoutout_args(i, t, trim_vals), cache)} for i in range(1, n + 1)]
+
+    return [{"row": i, "name": row[0], "link": row[1], "source": None, "prepare": prepare, "args": shoutout_args(i, t, trim_vals)}
+            for i, row in enumerate(csv_rows(shoutout_csv)[:n], 1)]
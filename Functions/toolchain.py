@@ -0,0 +1,96 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+
+# the argument that makes a tool print its version
+VERSION_ARGS = {"ffmpeg": "-version", "ffprobe": "-version", "youtube-dl": "--version"}
+# the oldest versions known to work (ffmpeg 4 has every filter used, e.g. loudnorm and alimiter)
+MINIMUM_VERSIONS = {"ffmpeg": (4,), "ffprobe": (4,)}
+INSTALL_HINTS = {"ffmpeg": "sudo apt install ffmpeg, see setup.sh", "ffprobe": "it comes with ffmpeg",
+                 "youtube-dl": "python -m pip install youtube_dl, see setup.sh"}
+
+CACHE_FILE = "toolchain.json"
+
+# the tools probed by this process, by (tool, path, modification time)
+probed = {}
+
+
+def parse_version(text):
+    """
+    Returns the first version number (e.g. (4, 4, 2) of "ffmpeg version 4.4.2-0ubuntu0") in text as a tuple, or None
+    """
+    match = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", text)
+    if match is None:
+        return None
+    return tuple(int(v) for v in match.groups() if v is not None)
+
+
+def ask_version(path, tool):
+    """
+    Runs the tool to ask for its version, returns the version as a tuple or None if it could not be read
+    """
+    try:
+        out = subprocess.run([path, VERSION_ARGS[tool]], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, timeout = 30).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    lines = out.decode("utf-8", "replace").splitlines()
+    return parse_version(lines[0]) if lines else None
+
+
+def cached_version(name, path, mtime, cache_dir):
+    # the version from the cache if the same binary was probed before with this PATH, otherwise asked and added to the cache
+    if cache_dir is None:
+        return ask_version(path, name)
+    from Functions.cache import DEFAULT_CACHE_DIR, locked_json
+
+    cache_file = os.path.join(DEFAULT_CACHE_DIR if cache_dir == "default" else cache_dir, CACHE_FILE)
+    key = name + " " + os.environ.get("PATH", "")
+    try:
+        with open(cache_file, "rt") as f:
+            entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        entry = None
+    if entry is not None and entry["path"] == path and entry["mtime"] == mtime:
+        return None if entry["version"] is None else tuple(entry["version"])
+
+    version = ask_version(path, name)
+    os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+    with locked_json(cache_file) as cache:
+        cache[key] = {"path": path, "mtime": mtime, "version": version}
+    return version
+
+
+def probe(tool, cache_dir = "default"):
+    """
+    Finds a tool on the PATH and checks its version, returns (path, version). The version is only asked for once per binary:
+    it is kept by the process and in <cache_dir>/toolchain.json by PATH, so it is asked again only when the PATH or the
+    binary (its modification time) changes
+    ---------------------------------------
+    tool = the name of the tool (see VERSION_ARGS) or the path of a stand-in, which is only checked to exist \n
+    cache_dir = the folder of the cache, "default" uses ~/.cache/klub-100-maker and None only keeps the result in the process
+    """
+    path = shutil.which(tool)
+    if path is None:
+        hint = INSTALL_HINTS.get(tool)
+        raise AssertionError(f"{tool} was not found on the PATH" + (f", please install it ({hint})" if hint else ""))
+    name = os.path.basename(tool)
+    if name not in VERSION_ARGS:
+        return path, None
+
+    mtime = os.stat(path).st_mtime_ns
+    if (name, path, mtime) not in probed:
+        probed[(name, path, mtime)] = cached_version(name, path, mtime, cache_dir)
+    version = probed[(name, path, mtime)]
+    minimum = MINIMUM_VERSIONS.get(name)
+    if minimum is not None and version is not None and version < minimum:
+        raise AssertionError(f"{tool} {'.'.join(map(str, version))} at {path} is too old, version {'.'.join(map(str, minimum))} or newer is needed")
+    return path, version
+
+
+def require(*tools, cache_dir = "default"):
+    """
+    Probes tools (see probe) before they are used, so a missing or too old tool is reported before anything is made
+    """
+    return {tool: probe(tool, cache_dir) for tool in tools}
@@ -0,0 +1,127 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# the folder spans are written to, set by start() and inherited by the pool workers and other processes of a build
+TRACE_DIR_ENV = "KLUB_TRACE_DIR"
+
+# the args of the open spans, a context variable so threads and asyncio tasks (the downloads) each have their own
+_stack = ContextVar("stack", default = ())
+_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get(TRACE_DIR_ENV) is not None
+
+
+def start(path):
+    """
+    Starts tracing to the chrome trace file path (see collect). Every process of the build writes its spans to
+    <path>.d/<pid>.jsonl, so spans from pool workers are recorded too
+    """
+    folder = path + ".d"
+    os.makedirs(folder, exist_ok = True)
+    for f in os.listdir(folder):
+        os.remove(os.path.join(folder, f))
+    os.environ[TRACE_DIR_ENV] = folder
+
+
+def _cpu(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _write(event):
+    path = os.path.join(os.environ[TRACE_DIR_ENV], str(os.getpid()) + ".jsonl")
+    with _lock, open(path, "a") as f:
+        f.write(json.dumps(event) + "\n")
+
+
+@contextmanager
+def span(name, cat = "stage", **args):
+    """
+    Records a span with its wall time, the cpu time of the thread and of the child processes (ffmpeg, youtube-dl) that
+    finished during it, and args. Inside the span, note() adds more args, e.g. the bytes piped or the exit status.
+    Does nothing unless tracing was started. Child cpu time is per process, so spans running at the same time in threads
+    of one process share it
+    """
+    if not enabled():
+        yield
+        return
+
+    args = dict(args)
+    token = _stack.set(_stack.get() + (args,))
+    t0, thread0, children0 = time.time(), _cpu(resource.RUSAGE_THREAD), _cpu(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    except BaseException as e:
+        args.setdefault("status", type(e).__name__)
+        raise
+    finally:
+        _stack.reset(token)
+        args.update(cpu = round(_cpu(resource.RUSAGE_THREAD) - thread0, 4), child_cpu = round(_cpu(resource.RUSAGE_CHILDREN) - children0, 4))
+        _write({"name": name, "cat": cat, "ph": "X", "ts": int(t0 * 1e6), "dur": int((time.time() - t0) * 1e6),
+                "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+
+def note(**args):
+    """
+    Adds args to the innermost open span, e.g. note(bytes_piped = n, status = process.returncode)
+    """
+    stack = _stack.get()
+    if stack:
+        for k, v in args.items():
+            stack[-1][k] = stack[-1].get(k, 0) + v if k == "bytes_piped" else v
+
+
+def traced(cat):
+    """
+    Decorator recording a span for every call of a per-item function, named by the function and its first argument (the input file)
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(function.__name__, cat, input = str(args[0]) if args else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collect(path):
+    """
+    Merges the spans of all processes into a chrome trace (open it in chrome://tracing or https://ui.perfetto.dev),
+    stops tracing and returns the events
+    """
+    folder = os.environ.pop(TRACE_DIR_ENV, path + ".d")
+    events = []
+    if os.path.isdir(folder):
+        for f in sorted(os.listdir(folder)):
+            with open(os.path.join(folder, f), "rt") as lines:
+                events += [json.loads(line) for line in lines if line.strip()]
+            os.remove(os.path.join(folder, f))
+        os.rmdir(folder)
+
+    events.sort(key = lambda e: e["ts"])
+    with open(path, "wt") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return events
+
+
+def summary(events, n = 5):
+    """
+    Prints the time spent in every stage and the slowest items
+    """
+    print("Time per stage:")
+    for e in [e for e in events if e["cat"] == "stage"]:
+        print(f"  {e['name']:<24} {e['dur'] / 1e6:8.2f} s")
+
+    items = sorted([e for e in events if e["cat"] != "stage"], key = lambda e: -e["dur"])
+    if items:
+        print(f"Slowest of {len(items)} items:")
+        for e in items[:n]:
+            print(f"  {e['name']:<24} {e['dur'] / 1e6:8.2f} s  {e['args'].get('input') or e['args'].get('item', '')}")
@@ -0,0 +1,134 @@
+import datetime
+import json
+import os
+
+# the sheets of a club are read from the workbook together, parsed sheets are kept by the process and in the cache
+parsed = {}
+
+
+def cell_value(cell):
+    # as pandas reads a cell (whole numbers as ints, empty cells as ""), with dates and times as text so the rows can be cached as json
+    from openpyxl.cell.cell import TYPE_ERROR
+
+    if cell.value is None:
+        return ""
+    if cell.data_type == TYPE_ERROR:
+        return float("nan")
+    if isinstance(cell.value, float) and cell.value.is_integer():
+        return int(cell.value)
+    if isinstance(cell.value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+        return str(cell.value)
+    return cell.value
+
+
+def parse_workbook(file_name):
+    """
+    Returns the rows of every sheet of an xlsx as {sheet: rows}, with the workbook opened once in read-only mode, which
+    streams the rows instead of loading the whole workbook
+    """
+    from openpyxl import load_workbook
+
+    book = load_workbook(file_name, read_only = True, data_only = True)
+    try:
+        sheets = {}
+        for sheet in book.worksheets:
+            # the dimensions saved in the file can be wrong, the rows are read until the last one with data
+            sheet.reset_dimensions()
+            rows = []
+            for row in sheet.iter_rows():
+                values = [cell_value(cell) for cell in row]
+                while values and values[-1] == "":
+                    values.pop()
+                rows.append(values)
+            while rows and not rows[-1]:
+                rows.pop()
+            width = max((len(row) for row in rows), default = 0)
+            sheets[sheet.title] = [row + [""] * (width - len(row)) for row in rows]
+    finally:
+        book.close()
+    return sheets
+
+
+def read_workbook(file_name, cache_dir = None):
+    """
+    Returns the rows of every sheet of an xlsx (see parse_workbook). A workbook is parsed once per process, and with a cache
+    once per content: the parsed sheets are kept in <cache_dir>/workbooks by the hash of the file, which is looked up by its
+    path, modification time and size so an unchanged workbook is not even read
+    ---------------------------------------
+    file_name = the xlsx \n
+    cache_dir = the folder of the cache, "default" uses ~/.cache/klub-100-maker and None only keeps the sheets in the process
+    """
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    stamp = (path, stat.st_mtime_ns, stat.st_size)
+    if stamp in parsed:
+        return parsed[stamp]
+    if cache_dir is None:
+        parsed[stamp] = parse_workbook(path)
+        return parsed[stamp]
+
+    from Functions.cache import DEFAULT_CACHE_DIR, file_hash, locked_json
+
+    folder = os.path.join(DEFAULT_CACHE_DIR if cache_dir == "default" else cache_dir, "workbooks")
+    os.makedirs(folder, exist_ok = True)
+    index_file = os.path.join(folder, "index.json")
+    try:
+        with open(index_file, "rt") as f:
+            entry = json.load(f).get(path)
+    except (OSError, ValueError):
+        entry = None
+
+    if entry is not None and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        digest = entry["hash"]
+    else:
+        digest = file_hash(path)
+        with locked_json(index_file) as index:
+            index[path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": digest}
+
+    cached = os.path.join(folder, digest + ".json")
+    sheets = None
+    if os.path.exists(cached):
+        try:
+            with open(cached, "rt") as f:
+                sheets = json.load(f)
+        except ValueError:
+            sheets = None
+    if sheets is None:
+        print("Reading", file_name + "...")
+        sheets = parse_workbook(path)
+        tmp = cached + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump(sheets, f)
+        os.replace(tmp, cached)
+
+    parsed[stamp] = sheets
+    return sheets
+
+
+def check_columns(frame, columns, where):
+    """
+    Raises if columns are missing in a data frame read from where (e.g. a sheet)
+    """
+    missing = [c for c in columns if c not in frame.columns]
+    if missing:
+        raise AssertionError(f"The columns {missing} are missing in {where}, please use the headers of sheet_template.xlsx")
+
+
+def read_sheet(file_name, sheet, columns, cache_dir = None):
+    """
+    Returns the columns of a sheet of an xlsx as a data frame without the empty rows, as pd.read_excel(file_name, sheet_name = sheet,
+    usecols = columns).dropna(how = "all") would, from the workbook read once (see read_workbook)
+    ---------------------------------------
+    columns = the headers of the columns, which must all be in the sheet
+    """
+    import pandas as pd
+    from pandas.io.parsers import TextParser
+
+    sheets = read_workbook(file_name, cache_dir)
+    if sheet not in sheets:
+        raise AssertionError(f'There is no sheet called "{sheet}" in {file_name}, only {list(sheets)}')
+    rows = sheets[sheet]
+    # the same parser pd.read_excel uses, so the numbers, empty cells and headers are read the same way
+    frame = TextParser(rows, header = 0).read() if rows else pd.DataFrame()
+    check_columns(frame, columns, f'the sheet "{sheet}" of {file_name}')
+    return frame.loc[:, columns].dropna(how = "all")
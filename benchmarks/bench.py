@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks of making a club, runnable without network access.
+
+Synthetic sources (tones, noise, silence in different sample rates and codecs) are generated with ffmpeg and
+"downloaded" with fake_youtube_dl.py. Every stage runs in its own process, so its wall time, cpu time (including
+ffmpeg and pool workers), peak rss and the bytes it writes are measured on their own. The results are compared to
+baseline.json, and regressions beyond the tolerance make the run fail. Before the clubs are made, the loudness
+measurement and preparation of the numpy engine are checked against ffmpeg (see check_dsp), and windows are fetched from a
+source served over http (see check_windows) and the retries of failed downloads are checked (see check_retries). These
+checks, and the gapless joins of a club encoded in chunks (see check_joined), can also be run on their own with --checks.
+
+    python benchmarks/bench.py                          # 10, 100 and 1000 songs, all stages
+    python benchmarks/bench.py --sizes 10 --stages download_all prepare_all_tracks
+    python benchmarks/bench.py --sizes 10 100 --save-baseline
+    python benchmarks/bench.py --orders 100 10000 1000000    # only the shuffling of the songs and shoutouts, in memory
+    python benchmarks/bench.py --checks dsp                  # only the checks, nothing is benchmarked
+"""
+import argparse
+import csv
+import functools
+import http.server
+import json
+import os
+import platform
+import re
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FAKE_DL = os.path.join(HERE, "fake_youtube_dl.py")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+ORDER_STAGES = ["mix_order", "mix_order_spread", "arrange_order"]
+# the checks run before the clubs are made (see run_stage), not measured
+CHECKS = ["dsp", "windows", "retries"]
+# the stages that make the club check_joined is run on, and its number of songs when it is run on its own
+JOINED_STAGES = ["create_song_csv", "mix_song_pos", "shoutout_csv", "download_all", "prepare_all_tracks", "prepare_all_shoutouts", "combine", "combine_chunked"]
+JOINED_SONGS = 5
+STAGES = ["create_song_csv", "mix_song_pos", "preflight", "download_all", "prepare_all_tracks", "prepare_all_shoutouts", "combine", "combine_chunked", "make_club", "draft", "distributed"]
+
+SOURCE_LENGTH = 90
+
+# name, lavfi source, sample rate, channels, encoder arguments, extension
+SOURCES = [
+    ("tone", "sine=frequency=440", 44100, 2, ["-c:a", "libmp3lame", "-b:a", "192k"], "mp3"),
+    ("tone_48k", "sine=frequency=1000", 48000, 2, ["-c:a", "aac", "-b:a", "128k"], "m4a"),
+    ("white_noise", "anoisesrc=color=white:amplitude=0.3", 44100, 1, ["-c:a", "flac"], "flac"),
+    ("pink_noise", "anoisesrc=color=pink:amplitude=0.6", 22050, 2, ["-c:a", "libvorbis"], "ogg"),
+    ("tremolo", "aevalsrc=0.5*sin(2*PI*220*t)*(0.6+0.4*sin(2*PI*0.5*t))", 32000, 1, ["-c:a", "pcm_s16le"], "wav"),
+    ("opus", "sine=frequency=330", 48000, 2, ["-c:a", "libopus", "-b:a", "96k"], "opus"),
+    ("silence", "anullsrc=channel_layout=stereo", 44100, 2, ["-c:a", "pcm_s16le"], "wav"),
+]
+
+# name and lavfi source of the signals the numpy engine is checked against ffmpeg with (see check_dsp)
+DSP_SOURCES = [
+    ("pink_noise", "anoisesrc=color=pink:amplitude=0.3:sample_rate=44100"),
+    ("brown_noise", "anoisesrc=color=brown:amplitude=0.5:sample_rate=48000"),
+    ("sine", "sine=frequency=997:sample_rate=44100"),
+    ("two_tones", "aevalsrc=0.95*sin(2*PI*3000*t)|0.9*sin(2*PI*5000*t+1):s=44100"),
+    # a quiet tone with loud bursts, brought to the target it peaks above the ceiling so the limiter is used
+    ("bursts", "aevalsrc=0.05*sin(2*PI*200*t)+0.9*sin(2*PI*1000*t)*lt(mod(t\\,2)\\,0.02):s=44100"),
+]
+DSP_LENGTH = 20
+
+# the length of the source the windows are fetched from (see check_windows), and the (start, length) of every window. The
+# first two are fetched in one pass, the last on its own
+WINDOW_SOURCE_LENGTH = 300
+WINDOW_SAMPLE_RATE = 22050
+WINDOWS = [(10, 5), (14, 5), (200, 5)]
+
+
+def generate_sources(folder):
+    """
+    Generates the synthetic sources in folder (once), returns their paths
+    """
+    os.makedirs(folder, exist_ok = True)
+    paths = []
+    for name, source, sr, channels, codec, ext in SOURCES:
+        path = os.path.join(folder, name + "." + ext)
+        if not os.path.exists(path):
+            subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", source + ":sample_rate=" + str(sr),
+                            "-t", str(SOURCE_LENGTH), "-ac", str(channels), *codec, "-y", path], check = True)
+        paths.append(path)
+    return paths
+
+
+def write_club(folder, n, sources):
+    """
+    Writes the song and shoutout sheets (as csv's) of a club with n songs. Every row gets its own link (a symlink to one
+    of the sources) so no two rows share a download
+    """
+    links = os.path.join(folder, "links")
+    os.makedirs(links, exist_ok = True)
+
+    def link(kind, i):
+        source = sources[i % len(sources)]
+        path = os.path.join(links, kind + str(i) + os.path.splitext(source)[1])
+        if not os.path.lexists(path):
+            os.symlink(source, path)
+        return path
+
+    with open(os.path.join(folder, "songs_sheet.csv"), "wt", newline = "") as f:
+        w = csv.writer(f)
+        w.writerow(["Sang - Kunstner", "link", "starttidspunkt (i sek)", "Shoutout", "behold placering"])
+        for i in range(n):
+            # every 10th song has its own shoutout and every 20th keeps its position
+            w.writerow(["song " + str(i) + " - artist " + str(i % 37), link("song", i), i % 25,
+                        "shoutout " + str(i) if i % 10 == 0 else "", "x" if i % 20 == 0 else ""])
+
+    with open(os.path.join(folder, "shoutouts_sheet.csv"), "wt", newline = "") as f:
+        w = csv.writer(f)
+        w.writerow(["Shoutout titel", "link", "starttidspunkt (i sek)", "sluttidspunkt (i sek)"])
+        for i in range(n):
+            w.writerow(["shoutout " + str(i), link("shoutout", i), i % 60, i % 60 + 2 + i % 4])
+
+
+def time_orders(n, seed = 0):
+    """
+    Times the shuffling of a catalog of n songs and shoutouts in memory (see prepare_csv.mix_order and arrange_order), with
+    the same pins, artists and shoutouts as write_club. Returns the results of every stage in ORDER_STAGES
+    """
+    import resource
+    import numpy as np
+    sys.path.insert(0, ROOT)
+    from Functions.prepare_csv import arrange_order, artists_of, mix_order
+
+    names = np.array(["song " + str(i) + " - artist " + str(i % 37) for i in range(n)], dtype = object)
+    shoutouts = np.array(["shoutout " + str(i) for i in range(n)], dtype = object)
+    song_so = np.where(np.arange(n) % 10 == 0, shoutouts, "")
+    pinned = np.arange(n) % 20 == 0
+
+    def timed(f, *args):
+        start, cpu = time.time(), time.process_time()
+        result = f(*args)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return result, {"wall": round(time.time() - start, 3), "cpu": round(time.process_time() - cpu, 3), "peak_rss_mb": round(rss, 1), "written_mb": 0}
+
+    results = {}
+    order, results["mix_order"] = timed(mix_order, pinned, None, seed)
+    order, results["mix_order_spread"] = timed(lambda: mix_order(pinned, artists_of(names), seed))
+    shoutout_order, results["arrange_order"] = timed(arrange_order, song_so[order], shoutouts, seed)
+
+    # the pinned songs stay, every song is right after its own shoutout and the artists are spread
+    artists = artists_of(names)[order]
+    if not (order[pinned] == np.flatnonzero(pinned)).all() or (artists[1:] == artists[:-1]).any():
+        raise AssertionError("The songs were not mixed as asked")
+    asked = song_so[order] != ""
+    if not (shoutouts[shoutout_order][asked] == song_so[order][asked]).all() or len(set(shoutout_order.tolist())) != n:
+        raise AssertionError("The shoutouts were not arranged as asked")
+    return results
+
+
+def decode(path):
+    """
+    Decodes an audio file to a (samples, channels) array of 16 bit values
+    """
+    import numpy as np
+
+    out = subprocess.run(["ffmpeg", "-loglevel", "error", "-i", path, "-f", "s16le", "-"], stdout = subprocess.PIPE, check = True).stdout
+    return np.frombuffer(out, dtype = "<i2").reshape(-1, 2).astype(np.float64)
+
+
+def check_joined(folder, n, max_loss = 6):
+    """
+    Checks that the club encoded in chunks decodes to the same number of samples as the serial encode, and that in every second
+    it is about as close to the prepared songs and shoutouts as the serial encode, so there are no gaps or clicks at the joins
+    """
+    import numpy as np
+    from Functions.pcm import iter_pcm
+
+    source = b""
+    for i in range(1, n + 1):
+        for kind in ["prepared_shoutouts", "prepared_songs"]:
+            path = os.path.join(folder, kind, str(i) + ".wav")
+            if os.path.exists(path):
+                source += b"".join(iter_pcm(path))
+    source = np.frombuffer(source, dtype = "<i2").reshape(-1, 2).astype(np.float64)
+
+    serial, chunked = decode(os.path.join(folder, "klub.mp3")), decode(os.path.join(folder, "klub_chunked.mp3"))
+    # the padding ffmpeg writes for a serial encode can be a few samples off, the chunked encode must be exact
+    if len(chunked) != len(source) or abs(len(serial) - len(source)) >= 1152:
+        raise AssertionError(f"The chunked encode has {len(chunked)} samples, the serial encode {len(serial)} and the source {len(source)}")
+
+    # the coding error of every second, a gap or click at a join makes the error of its second much larger than in the serial encode.
+    # Errors below -60 dBFS (about 32 steps) count as that much, so the codec noise of a silent second does not count as a click
+    second = 44100
+    m = len(source) // second * second
+    floor = second * 2 * 32 ** 2
+    def error(x):
+        return ((x[:m] - source[:m]) ** 2).reshape(-1, second * 2).sum(axis = 1)
+    loss = 10 * np.log10((error(chunked) + floor) / (error(serial) + floor))
+    if len(loss) and loss.max() > max_loss:
+        raise AssertionError(f"The chunked encode is {loss.max():.1f} dB worse than the serial encode at {np.argmax(loss)} s")
+
+
+def ebur128(path):
+    """
+    Returns the integrated loudness (LUFS) and the true peak (dBTP) of an audio file as measured by ffmpeg's ebur128 filter
+    """
+    err = subprocess.run(["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-af", "ebur128=peak=true", "-f", "null", "-"],
+                         stderr = subprocess.PIPE, check = True).stderr.decode("utf-8", "replace")
+    summary = err[err.rindex("Summary:"):]
+    return float(re.search(r"I:\s+(-?[\d.]+) LUFS", summary).group(1)), float(re.search(r"Peak:\s+(-?[\d.]+) dBFS", summary).group(1))
+
+
+def check_dsp(folder, t = -14, tp = -1, tolerance = 0.2, max_deficit = 6):
+    """
+    Checks that the numpy engine (see Functions/dsp.py) measures and prepares like ffmpeg: the integrated loudness and true
+    peak it measures must be within tolerance of ebur128, and a song it prepares must be as loud and peak as high as the same
+    song prepared with ffmpeg (see prepare_track.prepare_track), both measured with ebur128. The limiters of the two engines
+    are not the same, so a song that the limiter is used on is checked to stay below the true peak ceiling and, prepared by
+    either engine, to be at most max_deficit LU below the target and not above it
+    """
+    from Functions import dsp
+    from Functions.prepare_track import prepare_track
+
+    os.makedirs(folder, exist_ok = True)
+    for name, source in DSP_SOURCES:
+        path = os.path.join(folder, name + ".wav")
+        subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", source, "-t", str(DSP_LENGTH), "-ac", "2", "-y", path], check = True)
+
+        x = dsp.decode(path)
+        loudness, peak = dsp.integrated_loudness(x), dsp.true_peak(x)
+        expected = ebur128(path)
+        if abs(loudness - expected[0]) > tolerance or abs(peak - expected[1]) > tolerance:
+            raise AssertionError(f"The numpy engine measures {name} at {loudness:.2f} LUFS and {peak:.2f} dBTP, ffmpeg at {expected[0]} LUFS and {expected[1]} dBTP")
+
+        prepared = {}
+        for engine, prepare in [("numpy", dsp.prepare_track), ("ffmpeg", prepare_track)]:
+            prepared[engine] = os.path.join(folder, name + "_" + engine + ".wav")
+            prepare(path, prepared[engine], t = t, length = DSP_LENGTH)
+        (numpy_loudness, numpy_peak), (ffmpeg_loudness, ffmpeg_peak) = ebur128(prepared["numpy"]), ebur128(prepared["ffmpeg"])
+        if numpy_peak > tp + tolerance:
+            raise AssertionError(f"{name} prepared by the numpy engine peaks at {numpy_peak} dBTP, above the ceiling of {tp} dBTP")
+        limited = peak + t - loudness > tp
+        if limited:
+            for engine, prepared_loudness in [("numpy", numpy_loudness), ("ffmpeg", ffmpeg_loudness)]:
+                if not t - max_deficit <= prepared_loudness <= t + tolerance:
+                    raise AssertionError(f"{name} prepared by the {engine} engine is {prepared_loudness} LUFS, the limiter should keep it within {max_deficit} LU below {t} LUFS")
+        elif abs(numpy_loudness - ffmpeg_loudness) > tolerance or abs(numpy_peak - ffmpeg_peak) > tolerance:
+            raise AssertionError(f"{name} prepared by the numpy engine is {numpy_loudness} LUFS and peaks at {numpy_peak} dBTP, "
+                                 f"prepared by ffmpeg {ffmpeg_loudness} LUFS and {ffmpeg_peak} dBTP")
+
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the files of a folder like a media host, answering range requests so ffmpeg can seek in them, and counts the bytes
+    it sends in server.sent
+    """
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        asked = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if asked:
+            start, end = int(asked.group(1)), min(int(asked.group(2) or size - 1), size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(left, 1 << 16))
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg read what it needed
+                    return
+                self.server.sent += len(chunk)
+                left -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+def check_windows(folder, margin = 1, tolerance = 0.05):
+    """
+    Fetches the WINDOWS of a source served over http (see RangeHandler) with download_all's window_margin, and checks that every
+    downloaded window is as long as asked and starts where asked. The source is a ramp, so every sample tells its time. Fails
+    the benchmark as well if the windows were not fetched with range requests, i.e. if most of the source was sent
+    """
+    import numpy as np
+    from Functions.dl import download_all, window_bounds
+
+    os.makedirs(folder, exist_ok = True)
+    source = os.path.join(folder, "ramp.wav")
+    subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", f"aevalsrc=0.9*t/{WINDOW_SOURCE_LENGTH}:s={WINDOW_SAMPLE_RATE}",
+                    "-t", str(WINDOW_SOURCE_LENGTH), "-ac", "2", "-c:a", "pcm_s16le", "-y", source], check = True)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(RangeHandler, directory = folder))
+    server.sent = 0
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    try:
+        link = "http://%s:%d/ramp.wav" % server.server_address
+        windows_csv = os.path.join(folder, "windows.csv")
+        with open(windows_csv, "wt", newline = "") as f:
+            csv.writer(f).writerows([["window " + str(i), link, start, length] for i, (start, length) in enumerate(WINDOWS)])
+        # the fake downloader is only asked for, the links are read by ffmpeg
+        failures = download_all(os.path.join(folder, "windows"), windows_csv, window_margin = margin, downloader = FAKE_DL)
+    finally:
+        server.shutdown()
+        server.server_close()
+    if failures:
+        raise AssertionError(f"Could not fetch the windows: {failures}")
+
+    for i, (start, length) in enumerate(WINDOWS, 1):
+        first, duration = window_bounds(start, length, margin)
+        x = decode(os.path.join(folder, "windows", str(i) + ".wav"))[:, 0]
+        times = x / 32767 / 0.9 * WINDOW_SOURCE_LENGTH
+        if abs(len(x) / WINDOW_SAMPLE_RATE - duration) > tolerance or abs(times[0] - first) > tolerance or abs(times[-1] - first - duration) > tolerance:
+            raise AssertionError(f"Window {i} is {len(x) / WINDOW_SAMPLE_RATE:.3f} s from {times[0]:.3f} s to {times[-1]:.3f} s of the source, "
+                                 f"asked for {duration:.3f} s from {first:.3f} s")
+    size = os.path.getsize(source)
+    if server.sent > size / 2:
+        raise AssertionError(f"{server.sent} of the {size} bytes of the source were sent for the windows")
+
+
+def check_retries(folder, flaky = 2, retries = 2):
+    """
+    Downloads a link that fails its first flaky calls and a link that always fails with download_all, and checks that the first
+    is downloaded after backing off between the retries and that the second is reported in the failures and the failures file
+    """
+    from Functions.dl import download_all
+    from Functions.downloader import FAILURES_FILE, failed_rows
+
+    os.makedirs(folder, exist_ok = True)
+    source = os.path.join(folder, "tone.wav")
+    subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440", "-t", "2", "-y", source], check = True)
+    retries_csv = os.path.join(folder, "retries.csv")
+    with open(retries_csv, "wt", newline = "") as f:
+        csv.writer(f).writerows([["flaky", source], ["gone", os.path.join(folder, "gone.wav")]])
+
+    calls = os.path.join(folder, "calls")
+    os.environ.update(FAKE_DL_FLAKY = str(flaky), FAKE_DL_CALLS = calls)
+    start = time.time()
+    try:
+        failures = download_all(os.path.join(folder, "downloads"), retries_csv, retries = retries, downloader = FAKE_DL)
+    finally:
+        del os.environ["FAKE_DL_FLAKY"], os.environ["FAKE_DL_CALLS"]
+    took = time.time() - start
+
+    if not os.path.exists(os.path.join(folder, "downloads", "1.wav")):
+        raise AssertionError(f"The link failing its first {flaky} calls was not downloaded with {retries} retries: {failures}")
+    # the backoff starts at a second and doubles for every retry
+    if took < 2 ** flaky - 1:
+        raise AssertionError(f"The {flaky} retries took {took:.2f} s, they did not back off")
+    if [(f["row"], f["attempts"]) for f in failures] != [(2, retries + 1)]:
+        raise AssertionError(f"Only the link that always fails should fail after {retries + 1} attempts: {failures}")
+    if failed_rows(os.path.join(folder, "downloads")) != [2]:
+        raise AssertionError(f"The link that always fails is not in {FAILURES_FILE}")
+
+
+def check_distributed(folder, song_length, workers = 2, lease_time = 5):
+    """
+    Downloads and prepares the songs on worker processes on this machine through a coordinator (see Functions/distributed.py),
+    killing one of the workers in the middle of a unit. Fails the benchmark if that unit is not given to another worker and
+    finished, or if any unit fails
+    """
+    import threading
+    from Functions.distributed import Coordinator
+    from Functions.dl import download_all
+    from Functions.manifest import csv_rows
+    from Functions.prepare_track import prepare_all_tracks
+
+    songs_csv = os.path.join(folder, "Songs.csv")
+    club = os.path.join(folder, "distributed")
+    killed = []
+    # the coordinator and the workers must share a key, the workers get it with the environment
+    os.environ.setdefault("KLUB_AUTHKEY", secrets.token_hex(16))
+    # one retry, which the unit of the killed worker uses once its lease runs out
+    with Coordinator("127.0.0.1:0", lease_time = lease_time, retries = 1) as coordinator:
+        # every download takes a second, so the worker is killed well before its unit is done
+        env = dict(os.environ, FAKE_DL_LATENCY = "1")
+        processes = [subprocess.Popen([sys.executable, "-m", "Functions.distributed", "worker", "%s:%d" % coordinator.server.address, "--processes", "1", "--downloader", FAKE_DL],
+                                      cwd = ROOT, env = env) for _ in range(workers)]
+        victim = processes[0]
+
+        def kill():
+            deadline = time.time() + 60
+            while not killed and time.time() < deadline:
+                with coordinator.work.lock:
+                    leased = [unit_id for unit_id, (worker, _) in coordinator.work.leases.items() if worker.endswith(":" + str(victim.pid))]
+                if leased:
+                    victim.kill()
+                    killed.append(coordinator.work.units[leased[0]])
+                time.sleep(0.05)
+
+        killer = threading.Thread(target = kill)
+        killer.start()
+        try:
+            failures = download_all(os.path.join(club, "songs"), songs_csv, coordinator = coordinator)
+            prepare_all_tracks(songs_csv, os.path.join(club, "songs"), os.path.join(club, "prepared_songs"), length = song_length, coordinator = coordinator)
+        finally:
+            killer.join()
+            for p in processes:
+                p.kill()
+                p.wait()
+
+    if not killed:
+        raise AssertionError("The worker to kill was never given a unit")
+    if failures or not os.path.exists(killed[0]["output"]):
+        raise AssertionError(f"The unit of the killed worker ({killed[0]['name']}) was not finished by another worker, {len(failures)} downloads failed")
+    missing = [row[0] for i, row in enumerate(csv_rows(songs_csv), 1) if not os.path.exists(os.path.join(club, "prepared_songs", str(i) + ".wav"))]
+    if missing:
+        raise AssertionError(f"The workers did not prepare {missing}")
+
+
+def run_stage(stage, folder, n, song_length):
+    """
+    Runs one stage on the club in folder, this is what the measured process does
+    """
+    sys.path.insert(0, ROOT)
+    songs_csv = os.path.join(folder, "Songs.csv")
+    shoutouts_csv = os.path.join(folder, "Shoutouts.csv")
+    songs = os.path.join(folder, "songs")
+    shoutouts = os.path.join(folder, "shoutouts")
+
+    if stage == "create_song_csv":
+        from Functions.prepare_csv import create_song_csv
+        create_song_csv(os.path.join(folder, "songs_sheet.csv"), n_songs = n, csv_name = songs_csv)
+    elif stage == "mix_song_pos":
+        from Functions.prepare_csv import mix_song_pos
+        mix_song_pos(songs_csv)
+    elif stage == "shoutout_csv":
+        # not measured, the shoutouts are needed by the later stages
+        from Functions.prepare_csv import create_shoutout_csv, arrange_shoutout_csv
+        create_shoutout_csv(os.path.join(folder, "shoutouts_sheet.csv"), n_shoutouts = n, csv_name = shoutouts_csv)
+        arrange_shoutout_csv(songs_csv, shoutouts_csv)
+    elif stage == "preflight":
+        from Functions.plan import Plan
+        from Functions.preflight import check_club
+        check_club(Plan.from_csv(songs_csv, shoutouts_csv), length = song_length, downloader = FAKE_DL)
+    elif stage == "download_all":
+        from Functions.dl import download_all
+        download_all(songs, songs_csv, downloader = FAKE_DL)
+        download_all(shoutouts, shoutouts_csv, downloader = FAKE_DL)
+    elif stage == "prepare_all_tracks":
+        from Functions.prepare_track import prepare_all_tracks
+        prepare_all_tracks(songs_csv, songs, os.path.join(folder, "prepared_songs"), length = song_length)
+    elif stage == "prepare_all_shoutouts":
+        from Functions.prepare_shoutout import prepare_all_shoutouts
+        from Functions.prepare_csv import get_trim_vals
+        prepare_all_shoutouts(songs_csv, shoutouts, os.path.join(folder, "prepared_shoutouts"), trim_vals = get_trim_vals(shoutouts_csv))
+    elif stage == "combine":
+        from Functions.combine import combine
+        combine(songs_csv, os.path.join(folder, "prepared_shoutouts"), os.path.join(folder, "prepared_songs"), os.path.join(folder, "klub"))
+    elif stage == "combine_chunked":
+        from Functions.chunked import encode_chunked
+        from Functions.manifest import csv_rows
+        # encoded directly in at least two chunks (combine uses a single encoder on a single cpu), so the joins are checked there too
+        inputs = [os.path.join(folder, kind, str(i) + ".wav") for i in range(1, len(csv_rows(songs_csv)) + 1)
+                  for kind in ["prepared_shoutouts", "prepared_songs"]]
+        encode_chunked(inputs, os.path.join(folder, "klub_chunked.mp3"), max(os.cpu_count(), 2))
+    elif stage == "check_joined":
+        # not measured, fails the benchmark if the chunked encode is not the same as the serial one
+        check_joined(folder, n)
+    elif stage == "make_club":
+        from make_klub import make_club
+        club = os.path.join(folder, "make_club")
+        os.makedirs(club, exist_ok = True)
+        for sheet in ["songs_sheet.csv", "shoutouts_sheet.csv"]:
+            shutil.copy(os.path.join(folder, sheet), club)
+        make_club(club, ["songs_sheet.csv", "shoutouts_sheet.csv"], n_songs = n, shoutout_type = "link", song_length = song_length,
+                  incremental = True, cache_dir = None, downloader = FAKE_DL)
+    elif stage == "draft":
+        from make_klub import make_club
+        club = os.path.join(folder, "draft")
+        os.makedirs(club, exist_ok = True)
+        for sheet in ["songs_sheet.csv", "shoutouts_sheet.csv"]:
+            shutil.copy(os.path.join(folder, sheet), club)
+        make_club(club, ["songs_sheet.csv", "shoutouts_sheet.csv"], n_songs = n, shoutout_type = "link", song_length = song_length,
+                  cache_dir = None, downloader = FAKE_DL, draft = True, draft_excerpt = 5)
+    elif stage == "check_dsp":
+        # not measured, fails the benchmark if the numpy engine measures or prepares differently from ffmpeg
+        check_dsp(folder)
+    elif stage == "check_windows":
+        # not measured, fails the benchmark if a window is not fetched as asked
+        check_windows(folder)
+    elif stage == "check_retries":
+        # not measured, fails the benchmark if failed downloads are not retried and reported
+        check_retries(folder)
+    elif stage == "distributed":
+        check_distributed(folder, song_length)
+    else:
+        raise AssertionError(f"Unknown stage {stage}, choose from {STAGES}")
+
+
+def bytes_written(folder, since):
+    """
+    Returns the size of the files in folder written after since (a time stamp)
+    """
+    total = 0
+    for path, _, files in os.walk(folder):
+        for f in files:
+            st = os.lstat(os.path.join(path, f))
+            if st.st_mtime >= since:
+                total += st.st_size
+    return total
+
+
+def measure(stage, folder, n, song_length, verbose = False):
+    """
+    Runs a stage in a new process and returns its wall time, cpu time and peak rss (both including the processes it
+    started) and the bytes it wrote
+    """
+    out = None if verbose else subprocess.DEVNULL
+    start = time.time()
+    p = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-stage", stage, folder, str(n), str(song_length)],
+                         stdout = out, stderr = out)
+    # wait4 gives the resource usage of the process together with all the processes it waited for
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+
+    if p.returncode != 0:
+        raise RuntimeError(f"{stage} failed" + (f" for {n} songs" if n else "") + ", run with --verbose to see why")
+
+    return {"wall": round(wall, 3), "cpu": round(usage.ru_utime + usage.ru_stime, 3),
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1), "written_mb": round(bytes_written(folder, start) / 1024**2, 2)}
+
+
+def compare(results, baseline, tolerance = 0.25, min_seconds = 0.5):
+    """
+    Returns the (size, stage, metric, baseline, now) of every wall/cpu time that got more than tolerance slower than the
+    baseline (ignoring differences below min_seconds)
+    """
+    regressions = []
+    for size, stages in results.items():
+        for stage, now in stages.items():
+            before = baseline.get(size, {}).get(stage)
+            if before is None:
+                continue
+            for metric in ["wall", "cpu"]:
+                if now[metric] > before[metric] * (1 + tolerance) and now[metric] - before[metric] > min_seconds:
+                    regressions.append((size, stage, metric, before[metric], now[metric]))
+    return regressions
+
+
+def missing_baseline(results, baseline):
+    """
+    Returns the (size, stage) of every result that has no baseline to compare to, so a regression there would go unnoticed
+    """
+    return [(size, stage) for size, stages in results.items() for stage in stages if stage not in baseline.get(size, {})]
+
+
+def print_results(results, baseline):
+    print(f"{'songs':>6} {'stage':<22} {'wall s':>8} {'cpu s':>8} {'rss MB':>8} {'written MB':>11} {'wall vs baseline':>17}")
+    for size, stages in results.items():
+        for stage, r in stages.items():
+            before = baseline.get(size, {}).get(stage)
+            ratio = f"{r['wall'] / before['wall']:.2f}x" if before and before["wall"] > 0 else "-"
+            print(f"{size:>6} {stage:<22} {r['wall']:>8.2f} {r['cpu']:>8.2f} {r['peak_rss_mb']:>8.1f} {r['written_mb']:>11.2f} {ratio:>17}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Offline benchmarks of making a club")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = None, help = "the numbers of songs to benchmark, 10, 100 and 1000 by default (none if --orders is given)")
+    parser.add_argument("--orders", type = int, nargs = "+", default = [], help = "the numbers of rows to benchmark the shuffling of the songs and shoutouts with")
+    parser.add_argument("--stages", nargs = "+", default = STAGES, choices = STAGES, help = "the stages to benchmark")
+    parser.add_argument("--checks", nargs = "+", default = None, choices = [*CHECKS, "joined"], help = "only run these checks, without benchmarking anything")
+    parser.add_argument("--song-length", type = float, default = 60, help = "the length of each song in seconds")
+    parser.add_argument("--workdir", default = None, help = "folder for the sources and clubs, a temporary folder by default")
+    parser.add_argument("--output", default = None, help = "json file to write the results to")
+    parser.add_argument("--baseline", default = BASELINE, help = "the baseline to compare to")
+    parser.add_argument("--save-baseline", action = "store_true", help = "store the results as the new baseline (merged with the stored sizes and stages)")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "the relative slowdown that counts as a regression")
+    parser.add_argument("--verbose", action = "store_true", help = "show the output of the stages")
+    parser.add_argument("--run-stage", nargs = 4, metavar = ("STAGE", "FOLDER", "N", "SONG_LENGTH"), help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        stage, folder, n, song_length = args.run_stage
+        run_stage(stage, folder, int(n), float(song_length))
+        return 0
+
+    if args.checks:
+        workdir = args.workdir or tempfile.mkdtemp(prefix = "klub-bench-")
+        try:
+            for check in args.checks:
+                print("Checking", check + "...", file = sys.stderr)
+                folder = os.path.join(workdir, check)
+                n = 0
+                if check == "joined":
+                    # the joins are checked on a small club made here
+                    n = JOINED_SONGS
+                    os.makedirs(folder, exist_ok = True)
+                    write_club(folder, n, generate_sources(os.path.join(workdir, "sources")))
+                    for stage in JOINED_STAGES:
+                        measure(stage, folder, n, args.song_length, args.verbose)
+                measure("check_" + check, folder, n, args.song_length, args.verbose)
+        finally:
+            if args.workdir is None:
+                shutil.rmtree(workdir)
+        print("All checks passed", file = sys.stderr)
+        return 0
+
+    if args.sizes is None:
+        args.sizes = [] if args.orders else [10, 100, 1000]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = "klub-bench-")
+    sources = generate_sources(os.path.join(workdir, "sources")) if args.sizes else None
+
+    baseline, machine = {}, {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "rt") as f:
+            stored = json.load(f)
+        baseline, machine = stored["results"], stored.get("machine", {})
+
+    results = {}
+    for n in args.orders:
+        print("Benchmarking the orders of", n, "songs...", file = sys.stderr)
+        results.setdefault(str(n), {}).update(time_orders(n))
+
+    try:
+        if args.sizes:
+            for check in CHECKS:
+                measure("check_" + check, os.path.join(workdir, check), 0, args.song_length, args.verbose)
+        for n in args.sizes:
+            folder = os.path.join(workdir, str(n))
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            os.makedirs(folder)
+            write_club(folder, n, sources)
+
+            results.setdefault(str(n), {})
+            for stage in STAGES:
+                # the stages depend on each other, so the ones not benchmarked still run (unmeasured)
+                if stage in args.stages:
+                    print("Benchmarking", stage, "with", n, "songs...", file = sys.stderr)
+                    results[str(n)][stage] = measure(stage, folder, n, args.song_length, args.verbose)
+                elif stage not in ("preflight", "make_club", "draft", "distributed"):
+                    measure(stage, folder, n, args.song_length, args.verbose)
+                if stage == "mix_song_pos":
+                    measure("shoutout_csv", folder, n, args.song_length, args.verbose)
+                if stage == "combine_chunked":
+                    measure("check_joined", folder, n, args.song_length, args.verbose)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(results, f, indent = 1)
+
+    if args.save_baseline:
+        machine = {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(), "song_length": args.song_length}
+        with open(args.baseline, "wt") as f:
+            # merged per stage, so recording some stages of a size keeps the baseline of its other stages
+            merged = {size: dict(stages) for size, stages in baseline.items()}
+            for size, stages in results.items():
+                merged.setdefault(size, {}).update(stages)
+            json.dump({"machine": machine, "results": merged}, f, indent = 1)
+        return 0
+
+    if machine.get("cpus") not in (None, os.cpu_count()) or machine.get("song_length") not in (None, args.song_length):
+        print(f"The baseline was recorded with {machine['cpus']} cpus and {machine['song_length']} s songs, the times are not comparable", file = sys.stderr)
+    regressions = compare(results, baseline, args.tolerance)
+    for size, stage, metric, before, now in regressions:
+        print(f"Regression: {stage} with {size} songs, {metric} {before:.2f}s -> {now:.2f}s", file = sys.stderr)
+    # a stage without a baseline fails the run as well, rather than passing without being compared
+    missing = missing_baseline(results, baseline)
+    for size, stage in missing:
+        print(f"No baseline for {stage} with {size} songs, record one with --save-baseline", file = sys.stderr)
+    return 1 if regressions or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Stand-in for youtube-dl used by the benchmarks, so a club can be made without network access.
+Links are paths to local audio files (or file:// urls of them).
+Supports the arguments used by Functions/dl.py and Functions/downloader.py:
+
+    fake_youtube_dl.py --extract-audio --audio-format wav -o <outfile> <link>
+    fake_youtube_dl.py --get-url -f bestaudio/best <link>
+    fake_youtube_dl.py -j <link>
+
+FAKE_DL_LATENCY = seconds to sleep before every call, to simulate the network \n
+FAKE_DL_FAIL = a substring of the links that should fail \n
+FAKE_DL_FLAKY = the number of calls for every link that should fail before it succeeds, counted in the folder FAKE_DL_CALLS
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def count_call(link):
+    """
+    Counts a call for link in the folder FAKE_DL_CALLS, returns the number of calls for it before this one
+    """
+    folder = os.environ['FAKE_DL_CALLS']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, hashlib.sha1(link.encode('utf-8')).hexdigest())
+    calls = 0
+    if os.path.exists(path):
+        with open(path) as f:
+            calls = int(f.read())
+    with open(path, 'w') as f:
+        f.write(str(calls + 1))
+    return calls
+
+
+def main(args):
+    link = args[-1]
+    path = link.replace('file://', '')
+
+    time.sleep(float(os.environ.get('FAKE_DL_LATENCY', 0)))
+    if int(os.environ.get('FAKE_DL_FLAKY', 0)) > count_call(link):
+        print('ERROR: Unable to download', link, '(flaky)', file=sys.stderr)
+        return 1
+    if os.environ.get('FAKE_DL_FAIL') and os.environ['FAKE_DL_FAIL'] in link or not os.path.exists(path):
+        print('ERROR: Unable to download', link, file=sys.stderr)
+        return 1
+
+    if '--get-url' in args or '-g' in args:
+        print('file://' + os.path.abspath(path))
+        return 0
+
+    if '-j' in args or '--dump-json' in args:
+        # ffmpeg without an output prints the duration of the input and exits
+        err = subprocess.run(['ffmpeg', '-hide_banner', '-i', path], stderr=subprocess.PIPE).stderr.decode('utf-8', 'replace')
+        duration = None
+        if 'Duration: ' in err:
+            h, m, s = err.split('Duration: ')[1].split(',')[0].split(':')
+            duration = round(int(h) * 3600 + int(m) * 60 + float(s), 2)
+        print(json.dumps({'title': os.path.basename(path), 'duration': duration, 'webpage_url': link}))
+        return 0
+
+    outfile = args[args.index('-o') + 1]
+    return subprocess.call(['ffmpeg', '-loglevel', 'error', '-i', path, '-vn', '-f', 'wav', '-y', outfile])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
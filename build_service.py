@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Local build service for several clubs, see Functions/service.py
+
+    python build_service.py serve --builds 2 --cpus 8 --net 8
+    python build_service.py submit "Examples/Børne Klub 100" "Børne Klub 100.xlsx" --priority 1 --arg shoutout_type=link --arg song_length=60
+    python build_service.py status [job id]
+
+The service and its clients must share a secret KLUB_SERVICE_TOKEN environment variable
+"""
+import argparse
+import json
+import urllib.error
+import urllib.request
+
+from Functions.service import BuildService, DEFAULT_PORT, TOKEN_HEADER, service_token
+
+
+def request(url, body = None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data = data, headers = {"Content-Type": "application/json", TOKEN_HEADER: service_token()})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        raise SystemExit(json.load(e).get("error", str(e)))
+
+
+def parse_arg(arg):
+    # key=value, the value is read as json if possible (numbers, lists, true/false) and as a string otherwise
+    key, _, value = arg.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Build several clubs with shared caches")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT)
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    serve = commands.add_parser("serve", help = "run the service")
+    serve.add_argument("--builds", type = int, default = 2, help = "the number of clubs to build at the same time")
+    serve.add_argument("--cpus", type = int, default = None, help = "the cpu budget of all builds together, by default the number of cpus")
+    serve.add_argument("--net", type = int, default = 8, help = "the number of downloads of all builds together")
+    serve.add_argument("--cache-dir", default = "default", help = "the cache shared by the builds")
+    serve.add_argument("--downloader", default = "youtube-dl", help = "the youtube-dl executable used by all builds")
+
+    submit = commands.add_parser("submit", help = "queue a build")
+    submit.add_argument("club_folder")
+    submit.add_argument("club_file", nargs = "+", help = "the xlsx, or the song csv and the shoutout csv")
+    submit.add_argument("--priority", type = int, default = 0, help = "builds with a higher priority start first")
+    submit.add_argument("--arg", action = "append", default = [], metavar = "KEY=VALUE", help = "another argument of make_club")
+
+    status = commands.add_parser("status", help = "show the jobs")
+    status.add_argument("job", nargs = "?", type = int)
+
+    args = parser.parse_args()
+    url = f"http://{args.host}:{args.port}/jobs"
+
+    if args.command == "serve":
+        BuildService(builds = args.builds, cpus = args.cpus, net = args.net, cache_dir = args.cache_dir, downloader = args.downloader).serve(args.host, args.port)
+    elif args.command == "submit":
+        club_file = args.club_file[0] if len(args.club_file) == 1 else args.club_file
+        job = request(url, {"club_folder": args.club_folder, "club_file": club_file, "priority": args.priority, **dict(map(parse_arg, args.arg))})
+        print("Queued job", job["id"])
+    else:
+        jobs = request(url if args.job is None else url + "/" + str(args.job))
+        for job in (jobs if isinstance(jobs, list) else [jobs]):
+            print(f"{job['id']:>4} {job['status']:<8} priority {job['priority']:>3}  {job['club_folder']}" + (f"  {job['error']}" if job["error"] else ""))
@@ -1,6 +1,5 @@
 import os
 import shutil
-import pandas as pd
 import time
 
 
@@ -17,7 +16,10 @@ def check_progress(path, check_desc):
 
 
 def make_club(club_folder, club_file, n_songs = 100, output_name = "klub", shoutout_type = "none", song_vol = -14, so_vol = -14, 
-                fade = 3, song_length = 60, file_format = "mp3", files_to_keep = None):
+                fade = 3, song_length = 60, file_format = "mp3", files_to_keep = None, cache_dir = "default", cache_size = 20 * 1024**3,
+                window_margin = None, engine = "ffmpeg", incremental = False, reshuffle = False, pipelined = False, net_workers = 4, cpu_workers = None,
+                retries = 3, downloader = "youtube-dl", trace = None, profile = None, streaming = False, encode_chunks = None, share_prepared = False,
+                coordinator = None, coordinator_public = False, draft = False, draft_excerpt = None, seed = None, spread_artists = False, preflight = False, live = None, budget = None):
     """
     Makes a club 100
     -------------------------------------------------------------
@@ -29,15 +31,43 @@ def make_club(club_folder, club_file, n_songs = 100, output_name = "klub", shout
     so_vol = the shoutout volume in LUFS (-70 to -5) \n
     fade = the number of seconds to fade each song \n
     song_length = length of each song, kan be set to "varying" if song_csv contains the column "sluttidspunkt (i sek)" \n
-    file_format = the file format of the output file \n
-    files_to_keep = the folders to keep as a list of strings. Options are "song_folder", "prep_song_folder", "shoutout_folder", "prep_shoutout_folder", "song_csv", "shoutout_csv", "all", None
+    file_format = the file format of the output file, optionally with a bitrate ("mp3:192k"). Can also be a list of formats (["mp3", "flac", "opus:96k"]), the club is then rendered once and encoded to a file of every format at the same time \n
+    files_to_keep = the folders to keep as a list of strings. Options are "song_folder", "prep_song_folder", "shoutout_folder", "prep_shoutout_folder", "song_csv", "shoutout_csv", "all", None \n
+    cache_dir = folder of the download and loudness cache shared between clubs, "default" uses ~/.cache/klub-100-maker and None disables the cache. It also keeps the parsed club workbooks, so an unchanged xlsx is not parsed again. With the loudness cache, changing song_vol/so_vol only reapplies the gain \n
+    cache_size = the maximum size of the download cache in bytes \n
+    window_margin = if given, only the part of each link that is used (plus this many seconds on both sides) is downloaded instead of the whole source. The windows of a link that are close together are fetched in one pass (see downloader.group_jobs) only when the build is neither pipelined nor streaming: a pipelined build fetches every window on its own, so the first songs of the club are ready first, and a streaming build reads every window straight from its source \n
+    engine = the engine used to normalise and fade, "ffmpeg" (ffmpeg filters) or "numpy" (in process) \n
+    incremental = rebuild without asking, only redownloading/repreparing the songs and shoutouts whose inputs changed since the last build. All folders are kept and the order of the last build (recorded in manifest.json in the club folder) is reused \n
+    reshuffle = give an existing club a new order, reusing its csv's and all downloaded and prepared songs/shoutouts so only the final combine runs (implies incremental) \n
+    pipelined = instead of downloading everything, then preparing everything and then combining, every song/shoutout is prepared as soon as it is downloaded and the club is encoded while the later songs are still being made \n
+    net_workers = the number of downloads to run at the same time \n
+    cpu_workers = the number of songs/shoutouts to prepare at the same time, by default the number of cpus \n
+    retries = the number of times a failed download is retried before it is reported (and left out of the club). Run again with incremental = True to retry only the failed ones \n
+    downloader = the youtube-dl executable, can be replaced by a stand-in taking the same arguments (e.g. for offline tests) \n
+    trace = if given, a span with the wall time, cpu time of ffmpeg/youtube-dl, bytes piped and exit status of every stage and every download/preparation is written to this file as a chrome trace (open it in chrome://tracing or https://ui.perfetto.dev) \n
+    profile = if given, the main process is profiled with cProfile and the stats are written to this file (read them with pstats) \n
+    streaming = make every song/shoutout in memory, reading only the part that is used from its source and feeding it straight to the encoder, so no song/shoutout is ever written to disk. Nothing is kept for later builds, the download cache is not used and the loudness cache only for own shoutouts \n
+    encode_chunks = if given, an mp3 or aac club is encoded in this many chunks on as many cores at once, which are joined without gaps. Only used when the build is neither pipelined nor streaming, as those encode while the songs are being made \n
+    share_prepared = share the prepared songs/shoutouts with other clubs through the cache_dir, so a song prepared with the same settings for another club is not prepared again (implies incremental) \n
+    coordinator = if given, "host:port" on which the downloads and preparations are served to workers on other machines, started with `python -m Functions.distributed worker host:port` (see Functions/distributed.py), instead of being run here. The machines must share a secret KLUB_AUTHKEY environment variable. Only used when the build is neither pipelined nor streaming \n
+    coordinator_public = let the coordinator listen on an address other than loopback (e.g. "0.0.0.0:50100"), so workers on other machines can reach it \n
+    draft = make a quick draft to check the order, the shoutouts and the start times instead of the club: <output_name>_draft.mp3, mono at a low sample rate and bitrate with an approximate gain measured in the same pass (see Functions/draft.py). The draft is streamed (implies streaming) and all files are kept, so build the club with incremental = True afterwards to keep the order of the draft \n
+    draft_excerpt = if given, the draft only has this many seconds at the start and at the end of every song, around its cut and fade points \n
+    seed = a seed for the order of the songs and shoutouts, the same seed gives the same order of the same club \n
+    spread_artists = avoid playing songs by the same artist (the part of "Sang - Kunstner" after " - ") right after each other. Pinned songs keep their position \n
+    preflight = check the club before anything is downloaded: the duration, availability and audio formats of every link are resolved at the same time without downloading, and every song/shoutout is checked to fit in its source (start time plus length) and to be played after the shoutout it names. The problems are printed and written to preflight.json in the club folder. "strict" stops the build if there are any errors \n
+    live = play the club while it is being made: it is encoded as mp3 as soon as each song/shoutout and the ones before it are ready, and written to live, which is "-" for stdout (e.g. `| mpv -`), "host:port" to serve it at http://host:port/ (e.g. for VLC, the club is also written to <output_name>_live.mp3) or a file that grows while the club is made. The songs/shoutouts are made in the order they are played, so the next one is ready first. Implies pipelined unless the build is streaming, and it waits at the end for the http listeners to play the rest of the club \n
+    budget = a Budget (see Functions/service.py) shared with the builds running at the same time, its cpus and downloads are used instead of cpu_workers and net_workers
     """
     
     # initialisation
     t0 = time.time()
-    print("Beginning to make the Club 100...")
+    if live is not None and coordinator is not None:
+        raise AssertionError("A live club is made pipelined or streaming, so it can not be distributed to workers")
+    from Functions import trace as tracing
     song_csv = club_folder+"/Songs.csv"
     shoutout_csv = club_folder+"/Shoutouts.csv"
+    plan_file = club_folder+"/plan.npz"
     song_folder = club_folder+"/songs"
     shoutout_folder = club_folder + "/shoutouts"
     prep_song_folder = club_folder + "/prepared_songs"
@@ -54,90 +84,305 @@ def make_club(club_folder, club_file, n_songs = 100, output_name = "klub", shout
         raise AssertionError(f"To use own shoutouts, please place them in a folder called 'shoutouts' in your wanted club folder: {club_folder}")
     # if not all(elem in folder_names for elem in files_to_keep):
     #     raise AssertionError("Please make sure you specified the file/folder to keep correctly")
-    if not os.path.exists(club_folder+"/"+club_file):
-        raise AssertionError(f"Something is wrong with the club folder/file as {club_folder}/{club_file}")
+    for f in (club_file if type(club_file) == list else [club_file]):
+        if not os.path.exists(club_folder+"/"+f):
+            raise AssertionError(f"Something is wrong with the club folder/file as {club_folder}/{f}")
         
-    # Check whether some process has already been done to speed up
-    dl_songs = check_progress(song_folder, "song folder")
-    dl_so = False if shoutout_type in ["own", "none"] else check_progress(shoutout_folder, "shoutout folder")
-    prep_songs = check_progress(prep_song_folder, "prepared_songs folder")
-    prep_so = check_progress(prep_shoutout_folder, "prepared_shoutouts folder")
-
-    ##imports
-    from Functions.combine import combine
-    if dl_songs or dl_so:
-        from Functions.dl import download_all
-    if dl_songs:
-        from Functions.prepare_csv import create_song_csv, mix_song_pos
-    if dl_so:
-        from Functions.prepare_csv import create_shoutout_csv
-    if prep_songs:
-        from Functions.prepare_track import prepare_all_tracks
-    if prep_so:
-        from Functions.prepare_shoutout import prepare_all_shoutouts
-        from Functions.prepare_csv import get_trim_vals
-
-    # prepare csv's and download
-    if dl_songs:
-        filename, file_extension = os.path.splitext(club_file)
-        if type(club_file) == list:
-            create_song_csv(file_name = club_folder+"/"+club_file[0], csv_name= song_csv, n_songs = n_songs, diff_song_length = diff_song_length)
-            mix_song_pos(song_csv = song_csv, diff_song_length = diff_song_length)
-            if (len(club_file) == 2) & (dl_so):
-                create_shoutout_csv(file_name=club_folder+"/"+club_file[1], csv_name= shoutout_csv, n_shoutouts = n_songs)
-                from Functions.prepare_csv import arrange_shoutout_csv
-                arrange_shoutout_csv(song_csv=song_csv, shoutout_csv=shoutout_csv, diff_song_length=diff_song_length)
-                download_all(dl_path = shoutout_folder, csv_name=shoutout_csv)
+    # raises if a file format is given twice, before anything is made
+    from Functions.combine import outputs
+    club_outputs = outputs(club_folder+"/"+output_name, file_format)
+
+    if draft:
+        from Functions import draft as drafting
+        club_outputs = drafting.outputs(club_folder+"/"+output_name)
+        streaming = True
+        files_to_keep = "all"
+
+    if live is not None and not streaming:
+        pipelined = True
+
+    cpu_slots, limits = None, None
+    if budget is not None:
+        cpu_workers, net_workers, cpu_slots, limits = budget.cpus, budget.net, budget.cpu_slots, budget.limits
+
+    if pipelined and streaming:
+        raise AssertionError("Choose either pipelined or streaming, streaming already makes the songs/shoutouts while encoding")
+    staged = not (pipelined or streaming)
+    if coordinator is not None and not staged:
+        raise AssertionError("Only a build that is neither pipelined nor streaming can be distributed to workers")
+
+    live_output = None
+    if live is not None:
+        # opened once the club is checked and before anything else is printed, so nothing printed goes to a live club on stdout
+        from Functions.live import open_live
+        live_output = open_live(live, club_folder+"/"+output_name+"_live.mp3")
+    finished = False
+    # started right before the try, so tracing (which is process wide) and the profiler are stopped whatever happens
+    if trace is not None:
+        tracing.start(trace)
+    if profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        print("Beginning to make the Club 100...")
+
+        # Check whether some process has already been done to speed up
+        if share_prepared:
+            # prepared files taken from the cache must not be remade in place
+            incremental = True
+        if reshuffle:
+            incremental = True
+            if not os.path.exists(song_csv) and not os.path.exists(plan_file):
+                raise AssertionError(f"To reshuffle a club it must have been made before, no song csv was found at {song_csv}")
+        if incremental or streaming:
+            # every stage runs, when incremental only for the songs and shoutouts that are missing
+            if incremental:
+                files_to_keep = "all"
+            dl_songs, prep_songs, prep_so = True, True, True
+            dl_so = shoutout_type == "link"
         else:
-            create_song_csv(file_name = club_folder+"/"+club_file, csv_name = song_csv, n_songs=n_songs, diff_song_length = diff_song_length)
+            dl_songs = check_progress(song_folder, "song folder")
+            dl_so = False if shoutout_type in ["own", "none"] else check_progress(shoutout_folder, "shoutout folder")
+            prep_songs = check_progress(prep_song_folder, "prepared_songs folder")
+            prep_so = check_progress(prep_shoutout_folder, "prepared_shoutouts folder")
 
-        ## Download songs
-        mix_song_pos(song_csv = song_csv, diff_song_length = diff_song_length)
-        download_all(dl_path=song_folder, csv_name=song_csv)
+        # the tools are found and their versions checked before anything is made, the downloads of a coordinator are made by its workers
+        from Functions.toolchain import require
+        require("ffmpeg", *([downloader] if ((dl_songs or dl_so) and coordinator is None) or preflight else []), cache_dir = cache_dir)
 
+        ##imports
+        from Functions.combine import combine, encode
+        from Functions.manifest import Manifest, download_keys, file_keys, prepare_keys, missing_rows, prune
+        from Functions.plan import Plan
+        from Functions.cache import DownloadCache, LoudnessCache, PreparedCache, DEFAULT_CACHE_DIR
+        cache, loudness_cache, prepared_cache = None, None, None
+        if cache_dir is not None:
+            loudness_cache = LoudnessCache(DEFAULT_CACHE_DIR if cache_dir == "default" else cache_dir)
+            if share_prepared and not streaming:
+                prepared_cache = PreparedCache(DEFAULT_CACHE_DIR if cache_dir == "default" else cache_dir)
+        if dl_songs or dl_so:
+            from Functions.dl import download_all
+            if cache_dir is not None:
+                cache = DownloadCache(DEFAULT_CACHE_DIR if cache_dir == "default" else cache_dir, max_size = cache_size)
+        if prep_songs:
+            from Functions.prepare_track import prepare_all_tracks
+        if prep_so:
+            from Functions.prepare_shoutout import prepare_all_shoutouts
 
-    if (shoutout_type == "link") & (type(club_file) != list) & dl_so:
-        create_shoutout_csv(club_folder+"/"+club_file, n_shoutouts=n_songs, shoutout_sheet="Shoutouts", csv_name = shoutout_csv)
-        from Functions.prepare_csv import arrange_shoutout_csv
-        arrange_shoutout_csv(song_csv=song_csv, shoutout_csv=shoutout_csv, diff_song_length=diff_song_length)
-        download_all(dl_path = shoutout_folder, csv_name=shoutout_csv)
+        manifest = Manifest(club_folder + "/manifest.json")
 
-    # prepare tracks
-    if prep_songs:
-        if diff_song_length:
-            song_length = get_trim_vals(song_csv)
-        prepare_all_tracks(songs_csv=song_csv, input = song_folder, output = prep_song_folder, t = song_vol, f = fade, length = song_length)
+        def last_order(kind, n):
+            # the order of the last build, so an incremental rebuild does not reshuffle the club
+            return manifest.order(kind, n) if incremental else None
+
+        def last_plan():
+            # the plan of the last build, or its csv's if they were edited since (or the club was made before plans were saved)
+            if os.path.exists(plan_file) and (not os.path.exists(song_csv) or os.path.getmtime(plan_file) >= os.path.getmtime(song_csv)):
+                return Plan.load(plan_file)
+            return Plan.from_csv(song_csv, shoutout_csv if os.path.exists(shoutout_csv) else None, diff_song_length = diff_song_length)
+
+        # read the club into a plan, which every stage is given instead of the csv's
+        with tracing.span("csv"):
+            shoutout_file = None
+            if dl_so and ((type(club_file) != list) or (len(club_file) == 2)):
+                shoutout_file = club_folder+"/"+(club_file[1] if type(club_file) == list else club_file)
 
-    # prepare shoutouts
-    with_shoutouts = True if (shoutout_type == "link" or shoutout_type == "own") else False
-    if prep_so:
-        if shoutout_type == "own":
+            if dl_songs and not reshuffle:
+                song_file = club_file[0] if type(club_file) == list else club_file
+                plan = Plan.read(club_folder+"/"+song_file, n_songs = n_songs, diff_song_length = diff_song_length, cache_dir = cache_dir)
+                manifest.set_order("songs", plan.mix(order = last_order("songs", len(plan.songs)), seed = seed, spread = spread_artists))
+            else:
+                plan = last_plan()
+                if reshuffle:
+                    manifest.reorder("songs", plan.mix(seed = seed, spread = spread_artists))
+
+            if shoutout_file is not None:
+                if reshuffle:
+                    manifest.reorder("shoutouts", plan.arrange(seed = seed))
+                else:
+                    plan.read_shoutouts(shoutout_file, n_shoutouts = n_songs, cache_dir = cache_dir)
+                    manifest.set_order("shoutouts", plan.arrange(order = last_order("shoutouts", len(plan.shoutouts)), seed = seed))
+            elif shoutout_type == "link" and plan.shoutouts is None and (os.path.exists(plan_file) or os.path.exists(shoutout_csv)):
+                # the shoutouts were kept from the last build
+                plan.shoutouts = last_plan().shoutouts
+
+            # the csv's are only an export, written before the plan so a csv edited later is newer than the plan
+            plan.to_csv(song_csv, shoutout_csv)
+            plan.save(plan_file)
+
+        # the links are checked before anything heavy starts, so a dead link or a too short source is found in seconds instead of mid-build
+        if preflight:
+            from Functions.preflight import check_club, REPORT_FILE
+            with tracing.span("preflight"):
+                problems = check_club(plan, length = None if diff_song_length else song_length, shoutouts = shoutout_type == "link", report = club_folder + "/" + REPORT_FILE,
+                                      parallel = net_workers, retries = retries, downloader = downloader)
+            errors = [p for p in problems if p["severity"] == "error"]
+            if preflight == "strict" and errors:
+                raise AssertionError(f"The preflight found {len(errors)} errors (see {club_folder}/{REPORT_FILE}), please fix the club sheets or run without preflight = \"strict\"")
+
+        # every downloaded and prepared file is named by a key of the inputs it is made from rather than its position,
+        # so the files are found again after a reshuffle and only changed songs/shoutouts are redone
+        with_shoutouts = True if (shoutout_type == "link" or shoutout_type == "own") else False
+        fixed_length = None if diff_song_length else song_length
+        song_dl_keys = download_keys(plan.songs, length = fixed_length, window_margin = window_margin)
+        song_keys = prepare_keys(song_dl_keys, plan.songs, length = fixed_length, settings = (song_vol, fade, engine, window_margin))
+        so_dl_keys, so_keys = None, None
+        if shoutout_type == "link":
+            so_dl_keys = download_keys(plan.shoutouts, window_margin = window_margin)
+            so_keys = prepare_keys(so_dl_keys, plan.shoutouts, settings = (so_vol, engine, window_margin))
+        elif shoutout_type == "own":
+            # own shoutouts are placed by position, the prepared ones are keyed by the file they are made from
+            so_keys = prepare_keys(file_keys(shoutout_folder, len(song_keys)), settings = (so_vol, engine))
+
+        def missing(keys, folder, prepared = None):
+            if not incremental:
+                return None
+            # a song/shoutout that is prepared already (e.g. taken from the prepared cache) does not have to be downloaded
+            unprepared = None if prepared is None else set(missing_rows(*prepared))
+            return [i for i in missing_rows(keys, folder) if unprepared is None or i in unprepared]
+
+        if diff_song_length:
+            song_length = plan.songs.trim_vals()
+        if shoutout_type == "own" and isinstance(files_to_keep, list):
             files_to_keep.append("shoutout_folder")
-        
+        trim_vals = plan.shoutouts.trim_vals() if shoutout_type == "link" else None
+
+        if prepared_cache is not None:
+            prepared_cache.fetch(prep_song_folder, song_keys)
+            if with_shoutouts:
+                prepared_cache.fetch(prep_shoutout_folder, so_keys)
+
+        if pipelined:
+            from Functions.pipeline import Pipeline, track_jobs, shoutout_jobs
+            from Functions.downloader import FAILURES_FILE, print_failures, save_failures
+
+            # the stages chosen to be redone start from scratch, the files of the other stages are reused
+            for folder, redo in [(song_folder, dl_songs), (shoutout_folder, dl_so), (prep_song_folder, prep_songs), (prep_shoutout_folder, prep_so)]:
+                if redo and not incremental and os.path.exists(folder):
+                    shutil.rmtree(folder)
+                os.makedirs(folder, exist_ok = True)
+
+            songs = track_jobs(plan.songs, song_folder, prep_song_folder, t = song_vol, f = fade, length = song_length, window_margin = window_margin, engine = engine,
+                               input_keys = song_dl_keys, keys = song_keys, cache = loudness_cache)
+            shoutouts = [None] * len(songs)
+            if with_shoutouts:
+                shoutouts = shoutout_jobs(plan.shoutouts if shoutout_type == "link" else None, shoutout_folder, prep_shoutout_folder, len(songs), t = so_vol, trim_vals = trim_vals,
+                                          window_margin = window_margin if shoutout_type == "link" else None, engine = engine, input_keys = so_dl_keys, keys = so_keys, cache = loudness_cache)
+
+            print("Downloading, preparing and putting the elements together...")
+            with tracing.span("pipeline"), Pipeline(cache = cache, net_workers = net_workers, cpu_workers = cpu_workers, retries = retries, downloader = downloader,
+                                                         limits = limits, cpu_slots = cpu_slots) as pipeline:
+                # submitted in the order of the club, so the segments the encoder needs first are made first
+                segments = []
+                for shoutout, song in zip(shoutouts, songs):
+                    if shoutout is not None:
+                        segments.append(pipeline.submit(*shoutout))
+                    segments.append(pipeline.submit(*song))
+                encode(segments, club_outputs, live = live_output)
+
+            print_failures(pipeline.failures, len(pipeline.downloads))
+            for folder in [song_folder, shoutout_folder]:
+                save_failures(os.path.join(folder, FAILURES_FILE), [f for f in pipeline.failures if os.path.dirname(f["outfile"]) == folder])
+
+        if streaming:
+            from Functions.stream import Stream, track_segments, shoutout_segments
+            from Functions.downloader import print_failures
+
+            songs = track_segments(plan.songs, t = song_vol, f = fade, length = song_length, engine = "draft" if draft else engine, excerpt = draft_excerpt if draft else None)
+            shoutouts = [None] * len(songs)
+            if with_shoutouts:
+                shoutouts = shoutout_segments(plan.shoutouts if shoutout_type == "link" else None, shoutout_folder, len(songs), t = so_vol, trim_vals = trim_vals,
+                                              engine = "draft" if draft else engine, cache = loudness_cache)
+            segments = [s for pair in zip(shoutouts, songs) for s in pair if s is not None]
+
+            print("Streaming the elements together...")
+            with tracing.span("stream"), Stream(workers = cpu_workers, retries = retries, downloader = downloader, cpu_slots = cpu_slots) as stream:
+                encode(stream.run(segments), club_outputs, input_args = drafting.FFMPEG_INPUT_ARGS if draft else None, live = live_output)
+            print_failures(stream.failures, len(segments), hint = "they are left out of the club")
+
+        workers = None
+        if coordinator is not None and (dl_songs or dl_so or prep_songs or prep_so):
+            from Functions.distributed import Coordinator
+            workers = Coordinator(coordinator, retries = retries, public = coordinator_public)
+        try:
+            # download
+            if dl_songs and staged:
+                with tracing.span("download songs"):
+                    download_all(dl_path=song_folder, csv_name=plan.songs, cache = cache, window_margin = window_margin, length = fixed_length,
+                                 rows = missing(song_dl_keys, song_folder, (song_keys, prep_song_folder)), keys = song_dl_keys, parallel = net_workers, retries = retries, downloader = downloader, coordinator = workers, limits = limits)
+            if dl_so and staged:
+                with tracing.span("download shoutouts"):
+                    download_all(dl_path = shoutout_folder, csv_name=plan.shoutouts, cache = cache, window_margin = window_margin,
+                                 rows = missing(so_dl_keys, shoutout_folder, (so_keys, prep_shoutout_folder)), keys = so_dl_keys, parallel = net_workers, retries = retries, downloader = downloader, coordinator = workers, limits = limits)
+
+            # prepare tracks
+            if prep_songs and staged:
+                with tracing.span("prepare songs"):
+                    prepare_all_tracks(songs_csv=plan.songs, input = song_folder, output = prep_song_folder, t = song_vol, f = fade, length = song_length, window_margin = window_margin, engine = engine,
+                                       rows = missing(song_keys, prep_song_folder), input_keys = song_dl_keys, keys = song_keys, cache = loudness_cache, processes = cpu_workers, coordinator = workers, cpu_slots = cpu_slots)
+
+            # prepare shoutouts
+            if prep_so and with_shoutouts and staged:
+                with tracing.span("prepare shoutouts"):
+                    prepare_all_shoutouts(songs_csv=plan.songs, input = shoutout_folder, output = prep_shoutout_folder, t = so_vol, trim_vals = trim_vals, window_margin = window_margin if shoutout_type == "link" else None, engine = engine,
+                                          rows = missing(so_keys, prep_shoutout_folder), input_keys = so_dl_keys, keys = so_keys, cache = loudness_cache, processes = cpu_workers, coordinator = workers, cpu_slots = cpu_slots)
+        finally:
+            # the workers are let go even if a stage fails, so the port is free for the next build
+            if workers is not None:
+                workers.close()
+
+
+        # combine the tracks and shoutouts
+        if staged:
+            with tracing.span("combine"):
+                combine(songs_csv= plan.songs, prep_shoutout_path = prep_shoutout_folder, prep_tracks_path = prep_song_folder, output_name = club_folder+"/"+output_name, file_format = file_format, with_shoutouts = with_shoutouts,
+                        song_keys = song_keys, shoutout_keys = so_keys, chunks = encode_chunks)
+
+        if prepared_cache is not None:
+            prepared_cache.put(prep_song_folder, song_keys)
+            if with_shoutouts:
+                prepared_cache.put(prep_shoutout_folder, so_keys)
+
+        # remove files no longer used by any song/shoutout of the club
+        prune(song_folder, song_dl_keys)
+        prune(prep_song_folder, song_keys)
+        if shoutout_type == "link":
+            prune(shoutout_folder, so_dl_keys)
         if with_shoutouts:
-            trim_vals = get_trim_vals(csv=shoutout_csv) if shoutout_type == "link" else None
-            prepare_all_shoutouts(songs_csv=song_csv, input = shoutout_folder, output = prep_shoutout_folder, t = so_vol, trim_vals = trim_vals)
-
-
-    # combine the tracks and shoutouts
-    combine(songs_csv= song_csv, prep_shoutout_path = prep_shoutout_folder, prep_tracks_path = prep_song_folder, output_name = club_folder+"/"+output_name, file_format = file_format, with_shoutouts = with_shoutouts)
-
-    # Remove unwanted folders
-    if (files_to_keep is not "all") & (files_to_keep is not ["all"]):
-        folder_names = ["song_folder", "prep_song_folder", "shoutout_folder", "prep_shoutout_folder", "song_csv", "shoutout_csv"]
-        folder_paths = [song_folder, prep_song_folder, shoutout_folder, prep_shoutout_folder, song_csv, shoutout_csv]
-        file_dict = dict(zip(folder_names, folder_paths))
-        for f in files_to_keep:
-            del file_dict[f]
-
-        for fpath in file_dict.values():
-            if os.path.isfile(fpath):
-                os.remove(fpath)
-            if os.path.isdir(fpath):
-                shutil.rmtree(fpath)
+            prune(prep_shoutout_folder, so_keys)
+
+        # Remove unwanted folders
+        if (files_to_keep is not "all") & (files_to_keep is not ["all"]):
+            folder_names = ["song_folder", "prep_song_folder", "shoutout_folder", "prep_shoutout_folder", "song_csv", "shoutout_csv"]
+            folder_paths = [song_folder, prep_song_folder, shoutout_folder, prep_shoutout_folder, song_csv, shoutout_csv]
+            file_dict = dict(zip(folder_names, folder_paths))
+            for f in files_to_keep:
+                del file_dict[f]
+
+            for fpath in file_dict.values():
+                if os.path.isfile(fpath):
+                    os.remove(fpath)
+                if os.path.isdir(fpath):
+                    shutil.rmtree(fpath)
     
-    print(f"Club was made in {int(time.time()-t0)} seconds")
-    print(f"Your club is ready and placed at {club_folder}/{output_name}.{file_format}, enjoy!")
+        print(f"Club was made in {int(time.time()-t0)} seconds")
+        print(f"Your club is ready and placed at {', '.join(path for path, _ in club_outputs)}, enjoy!")
+        finished = True
+    finally:
+        try:
+            if profile is not None:
+                profiler.disable()
+                profiler.dump_stats(profile)
+            if trace is not None:
+                # the spans of a failed build are written as well, the failed stage is marked with the error in its status
+                events = tracing.collect(trace)
+                if finished:
+                    tracing.summary(events)
+        finally:
+            if live_output is not None:
+                # after an error the listeners are not waited for, the rest of the club will not come
+                live_output.close(wait = finished)
 
     
 if __name__ == "__main__":
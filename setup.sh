@@ -9,7 +9,7 @@ python -m pip install --upgrade pip
 
 # packages
 python -m pip install numpy pandas youtube_dl
-python -m pip install xlrd
+python -m pip install openpyxl
 
 # ffmpeg
 sudo apt update